@@ -1,64 +1,151 @@
 import os
 import time
-import csv
+import json
+import queue
 import subprocess
-import requests
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+import numpy as np
 from prometheus_api_client import PrometheusConnect
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "meta-lb"))
+from features import FEATURE_NAMES, SAMPLE_INTERVAL_SECONDS, WINDOW_SAMPLES, FeatureEngine, raw_queries
+from datastore import DATASET_COLUMNS, DatasetStore
+
 PROMETHEUS_URL = "http://prometheus:9090"
 LB_ALGORITHMS = {
     "round-robin": {"config": "server svc1:80;\nserver svc2:80;\nserver svc3:80;", "label": 0},
     "least_conn": {"config": "least_conn;\nserver svc1:80;\nserver svc2:80;\nserver svc3:80;", "label": 1},
     "ip_hash": {"config": "ip_hash;\nserver svc1:80;\nserver svc2:80;\nserver svc3:80;", "label": 2}
 }
-ALGO_CONF_PATH = "lb-conf/algo.conf"
-DATASET_PATH = "dataset.csv"
+# Columnar dataset store, see meta-lb/datastore.py
+DATASET_PATH = "dataset"
+
+# Completed scenario x algorithm cells are checkpointed here so an interrupted run resumes
+RUNS_DIR = "dataset-runs"
+
+# Isolated LB stacks that cells are scheduled across. Each stack has its own host for
+# Locust, its own algo.conf and nginx container, and a label selector that isolates its
+# nginx_* series in Prometheus. Override with a JSON list in the file named by STACKS_FILE.
+# cpu and mem are host-wide, as meta-lb reads them when serving, so concurrent stacks must
+# each run on a host of their own: with several stacks, each needs a `node_selector` that
+# picks its host's node-exporter series (e.g. 'instance="host-2:9100"'), and no two stacks
+# may share one.
+DEFAULT_STACKS = [
+    {"name": "default", "host": "http://nginx", "algo_conf_path": "lb-conf/algo.conf",
+     "nginx_container": "meta-load-balancer_nginx_1", "selector": "", "node_selector": ""},
+]
 
 # Traffic Scenarios for Locust
-# These would typically be different locustfiles or configurations passed to locust
-# For simplicity, we'll use the same locustfile but simulate different durations/patterns conceptually
+# Each scenario runs as the LoadTestShape of the same name in locust/shapes.py, which sets
+# its duration and user count over time; every user sends USER_RPS requests per second
 SCENARIOS = {
-    "ramp": {"duration": "2m", "users": 100, "spawn_rate": 10, "description": "Ramping up users"},
-    "spike": {"duration": "1m", "users": 500, "spawn_rate": 100, "description": "Sudden spike in users"},
-    "steady_high": {"duration": "3m", "users": 200, "spawn_rate": 20, "description": "Sustained high traffic"},
-    "steady_low": {"duration": "4m", "users": 50, "spawn_rate": 5, "description": "Sustained low traffic"}
+    "ramp": {"description": "Ramping up users"},
+    "spike": {"description": "Sudden spike in users"},
+    "steady_high": {"description": "Sustained high traffic"},
+    "steady_low": {"description": "Sustained low traffic"},
+    "diurnal": {"description": "A day of traffic compressed into ten minutes"},
+    "bursty": {"description": "Poisson bursts on a steady baseline"},
+    "skewed_clients": {"description": "Sustained high traffic from a few heavy client IPs"}
 }
 
-DATA_COLLECTION_WINDOW_SECONDS = 10
+# Distributed load generation: a headless Locust master with LOCUST_WORKERS local worker
+# processes, 0 runs one standalone process. Raise LOCUST_EXPECT_WORKERS above LOCUST_WORKERS
+# to also wait for workers started on other hosts with
+# `locust -f locust/locustfile.py --worker --master-host <this host> --master-port <port>`
+LOCUST_WORKERS = int(os.environ.get("LOCUST_WORKERS", "0"))
+LOCUST_EXPECT_WORKERS = int(os.environ.get("LOCUST_EXPECT_WORKERS", str(LOCUST_WORKERS)))
+# Stacks run concurrently, so each stack's master binds its own port, counting up from this one
+LOCUST_MASTER_PORT = 5557
+# How long a master waits for its workers to connect, and workers get to exit after the master
+LOCUST_WORKER_WAIT_SECONDS = 60
+
+# Seconds to let Nginx settle after a reload before traffic starts
+SETTLE_SECONDS = 5
+
+# A labelled sample is cut from the run every STRIDE_SAMPLES samples once the feature window is full
+STRIDE_SAMPLES = int(os.environ.get("STRIDE_SAMPLES", "1"))
 
 prom = PrometheusConnect(url=PROMETHEUS_URL, disable_ssl=True)
 
-def run_locust(scenario_config):
-    print(f"Starting Locust for scenario: {scenario_config['description']} for {scenario_config['duration']}")
-    # In a real scenario, you might pass different locustfiles or parameters
-    # For this example, we assume locustfile.py in locust/ handles the load pattern
-    # and we control duration and user load via command line arguments.
-    # The command needs to be run in the background.
-    # Note: Adjust users and spawn-rate as needed for your environment.
-    locust_cmd = [
-        "locust",
-        "-f", "locust/locustfile.py",
-        "--headless",
-        "-u", str(scenario_config['users']),
-        "-r", str(scenario_config['spawn_rate']),
-        "--run-time", scenario_config['duration'],
-        "--host=http://nginx"
-    ]
-    process = subprocess.Popen(locust_cmd)
-    print(f"Locust process started with PID: {process.pid}")
-    return process
-
-def update_nginx_config(algo_name):
-    print(f"Updating Nginx config for {algo_name}")
-    with open(ALGO_CONF_PATH, "w") as f:
+def load_stacks():
+    stacks_file = os.environ.get("STACKS_FILE")
+    if not stacks_file:
+        stacks = DEFAULT_STACKS
+    else:
+        with open(stacks_file) as f:
+            stacks = json.load(f)
+    nodes = {}
+    for i, stack in enumerate(stacks):
+        stack.setdefault("locust_master_port", LOCUST_MASTER_PORT + i)
+        stack.setdefault("node_selector", "")
+        if len(stacks) > 1:
+            # Stacks sharing a host would label their rows with each other's cpu and mem
+            if not stack["node_selector"]:
+                raise ValueError(f"Stack '{stack['name']}' needs a node_selector for its own host "
+                                 f"when {len(stacks)} stacks run concurrently")
+            if stack["node_selector"] in nodes:
+                raise ValueError(f"Stacks '{nodes[stack['node_selector']]}' and '{stack['name']}' share "
+                                 f"node_selector {stack['node_selector']}; each stack needs a host of its own")
+            nodes[stack["node_selector"]] = stack["name"]
+    return stacks
+
+def run_locust(scenario_name, stack, histogram_path):
+    print(f"Starting Locust for scenario: {SCENARIOS[scenario_name]['description']} against {stack['host']}")
+    # The load shape drives the user count and ends the run, so no -u/-r/--run-time
+    env = {**os.environ, "LOAD_SHAPE": scenario_name, "LATENCY_HISTOGRAM_PATH": histogram_path}
+    locust_cmd = ["locust", "-f", "locust/locustfile.py", f"--host={stack['host']}"]
+    if LOCUST_EXPECT_WORKERS == 0:
+        process = subprocess.Popen(locust_cmd + ["--headless"], env=env)
+        print(f"Locust process started with PID: {process.pid}")
+        return [process]
+
+    port = str(stack["locust_master_port"])
+    master = subprocess.Popen(locust_cmd + [
+        "--headless", "--master", "--master-bind-port", port,
+        "--expect-workers", str(LOCUST_EXPECT_WORKERS),
+        "--expect-workers-max-wait", str(LOCUST_WORKER_WAIT_SECONDS)
+    ], env=env)
+    workers = [subprocess.Popen(locust_cmd + ["--worker", "--master-host", "127.0.0.1", "--master-port", port], env=env)
+               for _ in range(LOCUST_WORKERS)]
+    print(f"Locust master started with PID {master.pid} and {len(workers)} local worker(s) on port {port}")
+    return [master] + workers
+
+def wait_locust(processes):
+    # Workers exit when the master tells them the run is over
+    master, workers = processes[0], processes[1:]
+    master.wait()
+    for worker in workers:
+        try:
+            worker.wait(timeout=LOCUST_WORKER_WAIT_SECONDS)
+        except subprocess.TimeoutExpired:
+            worker.kill()
+            worker.wait()
+    if master.returncode != 0:
+        print(f"Locust exited with status {master.returncode}")
+
+def load_latency_histogram(path):
+    # Locust's per-request latency histogram of the run, see locust/latency.py
+    if not os.path.exists(path):
+        print(f"Warning: Locust wrote no latency histogram to {path}")
+        return None
+    with open(path) as f:
+        histogram = json.load(f)
+    os.remove(path)
+    return histogram
+
+def update_nginx_config(algo_name, stack):
+    print(f"Updating Nginx config for {algo_name} on stack {stack['name']}")
+    with open(stack["algo_conf_path"], "w") as f:
         f.write(LB_ALGORITHMS[algo_name]["config"])
-    
+
     # Reload Nginx
     # Ensure DOCKER_HOST is set if running this script outside a container that can reach Docker daemon
     # Or that the script runs in a container with Docker socket mounted
     try:
-        # Using the specific container name from docker-compose.yml
-        subprocess.run(["docker", "exec", "meta-load-balancer_nginx_1", "nginx", "-s", "reload"], check=True)
+        # Using the specific container name of this stack
+        subprocess.run(["docker", "exec", stack["nginx_container"], "nginx", "-s", "reload"], check=True)
         print("Nginx reloaded successfully.")
     except subprocess.CalledProcessError as e:
         print(f"Error reloading Nginx: {e}")
@@ -67,138 +154,144 @@ def update_nginx_config(algo_name):
         print("Error: 'docker' command not found. Make sure Docker is installed and in PATH, or this script is run in an environment with access to Docker.")
         # Potentially exit
 
-def fetch_metrics():
-    print(f"Waiting {DATA_COLLECTION_WINDOW_SECONDS}s for metrics to stabilize...")
-    time.sleep(DATA_COLLECTION_WINDOW_SECONDS)
-    print("Fetching metrics from Prometheus...")
-    metrics = {}
+def fetch_run_window(start, end, selector, node_selector=""):
+    # Pull the whole run with a single range query per raw signal, evaluated at the
+    # serving sample interval, instead of many instant queries at the end of the run
+    step = int(SAMPLE_INTERVAL_SECONDS)
+    timestamps = np.arange(start, end + 1e-9, step)
+    series = {}
+    for name, query, _ in raw_queries(selector, node_selector=node_selector):
+        values = np.full(len(timestamps), np.nan)
+        result = prom.custom_query_range(
+            query=query,
+            start_time=datetime.fromtimestamp(start, tz=timezone.utc),
+            end_time=datetime.fromtimestamp(end, tz=timezone.utc),
+            step=f"{step}s"
+        )
+        if result:
+            for ts, value in result[0]['values']:
+                index = int(round((float(ts) - start) / step))
+                if 0 <= index < len(values):
+                    values[index] = float(value)
+        series[name] = values.tolist()
+    return {"timestamps": timestamps.tolist(), "series": series}
+
+def cell_path(scenario_name, algo_name):
+    return os.path.join(RUNS_DIR, f"{scenario_name}__{algo_name}.json")
+
+def write_checkpoint(path, data):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+def run_cell(scenario_name, algo_name, stacks):
+    stack = stacks.get()
     try:
-        # CPU Usage (node_exporter) - average over last window
-        # Note: Query might need adjustment based on your exact node_exporter setup and labels
-        # This query calculates the average CPU usage percentage over the last DATA_COLLECTION_WINDOW_SECONDS.
-        # It assumes 'instance' and 'job' labels are present. Adjust if your labels differ.
-        # It calculates (1 - idle_cpu) * 100.
-        cpu_query = f'avg_over_time(100 * (1 - avg by (instance) (rate(node_cpu_seconds_total{{mode="idle"}}[1m]))))[{DATA_COLLECTION_WINDOW_SECONDS}s:1s]'
-        cpu_data = prom.custom_query(query=cpu_query)
-        if cpu_data and cpu_data[0]:
-            metrics['cpu_usage'] = round(float(cpu_data[0]['value'][1]), 2) # value is [timestamp, value]
-        else:
-            metrics['cpu_usage'] = 0 # Default if no data
-
-        # Memory Usage (node_exporter) - average over last window
-        # This query calculates memory usage percentage: (1 - (available_memory / total_memory)) * 100
-        mem_query = f'avg_over_time(100 * (1 - (node_memory_MemAvailable_bytes / node_memory_MemTotal_bytes)))[{DATA_COLLECTION_WINDOW_SECONDS}s:1s]'
-        mem_data = prom.custom_query(query=mem_query)
-        if mem_data and mem_data[0]:
-            metrics['mem_usage'] = round(float(mem_data[0]['value'][1]), 2)
-        else:
-            metrics['mem_usage'] = 0
-
-        # Latency & Throughput (from meta-lb, assuming it exposes these via Prometheus)
-        # These queries depend on how meta-lb exposes metrics. Placeholder queries:
-        # Assuming nginx_http_request_duration_seconds_bucket from nginx-prometheus-exporter or similar for latency
-        # For Nginx, latency is often a histogram. We'll query for p95.
-        # This query assumes you have nginx-prometheus-exporter set up and metrics are available.
-        # The 'le' label is part of histogram buckets.
-        avg_latency_query = f'avg_over_time(histogram_quantile(0.50, sum(rate(nginx_http_request_duration_seconds_bucket[1m])) by (le, job))[{DATA_COLLECTION_WINDOW_SECONDS}s:1s]) * 1000' # ms
-        p95_latency_query = f'avg_over_time(histogram_quantile(0.95, sum(rate(nginx_http_request_duration_seconds_bucket[1m])) by (le, job))[{DATA_COLLECTION_WINDOW_SECONDS}s:1s]) * 1000' # ms
-        
-        # Throughput: requests per second from Nginx exporter
-        throughput_query = f'avg_over_time(sum(rate(nginx_http_requests_total[1m])) by (job))[{DATA_COLLECTION_WINDOW_SECONDS}s:1s]'
-        
-        # Active connections from Nginx exporter
-        active_connections_query = f'avg_over_time(nginx_http_connections_active[{DATA_COLLECTION_WINDOW_SECONDS}s:1s])'
-
-        avg_latency_data = prom.custom_query(query=avg_latency_query)
-        p95_latency_data = prom.custom_query(query=p95_latency_query)
-        throughput_data = prom.custom_query(query=throughput_query)
-        active_connections_data = prom.custom_query(query=active_connections_query)
-
-        metrics['avg_latency'] = round(float(avg_latency_data[0]['value'][1]), 2) if avg_latency_data and avg_latency_data[0] else 0
-        metrics['p95_latency'] = round(float(p95_latency_data[0]['value'][1]), 2) if p95_latency_data and p95_latency_data[0] else 0
-        metrics['throughput'] = round(float(throughput_data[0]['value'][1]), 2) if throughput_data and throughput_data[0] else 0
-        metrics['active_connections'] = round(float(active_connections_data[0]['value'][1]), 0) if active_connections_data and active_connections_data[0] else 0
-        
-    except requests.exceptions.ConnectionError:
-        print(f"Error connecting to Prometheus at {PROMETHEUS_URL}. Is it running and accessible?")
-        return None # Indicate failure
-    except Exception as e:
-        print(f"Error fetching metrics: {e}")
-        # Set defaults if specific metrics fail
-        metrics.setdefault('cpu_usage', 0)
-        metrics.setdefault('mem_usage', 0)
-        metrics.setdefault('avg_latency', 9999) # High latency for failed fetch
-        metrics.setdefault('p95_latency', 9999)
-        metrics.setdefault('throughput', 0)
-        metrics.setdefault('active_connections', 0)
-
-    print(f"Collected metrics: {metrics}")
-    return metrics
+        print(f"\n--- Running {scenario_name} x {algo_name} on stack {stack['name']} ---")
+        update_nginx_config(algo_name, stack)
+        time.sleep(SETTLE_SECONDS)
+
+        histogram_path = cell_path(scenario_name, algo_name) + ".latency"
+        start = time.time()
+        wait_locust(run_locust(scenario_name, stack, histogram_path)) # Wait for locust to finish its run
+        end = time.time()
+        print(f"Locust finished for {scenario_name} x {algo_name}")
+
+        window = fetch_run_window(start, end, stack["selector"], stack["node_selector"])
+        write_checkpoint(cell_path(scenario_name, algo_name), {
+            "scenario": scenario_name,
+            "algorithm": algo_name,
+            "stack": stack["name"],
+            "start": start,
+            "end": end,
+            "latency_histogram": load_latency_histogram(histogram_path),
+            **window
+        })
+        return scenario_name, algo_name
+    finally:
+        stacks.put(stack)
+
+def windowed_samples(run):
+    # Replay the run through the serving feature engine and cut a sample every
+    # STRIDE_SAMPLES samples once the window is full
+    engine = FeatureEngine()
+    names = list(run["series"])
+    samples = []
+    for i, timestamp in enumerate(run["timestamps"]):
+        engine.ingest({name: run["series"][name][i] for name in names}, timestamp=timestamp)
+        if i + 1 >= WINDOW_SAMPLES and (i + 1 - WINDOW_SAMPLES) % STRIDE_SAMPLES == 0:
+            samples.append({"features": engine.features(), "vector": engine.vector()[0], "timestamp": timestamp})
+    return samples
+
+def label_scenario(scenario_name):
+    # Align the runs of every algorithm by offset into the scenario; at each offset the
+    # algorithm with the lowest latency is the label and its features are the sample
+    runs, run_ids = {}, {}
+    for algo_name in LB_ALGORITHMS:
+        with open(cell_path(scenario_name, algo_name)) as f:
+            run = json.load(f)
+        runs[algo_name] = windowed_samples(run)
+        run_ids[algo_name] = f"{scenario_name}__{algo_name}@{int(run['start'])}"
+
+    rows = {name: [] for name in DATASET_COLUMNS}
+    for offset in range(min(len(samples) for samples in runs.values())):
+        best_algo = min(runs, key=lambda algo_name: runs[algo_name][offset]["features"]["latency"])
+        best = runs[best_algo][offset]
+        for name, value in zip(FEATURE_NAMES, best["vector"]):
+            rows[name].append(float(value))
+        rows["label"].append(LB_ALGORITHMS[best_algo]["label"])
+        rows["scenario"].append(scenario_name)
+        rows["algorithm"].append(best_algo)
+        rows["run_id"].append(run_ids[best_algo])
+        rows["timestamp"].append(best["timestamp"])
+    return rows
 
 def main():
-    # Check if dataset file exists, if not, write header
-    file_exists = os.path.isfile(DATASET_PATH)
-    with open(DATASET_PATH, "a", newline="") as csvfile:
-        writer = csv.writer(csvfile)
-        if not file_exists:
-            writer.writerow(["cpu", "mem", "latency", "p95", "throughput", "connections", "label"])
-
-        for scenario_name, scenario_config in SCENARIOS.items():
-            print(f"\n--- Running Scenario: {scenario_name} ({scenario_config['description']}) ---")
-            locust_process = run_locust(scenario_config)
-            
-            # Wait for locust to run for its duration. 
-            # This is a simplification. In reality, you'd monitor the locust process.
-            # For headless mode, locust runs for the specified --run-time then exits.
-            locust_process.wait() # Wait for locust to finish its run
-            print(f"Locust finished for scenario: {scenario_name}")
-
-            scenario_results = []
-            for algo_name in LB_ALGORITHMS.keys():
-                update_nginx_config(algo_name)
-                # Allow Nginx and system to stabilize after config change
-                print(f"Waiting a bit after Nginx reload for {algo_name}...")
-                time.sleep(5) # Short wait after reload
-                
-                current_metrics = fetch_metrics()
-                if current_metrics:
-                    scenario_results.append({
-                        "algo_name": algo_name,
-                        "metrics": current_metrics,
-                        "label": LB_ALGORITHMS[algo_name]["label"]
-                    })
-                else:
-                    print(f"Skipping {algo_name} due to metric fetch error.")
-            
-            if not scenario_results:
-                print(f"No results collected for scenario {scenario_name}. Skipping.")
-                continue
-
-            # Determine best algorithm for this scenario based on avg_latency
-            best_result = min(scenario_results, key=lambda x: x['metrics']['avg_latency'])
-            best_algo_label = best_result['label']
-            print(f"Best algorithm for scenario '{scenario_name}': {best_result['algo_name']} (Label: {best_algo_label}) with avg_latency: {best_result['metrics']['avg_latency']}")
-
-            # For simplicity, we use the metrics from the 'best_result' run as the features for this scenario.
-            # A more sophisticated approach might average metrics across the scenario or use metrics leading up to the decision.
-            features = best_result['metrics'] # Using metrics of the best performing algo for this scenario
-            
-            writer.writerow([
-                features['cpu_usage'],
-                features['mem_usage'],
-                features['avg_latency'],
-                features['p95_latency'],
-                features['throughput'],
-                features['active_connections'],
-                best_algo_label
-            ])
-            csvfile.flush() # Ensure data is written to disk
-            print(f"Appended data for scenario '{scenario_name}' with label '{best_algo_label}' to {DATASET_PATH}")
+    os.makedirs(RUNS_DIR, exist_ok=True)
+    stacks = queue.Queue()
+    for stack in load_stacks():
+        stacks.put(stack)
+    print(f"Scheduling scenarios across {stacks.qsize()} LB stack(s)")
+
+    # Cells already checkpointed by an earlier, interrupted run are not run again
+    pending = [(scenario_name, algo_name) for scenario_name in SCENARIOS for algo_name in LB_ALGORITHMS
+               if not os.path.exists(cell_path(scenario_name, algo_name))]
+    remaining = {scenario_name: sum(1 for s, _ in pending if s == scenario_name) for scenario_name in SCENARIOS}
+    print(f"{len(pending)} scenario x algorithm cell(s) to run")
+
+    with DatasetStore(DATASET_PATH) as store:
+        def write_scenario(scenario_name):
+            done_marker = os.path.join(RUNS_DIR, f"{scenario_name}.written")
+            if os.path.exists(done_marker):
+                return
+            rows = label_scenario(scenario_name)
+            store.append(rows)
+            store.flush() # Ensure data is written to disk
+            open(done_marker, "w").close()
+            print(f"Appended {len(rows['label'])} rows for scenario '{scenario_name}' to {DATASET_PATH}")
+
+        # Scenarios completed before an interruption may not have been written yet
+        for scenario_name, count in remaining.items():
+            if count == 0:
+                write_scenario(scenario_name)
+
+        with ThreadPoolExecutor(max_workers=stacks.qsize()) as executor:
+            futures = [executor.submit(run_cell, scenario_name, algo_name, stacks) for scenario_name, algo_name in pending]
+            for future in as_completed(futures):
+                try:
+                    scenario_name, algo_name = future.result()
+                except Exception as e:
+                    print(f"Cell failed, it will be retried on the next run: {e}")
+                    continue
+                remaining[scenario_name] -= 1
+                if remaining[scenario_name] == 0:
+                    write_scenario(scenario_name)
 
     print("\nDataset generation complete.")
 
 if __name__ == "__main__":
     # Small delay to allow other services (like Prometheus) to be fully up if run via docker-compose run
     print("Starting dataset generation script. Waiting 15s for services to initialize...")
-    time.sleep(15) 
-    main()
\ No newline at end of file
+    time.sleep(15)
+    main()
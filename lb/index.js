@@ -2,52 +2,154 @@ const express = require('express');
 const httpProxy = require('http-proxy');
 const promClient = require('prom-client');
 
+// Traffic is proxied by `app`; the config API and metrics are served by `admin`
+// on their own ports so the catch-all proxy never sees them
 const app = express();
+const admin = express();
 const proxy = httpProxy.createProxyServer();
 
+// Take req.ip from X-Forwarded-For when the request comes from a private network
+// (e.g. Locust), so iphash sees real clients rather than the load generator
+app.set('trust proxy', ['loopback', 'uniquelocal']);
+
 let algorithm = 'roundrobin';
 let backends = ['svc1:80', 'svc2:80', 'svc3:80'];
-let currentIndex = 0;
+// Per-backend weights for 'weighted'; backends without a weight count as 1
+let weights = {};
+// Version of the last config pushed by meta-lb, reported back for drift reconciliation
+let version = null;
 const connections = {};
 
+// Canary: when set, this fraction of requests is routed with the candidate algorithm and
+// the rest with `algorithm`. Each slice keeps its own round-robin position and smooth
+// weights; in-flight counts are shared since the backends are.
+let canary = null;
+const slices = { incumbent: newSliceState(), canary: newSliceState() };
+// Latency sums per slice since the canary started, read by meta-lb from GET /canary
+let canaryStats = null;
+
 const lbRequestsTotal = new promClient.Counter({
   name: 'lb_requests_total',
   help: 'Total number of requests handled by the load balancer'
 });
 
+const backendInflight = new promClient.Gauge({
+  name: 'lb_backend_inflight_requests',
+  help: 'Requests currently proxied to each backend',
+  labelNames: ['backend']
+});
+
+const backendDuration = new promClient.Histogram({
+  name: 'lb_backend_request_duration_seconds',
+  help: 'Latency of requests proxied to each backend',
+  labelNames: ['backend'],
+  buckets: [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+});
+
+const sliceRequests = new promClient.Counter({
+  name: 'lb_slice_requests_total',
+  help: 'Requests handled by each traffic slice and the algorithm it routed with',
+  labelNames: ['slice', 'algorithm']
+});
+
+const sliceDuration = new promClient.Histogram({
+  name: 'lb_slice_request_duration_seconds',
+  help: 'Latency of requests per traffic slice and the algorithm it routed with',
+  labelNames: ['slice', 'algorithm'],
+  buckets: [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+});
+
+function newSliceState() {
+  return { index: 0, currentWeights: {} };
+}
+
+function newSliceStats() {
+  return { count: 0, sum: 0, sumSquares: 0, errors: 0 };
+}
+
 app.use((req, res) => {
   lbRequestsTotal.inc();
-  const target = selectBackend(req);
+  const slice = canary && Math.random() < canary.fraction ? 'canary' : 'incumbent';
+  const sliceAlgorithm = slice === 'canary' ? canary.algorithm : algorithm;
+  const target = selectBackend(req, sliceAlgorithm, slices[slice]);
+  const stats = canaryStats;
+  const started = process.hrtime.bigint();
+
+  // Track in-flight requests per backend for leastconn and the per-backend metrics
+  connections[target] = (connections[target] || 0) + 1;
+  backendInflight.inc({ backend: target });
+  const endTimer = backendDuration.startTimer({ backend: target });
+  let finished = false;
+  const done = () => {
+    if (finished) return;
+    finished = true;
+    connections[target] -= 1;
+    backendInflight.dec({ backend: target });
+    endTimer();
+
+    const seconds = Number(process.hrtime.bigint() - started) / 1e9;
+    sliceRequests.inc({ slice, algorithm: sliceAlgorithm });
+    sliceDuration.observe({ slice, algorithm: sliceAlgorithm }, seconds);
+    // Requests that started under an earlier canary do not count towards this one
+    if (stats !== null && stats === canaryStats) {
+      const sliceStats = stats[slice];
+      sliceStats.count += 1;
+      sliceStats.sum += seconds;
+      sliceStats.sumSquares += seconds * seconds;
+      if (res.statusCode >= 500 || !res.writableFinished) sliceStats.errors += 1;
+    }
+  };
+  res.on('finish', done);
+  res.on('close', done);
+
   proxy.web(req, res, { target: `http://${target}` });
 });
 
-app.post('/config', express.json(), (req, res) => {
+admin.post('/config', express.json(), (req, res) => {
+  const newVersion = req.body.version === undefined ? null : req.body.version;
   algorithm = req.body.algorithm;
   backends = req.body.backends;
+  weights = req.body.weights || {};
+  canary = req.body.canary || null;
+  // A re-push of the same version (drift reconciliation) keeps the running comparison
+  if (newVersion === null || newVersion !== version) {
+    canaryStats = canary ? { incumbent: newSliceStats(), canary: newSliceStats() } : null;
+  }
+  version = newVersion;
   res.send('Configuration updated');
 });
 
-app.get('/metrics', (req, res) => {
+admin.get('/config', (req, res) => {
+  res.json({ algorithm, backends, weights, canary, version });
+});
+
+admin.get('/canary', (req, res) => {
+  res.json({ version, canary, slices: canaryStats });
+});
+
+admin.get('/metrics', async (req, res) => {
   res.set('Content-Type', promClient.register.contentType);
-  res.end(promClient.register.metrics());
+  res.end(await promClient.register.metrics());
 });
 
-function selectBackend(req) {
-  switch (algorithm) {
+function selectBackend(req, sliceAlgorithm, state) {
+  switch (sliceAlgorithm) {
     case 'roundrobin':
-      return roundrobin();
+      return roundrobin(state);
     case 'leastconn':
       return leastconn();
     case 'iphash':
       return iphash(req.ip);
+    case 'weighted':
+      return weighted(state);
     default:
-      return roundrobin();
+      return roundrobin(state);
   }
 }
 
-function roundrobin() {
-  const target = backends[currentIndex];
-  currentIndex = (currentIndex + 1) % backends.length;
+function roundrobin(state) {
+  const target = backends[state.index % backends.length];
+  state.index = (state.index + 1) % backends.length;
   return target;
 }
 
@@ -61,7 +163,36 @@ function leastconn() {
       target = backend;
     }
   });
-  connections[target] = (connections[target] || 0) + 1;
+  return target;
+}
+
+// Weighted least connections (as nginx's least_conn with weights): the backend with the
+// fewest in-flight requests per unit of weight; ties, e.g. when every backend is idle, are
+// broken by smooth weighted round-robin so each backend's share is spread evenly
+function weighted(state) {
+  const currentWeights = state.currentWeights;
+  const weightOf = backend => (weights[backend] === undefined ? 1 : weights[backend]);
+  const conn = backend => connections[backend] || 0;
+  const positive = backends.filter(backend => weightOf(backend) > 0);
+  const pool = positive.length > 0 ? positive : backends;
+  // conn / weight compared by cross-multiplying
+  let best = pool[0];
+  pool.forEach(backend => {
+    if (conn(backend) * weightOf(best) < conn(best) * weightOf(backend)) best = backend;
+  });
+  const least = pool.filter(backend => conn(backend) * weightOf(best) === conn(best) * weightOf(backend));
+
+  let total = 0;
+  let target = least[0];
+  least.forEach(backend => {
+    const weight = weightOf(backend);
+    currentWeights[backend] = (currentWeights[backend] || 0) + weight;
+    total += weight;
+    if (currentWeights[backend] > currentWeights[target]) {
+      target = backend;
+    }
+  });
+  currentWeights[target] -= total;
   return target;
 }
 
@@ -71,5 +202,5 @@ function iphash(ip) {
 }
 
 app.listen(80, () => console.log('Load balancer listening on port 80'));
-app.listen(7000, () => console.log('Config API listening on port 7000'));
-app.listen(9102, () => console.log('Metrics available on port 9102'));
\ No newline at end of file
+admin.listen(7000, () => console.log('Config API listening on port 7000'));
+admin.listen(9102, () => console.log('Metrics available on port 9102'));
\ No newline at end of file
@@ -0,0 +1,76 @@
+import bisect
+import json
+import os
+import time
+
+from locust import events
+from locust.runners import WorkerRunner
+
+# Per-request latency histogram of a run, exported as JSON when Locust quits. Requests are
+# counted into fixed buckets per HISTOGRAM_INTERVAL_SECONDS slot of wall-clock time, so a
+# run's histogram lines up with the Prometheus samples generate_dataset.py takes. In
+# distributed mode each worker ships the counts it gathered with every stats report and
+# the master merges them.
+
+# Upper bounds in seconds, the same buckets meta-lb uses for its windowed p95
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0)
+HISTOGRAM_INTERVAL_SECONDS = 5.0
+LATENCY_HISTOGRAM_PATH = os.environ.get('LATENCY_HISTOGRAM_PATH', '')
+
+
+class LatencyHistogram:
+    def __init__(self, bounds=LATENCY_BUCKETS, interval=HISTOGRAM_INTERVAL_SECONDS):
+        self.bounds = list(bounds)
+        self.interval = interval
+        # slot index -> bucket counts (the last bucket is +Inf) followed by the failure count
+        self.slots = {}
+
+    def observe(self, timestamp, seconds, failed=False):
+        counts = self.slots.setdefault(int(timestamp // self.interval), [0] * (len(self.bounds) + 2))
+        counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        if failed:
+            counts[-1] += 1
+
+    # Hand over the counts gathered since the last drain; used by workers
+    def drain(self):
+        slots, self.slots = self.slots, {}
+        return {str(slot): counts for slot, counts in slots.items()}
+
+    def merge(self, slots):
+        for slot, counts in slots.items():
+            merged = self.slots.setdefault(int(slot), [0] * (len(self.bounds) + 2))
+            for i, count in enumerate(counts):
+                merged[i] += count
+
+    def export(self):
+        return {
+            'bucket_bounds_seconds': self.bounds,
+            'interval_seconds': self.interval,
+            'slots': [{'start': slot * self.interval, 'counts': counts[:-1], 'failures': counts[-1]}
+                      for slot, counts in sorted(self.slots.items())],
+        }
+
+
+HISTOGRAM = LatencyHistogram()
+
+
+def install(path=LATENCY_HISTOGRAM_PATH):
+    @events.request.add_listener
+    def on_request(response_time, exception=None, start_time=None, **kwargs):
+        HISTOGRAM.observe(start_time or time.time(), response_time / 1000.0, exception is not None)
+
+    @events.report_to_master.add_listener
+    def on_report_to_master(client_id, data, **kwargs):
+        data['latency_histogram'] = HISTOGRAM.drain()
+
+    @events.worker_report.add_listener
+    def on_worker_report(client_id, data, **kwargs):
+        HISTOGRAM.merge(data.get('latency_histogram', {}))
+
+    @events.quitting.add_listener
+    def on_quitting(environment, **kwargs):
+        if not path or isinstance(environment.runner, WorkerRunner):
+            return
+        with open(path, 'w') as f:
+            json.dump(HISTOGRAM.export(), f)
+        print(f"Wrote latency histogram of {len(HISTOGRAM.slots)} slots to {path}")
@@ -1,10 +1,46 @@
-import time
+import os
 import random
-from locust import HttpUser, task, between
 
-class WebsiteUser(HttpUser):
-    wait_time = between(1, 3)  # Wait between 1 and 3 seconds between tasks
-    
+from locust import FastHttpUser, constant_throughput, task
+
+import latency
+from shapes import SHAPES
+
+# Requests per second each user sends, whatever the response time
+USER_RPS = float(os.environ.get('USER_RPS', '10'))
+# Distinct client IPs the users spread over, sent as X-Forwarded-For so that ip_hash sees
+# many clients rather than the one Locust host
+CLIENT_IPS = int(os.environ.get('CLIENT_IPS', '1000'))
+# Scripted load shape from shapes.py; empty leaves the user count to the web UI
+LOAD_SHAPE = os.environ.get('LOAD_SHAPE', '')
+
+latency.install()
+
+if LOAD_SHAPE:
+    # Locust runs the one LoadTestShape subclass it finds in this module
+    Shape = SHAPES[LOAD_SHAPE]
+    CLIENT_ZIPF_EXPONENT = getattr(Shape, 'client_zipf_exponent', None)
+else:
+    CLIENT_ZIPF_EXPONENT = None
+
+
+def client_ip(index):
+    # 100.64.0.0/10 (shared address space) is never mistaken for a trusted proxy address
+    return f"100.{64 + (index >> 16) % 64}.{(index >> 8) & 255}.{index & 255}"
+
+
+CLIENT_ADDRESSES = [client_ip(i + 1) for i in range(CLIENT_IPS)]
+# Uniform by default; the skewed_clients shape concentrates users on a few addresses
+CLIENT_WEIGHTS = None if CLIENT_ZIPF_EXPONENT is None else [
+    1.0 / (rank + 1) ** CLIENT_ZIPF_EXPONENT for rank in range(CLIENT_IPS)]
+
+
+class WebsiteUser(FastHttpUser):
+    wait_time = constant_throughput(USER_RPS)
+
+    def on_start(self):
+        self.headers = {'X-Forwarded-For': random.choices(CLIENT_ADDRESSES, CLIENT_WEIGHTS)[0]}
+
     @task
     def index_page(self):
-        self.client.get("/")
\ No newline at end of file
+        self.client.get("/", headers=self.headers)
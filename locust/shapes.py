@@ -0,0 +1,120 @@
+import math
+import os
+import random
+
+from locust import LoadTestShape
+
+# Scripted load shapes, one per dataset scenario. locustfile.py exposes the shape named by
+# LOAD_SHAPE to Locust; with no LOAD_SHAPE the user count is set by hand in the web UI.
+# Every user sends USER_RPS requests per second (see locustfile.py), so the offered load
+# is users x USER_RPS whatever the response times.
+
+# Seed for the random parts of a shape (bursts), so every algorithm sees the same load
+LOAD_SEED = int(os.environ.get('LOAD_SEED', '0'))
+
+
+# Base class: a user count as a function of seconds into the run, for `duration` seconds
+class ScenarioShape(LoadTestShape):
+    abstract = True
+    duration = 60
+    spawn_rate = 10
+
+    def users(self, run_time):
+        raise NotImplementedError
+
+    def tick(self):
+        run_time = self.get_run_time()
+        if run_time >= self.duration:
+            return None
+        return max(int(round(self.users(run_time))), 1), self.spawn_rate
+
+
+# Gradually increasing traffic, 0 to 100 users over two minutes
+class RampShape(ScenarioShape):
+    duration = 120
+    spawn_rate = 10
+    peak_users = 100
+
+    def users(self, run_time):
+        return self.peak_users * run_time / self.duration
+
+
+# Sudden burst: 500 users for the middle half of the minute on top of a light baseline
+class SpikeShape(ScenarioShape):
+    duration = 60
+    spawn_rate = 100
+    base_users = 50
+    spike_users = 500
+
+    def users(self, run_time):
+        return self.spike_users if self.duration / 4 <= run_time < 3 * self.duration / 4 else self.base_users
+
+
+class SteadyHighShape(ScenarioShape):
+    duration = 180
+    spawn_rate = 20
+
+    def users(self, run_time):
+        return 200
+
+
+class SteadyLowShape(ScenarioShape):
+    duration = 240
+    spawn_rate = 5
+
+    def users(self, run_time):
+        return 50
+
+
+# A day compressed into ten minutes: a night trough, a morning rise, a midday plateau
+# and an evening peak
+class DiurnalShape(ScenarioShape):
+    duration = 600
+    spawn_rate = 20
+    night_users = 20
+    peak_users = 250
+
+    def users(self, run_time):
+        day = 2 * math.pi * run_time / self.duration
+        level = 0.5 - 0.5 * math.cos(day) + 0.15 * math.sin(2 * day)
+        return self.night_users + (self.peak_users - self.night_users) * min(max(level, 0.0), 1.0)
+
+
+# Steady baseline with bursts arriving as a Poisson process, each adding a random number
+# of users for an exponentially distributed time
+class BurstyShape(ScenarioShape):
+    duration = 300
+    spawn_rate = 200
+    base_users = 60
+    burst_interval = 30.0
+    burst_seconds = 10.0
+    burst_users = (150, 400)
+
+    def __init__(self):
+        super().__init__()
+        rng = random.Random(LOAD_SEED)
+        self.bursts = []
+        at = rng.expovariate(1.0 / self.burst_interval)
+        while at < self.duration:
+            self.bursts.append((at, at + rng.expovariate(1.0 / self.burst_seconds), rng.randint(*self.burst_users)))
+            at += rng.expovariate(1.0 / self.burst_interval)
+
+    def users(self, run_time):
+        return self.base_users + sum(users for start, end, users in self.bursts if start <= run_time < end)
+
+
+# Steady high load from a few heavy clients: users pick their client IP from a Zipf
+# distribution instead of uniformly, which loads ip_hash's backends unevenly
+class SkewedClientsShape(SteadyHighShape):
+    client_zipf_exponent = 1.2
+
+
+SHAPES = {
+    'ramp': RampShape,
+    'spike': SpikeShape,
+    'steady_high': SteadyHighShape,
+    'steady_low': SteadyLowShape,
+    'diurnal': DiurnalShape,
+    'bursty': BurstyShape,
+    'skewed_clients': SkewedClientsShape,
+}
@@ -1,10 +1,51 @@
 import time
 import os
-import subprocess
-import requests
-import joblib
+import signal
+import threading
 import numpy as np
 from prometheus_client import start_http_server, Gauge
+from collector import MetricsCollector
+from applier import ConfigApplier
+from canary import CANARY_FRACTION, CanaryApplier
+from fleet import LB_BACKENDS, LBFleet, RECONCILE_SECONDS
+from forest import CompiledForest
+from registry import ModelRegistry
+from reloader import NGINX_SERVICE, NginxReloader
+from features import FEATURE_NAMES, FeatureEngine, SAMPLE_INTERVAL_SECONDS, check_schema, load_schema, raw_queries
+from journal import JOURNAL_PATH, DecisionJournal
+from instrumentation import FEATURE_VALUE, POOL_ALGORITHM, PREDICTION_CONFIDENCE, PREDICT_SECONDS, SamplingProfiler
+from pools import POOL_LABEL, PoolConfigApplier, PoolFeatures, parse_pools
+from scheduler import AdaptiveScheduler
+from webhook import WEBHOOK_PORT, serve_webhook, trigger_source
+from weights import BACKEND_LABEL, BACKEND_QUERIES, WeightScorer
+
+PROMETHEUS_URL = os.environ.get('PROMETHEUS_URL', 'http://prometheus:9090')
+LB_CONFIG_URL = os.environ.get('LB_CONFIG_URL', 'http://lb:7000/config')
+# LB fleet: a comma-separated list of config URLs, or a DNS name whose every record is
+# an LB replica; a single LB_CONFIG_URL target when neither is set
+LB_TARGETS = [url.strip() for url in os.environ.get('LB_TARGETS', '').split(',') if url.strip()]
+LB_DNS_NAME = os.environ.get('LB_DNS_NAME', '')
+LB_BACKEND_LIST = [b.strip() for b in os.environ.get('LB_BACKENDS', ','.join(LB_BACKENDS)).split(',') if b.strip()]
+LB_RECONCILE_SECONDS = float(os.environ.get('LB_RECONCILE_SECONDS', str(RECONCILE_SECONDS)))
+NGINX_CONF_DIR = os.environ.get('NGINX_CONF_DIR', '/etc/nginx/conf.d')
+MIN_DWELL_SECONDS = float(os.environ.get('MIN_DWELL_SECONDS', '30'))
+CONFIDENCE_MARGIN = float(os.environ.get('CONFIDENCE_MARGIN', '0.1'))
+PROFILER_ENABLED = os.environ.get('PROFILER_ENABLED', '0') == '1'
+# 'algorithm' picks one algorithm for all backends, 'weights' pushes a weight per backend,
+# 'pools' picks an algorithm for each nginx upstream pool in LB_POOLS
+META_LB_MODE = os.environ.get('META_LB_MODE', 'algorithm')
+# Pools mode: "name=host:port,host:port;name=host:port", one upstream-<name>.conf each
+LB_POOLS = os.environ.get('LB_POOLS', '')
+# Vary the decision interval with how fast things change; '0' polls every SAMPLE_INTERVAL_SECONDS
+ADAPTIVE_SCHEDULING = os.environ.get('ADAPTIVE_SCHEDULING', '1') == '1'
+WEBHOOK_LISTEN_PORT = int(os.environ.get('WEBHOOK_PORT', str(WEBHOOK_PORT)))
+MODEL_DIR = os.path.join(os.path.dirname(__file__), 'models')
+
+ALGORITHMS = {
+    0: "round-robin",
+    1: "least_conn",
+    2: "ip_hash"
+}
 
 # Define Prometheus metrics
 ALGORITHM_GAUGE = Gauge('current_lb_algorithm', 'Current Load Balancing Algorithm', ['algorithm'])
@@ -14,139 +55,245 @@ ALGORITHM_GAUGE.labels(algorithm='round-robin').set(0)
 ALGORITHM_GAUGE.labels(algorithm='least_conn').set(0)
 ALGORITHM_GAUGE.labels(algorithm='ip_hash').set(0)
 
+# Refuse to serve a model trained on a different feature schema
+def check_model_schema(model_dir=MODEL_DIR):
+    schema_path = os.path.join(model_dir, 'feature_schema.json')
+    if not os.path.exists(schema_path):
+        print(f"Warning: {schema_path} not found, cannot verify the model's feature schema")
+        return
+    check_schema(load_schema(schema_path))
+
 # Load the ML model
-def load_model():
-    # Directly load the trained model from models/lb_model.pkl
-    model_path = os.path.join(os.path.dirname(__file__), 'models', 'lb_model.pkl')
-    return joblib.load(model_path)
-
-# Get metrics from Prometheus
-def get_metrics():
-    try:
-        # Get CPU usage from node-exporter
-        cpu_response = requests.get('http://prometheus:9090/api/v1/query', params={
-            'query': '100 - (avg by (instance) (irate(node_cpu_seconds_total{mode="idle"}[1m])) * 100)'
-        })
-        cpu_data = cpu_response.json()
-        cpu_usage = float(cpu_data['data']['result'][0]['value'][1]) if cpu_data['data']['result'] else 50.0
-        
-        # Get memory usage from node-exporter
-        mem_response = requests.get('http://prometheus:9090/api/v1/query', params={
-            'query': '(node_memory_MemTotal_bytes - node_memory_MemAvailable_bytes) / node_memory_MemTotal_bytes * 100'
-        })
-        mem_data = mem_response.json()
-        mem_usage = float(mem_data['data']['result'][0]['value'][1]) if mem_data['data']['result'] else 50.0
-        
-        # Get HTTP latency from Nginx metrics
-        latency_response = requests.get('http://prometheus:9090/api/v1/query', params={
-            'query': 'sum(rate(nginx_http_request_duration_seconds_sum[1m])) / sum(rate(nginx_http_request_duration_seconds_count[1m]))'
-        })
-        latency_data = latency_response.json()
-        latency = float(latency_data['data']['result'][0]['value'][1]) if latency_data['data']['result'] else 0.1
-        
-        # Get HTTP throughput from Nginx metrics
-        throughput_response = requests.get('http://prometheus:9090/api/v1/query', params={
-            'query': 'sum(rate(nginx_http_requests_total[1m]))'
-        })
-        throughput_data = throughput_response.json()
-        throughput = float(throughput_data['data']['result'][0]['value'][1]) if throughput_data['data']['result'] else 10.0
-        
-        # Normalize values between 0 and 1
-        cpu_usage = min(cpu_usage / 100.0, 1.0)
-        mem_usage = min(mem_usage / 100.0, 1.0)
-        latency = min(latency / 1.0, 1.0)  # Assuming 1 second is the max latency
-        throughput = min(throughput / 100.0, 1.0)  # Assuming 100 req/s is the max throughput
-        
-        return np.array([[cpu_usage, mem_usage, latency, throughput]])
-    except Exception as e:
-        print(f"Error getting metrics: {e}")
-        # Return default values if there's an error
-        return np.array([[0.5, 0.5, 0.5, 0.5]])
+def load_model(model_dir=MODEL_DIR):
+    # Prefer the compiled forest in models/lb_forest, which does not need scikit-learn
+    forest_path = os.path.join(model_dir, 'lb_forest')
+    if os.path.exists(os.path.join(forest_path, 'meta.json')):
+        return CompiledForest.load(forest_path)
+
+    # Fall back to the pickled scikit-learn model in models/lb_model.pkl
+    import joblib
+    return joblib.load(os.path.join(model_dir, 'lb_model.pkl'))
+
+# Get metrics from Prometheus and fold them into the rolling feature windows
+def get_metrics(collector, engine, timestamp=None):
+    engine.ingest(collector.collect(), timestamp)
+    return engine.vector()
+
+# Predict the best algorithm along with the confidence of every algorithm
+def predict(model, metrics):
+    proba = model.predict_proba(metrics)[0]
+    scores = {ALGORITHMS.get(int(c), "round-robin"): float(p) for c, p in zip(model.classes_, proba)}
+    algorithm = ALGORITHMS.get(int(model.classes_[np.argmax(proba)]), "round-robin")
+    return algorithm, scores
+
+# Predict every pool at once from an N x F matrix; one (algorithm, scores) per row
+def predict_pools(model, matrix):
+    proba = model.predict_proba(matrix)
+    names = [ALGORITHMS.get(int(c), "round-robin") for c in model.classes_]
+    best = np.argmax(proba, axis=1)
+    return [(names[b], dict(zip(names, row.tolist()))) for b, row in zip(best, proba)]
 
 # Update the Nginx configuration based on the predicted algorithm
-def update_nginx_config(algorithm_id):
-    algorithms = {
-        0: "round-robin",
-        1: "least_conn",
-        2: "ip_hash"
-    }
-    
-    algorithm = algorithms.get(algorithm_id, "round-robin")
-    
+def update_nginx_config(applier, algorithm, scores=None, features=None):
+    applied = applier.propose(algorithm, scores, features)
+
     # Update Prometheus gauge
-    for alg in algorithms.values():
-        if alg == algorithm:
-            ALGORITHM_GAUGE.labels(algorithm=alg).set(1)
-        else:
-            ALGORITHM_GAUGE.labels(algorithm=alg).set(0)
-    
-    # Generate new algo.conf content for server directives only
-    server_content = "# Load balancing algorithm: " + algorithm + "\nserver svc1:80;\nserver svc2:80;\nserver svc3:80;\n"
-    
-    # Write server directives to algo.conf
-    with open('/etc/nginx/conf.d/algo.conf', 'w') as f:
-        f.write(server_content)
-    
-    # Update default.conf with the appropriate algorithm directive
-    with open('/etc/nginx/conf.d/default.conf', 'r') as f:
-        default_conf = f.read()
-    
-    # Remove any existing algorithm directives
-    default_conf = default_conf.replace("least_conn;", "# least_conn;")
-    default_conf = default_conf.replace("ip_hash;", "# ip_hash;")
-    
-    # Add the appropriate algorithm directive
-    if algorithm == "least_conn":
-        default_conf = default_conf.replace("# least_conn;", "least_conn;")
-    elif algorithm == "ip_hash":
-        default_conf = default_conf.replace("# ip_hash;", "ip_hash;")
-    
-    # Write the updated default.conf
-    with open('/etc/nginx/conf.d/default.conf', 'w') as f:
-        f.write(default_conf)
-    
-    # Prepare the JSON payload for the load balancer
-    payload = {
-        "algorithm": algorithm,
-        "backends": ["svc1:3000", "svc2:3000", "svc3:3000"]
-    }
-
-    # Send the configuration to the load balancer
-    try:
-        response = requests.post("http://lb:7000/config", json=payload)
-        response.raise_for_status()
-        print(f"Updated load balancing algorithm to: {algorithm}")
-    except requests.exceptions.RequestException as e:
-        print(f"Failed to update load balancer configuration: {e}")
+    for alg in ALGORITHMS.values():
+        ALGORITHM_GAUGE.labels(algorithm=alg).set(1 if alg == applied else 0)
+
+    return applied
+
+# One fetch -> predict -> apply cycle; returns the applied algorithm and per-stage seconds.
+# A scheduler, when given, sees the features and confidence to pick the next interval;
+# a journal, when given, gets the decision.
+def run_cycle(collector, engine, model, applier, timestamp=None, scheduler=None, journal=None, model_version=None):
+    started = time.perf_counter()
+
+    # Get metrics
+    metrics = get_metrics(collector, engine, timestamp)
+    fetched = time.perf_counter()
+    for name, value in zip(FEATURE_NAMES, metrics[0]):
+        FEATURE_VALUE.labels(feature=name).set(value)
+
+    # Predict the best algorithm
+    algorithm, scores = predict(model, metrics)
+    predicted = time.perf_counter()
+    PREDICT_SECONDS.observe(predicted - fetched)
+    for alg, confidence in scores.items():
+        PREDICTION_CONFIDENCE.labels(algorithm=alg).set(confidence)
+    if scheduler is not None:
+        scheduler.observe(metrics[0], max(scores.values()))
+
+    # Update Nginx config, a no-op unless the algorithm really changes
+    applied = update_nginx_config(applier, algorithm, scores, metrics[0])
+    finished = time.perf_counter()
+
+    if journal is not None:
+        journal.record(metrics[0], scores, algorithm, applied, engine.latest.get('latency', np.nan),
+                       model_version=model_version, timestamp=timestamp)
+
+    return applied, {'fetch': fetched - started, 'predict': predicted - fetched, 'apply': finished - predicted}
+
+# Weights mode cycle: per-backend signals -> scored weights -> apply; same return shape as run_cycle
+def run_weight_cycle(collector, scorer, applier, scheduler=None):
+    started = time.perf_counter()
+    values = collector.collect()
+    fetched = time.perf_counter()
+
+    weights = scorer.update(values)
+    predicted = time.perf_counter()
+    PREDICT_SECONDS.observe(predicted - fetched)
+    if scheduler is not None:
+        scheduler.observe(scorer.last_saturation)
+
+    applied = applier.propose_weights(weights)
+    finished = time.perf_counter()
+
+    return applied, {'fetch': fetched - started, 'predict': predicted - fetched, 'apply': finished - predicted}
+
+# Pools mode cycle: one grouped fetch and one predict call for every pool, then each pool's
+# applier; returns {pool: applied algorithm} and per-stage seconds like run_cycle
+def run_pool_cycle(collector, pool_features, model, appliers, timestamp=None, scheduler=None, journal=None,
+                   model_version=None):
+    started = time.perf_counter()
+    pool_features.ingest(collector.collect(), timestamp)
+    matrix = pool_features.matrix()
+    fetched = time.perf_counter()
+
+    predictions = predict_pools(model, matrix)
+    predicted = time.perf_counter()
+    PREDICT_SECONDS.observe(predicted - fetched)
+    if scheduler is not None:
+        # The least certain pool decides how soon the next cycle runs
+        scheduler.observe(matrix, min(max(scores.values()) for _, scores in predictions))
 
+    applied = {}
+    for row, (pool, (algorithm, scores)) in enumerate(zip(pool_features.pools, predictions)):
+        applied[pool] = appliers[pool].propose(algorithm, scores)
+        for alg in ALGORITHMS.values():
+            POOL_ALGORITHM.labels(pool=pool, algorithm=alg).set(1 if alg == applied[pool] else 0)
+        if journal is not None:
+            journal.record(matrix[row], scores, algorithm, applied[pool],
+                           pool_features.engines[pool].latest.get('latency', np.nan), pool=pool,
+                           model_version=model_version, timestamp=timestamp)
+    finished = time.perf_counter()
+
+    return applied, {'fetch': fetched - started, 'predict': predicted - fetched, 'apply': finished - predicted}
+
+def main():
     # Start Prometheus metrics server
     start_http_server(8000)
     print("Prometheus metrics server started on port 8000")
-    
-    # Load the ML model
-    model = load_model()
-    print("ML model loaded successfully")
-    
-    # Set initial algorithm
-    update_nginx_config(0)  # Start with round-robin
-    
+
+    # Optional on-demand sampling profiler, triggered with SIGUSR1
+    if PROFILER_ENABLED:
+        SamplingProfiler().install()
+
+    if ADAPTIVE_SCHEDULING:
+        scheduler = AdaptiveScheduler()
+    else:
+        scheduler = AdaptiveScheduler(min_interval=SAMPLE_INTERVAL_SECONDS, max_interval=SAMPLE_INTERVAL_SECONDS)
+
+    registry = ModelRegistry(MODEL_DIR)
+
+    # POST /trigger (e.g. an Alertmanager webhook receiver) runs a decision cycle immediately
+    def on_trigger(payload):
+        scheduler.trigger(trigger_source(payload))
+        return 'Decision cycle triggered'
+
+    # POST /rollback swaps the previous model back in before the next cycle
+    def on_rollback(payload):
+        registry.request_rollback()
+        scheduler.trigger('rollback')
+        return f"Rolling back from model version {registry.versions()['active']}"
+
+    serve_webhook({'/trigger': on_trigger, '/rollback': on_rollback}, port=WEBHOOK_LISTEN_PORT)
+
+    # Every algorithm decision goes to the decision journal (see journal.py); weights mode
+    # makes no algorithm decisions and is not journalled
+    journal = None
+    if JOURNAL_PATH and META_LB_MODE != 'weights':
+        journal = DecisionJournal(JOURNAL_PATH, [ALGORITHMS[label] for label in sorted(ALGORITHMS)]).start()
+        print(f"Journalling decisions to {JOURNAL_PATH}")
+
+    if META_LB_MODE != 'weights':
+        # Serve the newest valid model version, or the unversioned artifact when there is none,
+        # and keep watching for new versions in the background
+        if not registry.load_latest():
+            check_model_schema()
+            registry.activate(None, load_model())
+        registry.start()
+        print("ML model loaded successfully")
+
+    # Every config change is validated and reloaded into the nginx containers
+    reloader = NginxReloader(NGINX_SERVICE) if NGINX_SERVICE else None
+
+    if META_LB_MODE == 'pools':
+        pools = parse_pools(LB_POOLS)
+        collector = MetricsCollector(PROMETHEUS_URL, raw_queries(group_by=POOL_LABEL), group_label=POOL_LABEL)
+        pool_features = PoolFeatures(pools)
+        appliers = {pool: PoolConfigApplier(NGINX_CONF_DIR, pool, servers, min_dwell_seconds=MIN_DWELL_SECONDS,
+                                            confidence_margin=CONFIDENCE_MARGIN, reloader=reloader)
+                    for pool, servers in pools.items()}
+        print(f"Running in pools mode for {len(pools)} pools: {', '.join(pools)}")
+
+        # Start every pool with round-robin
+        for applier in appliers.values():
+            applier.propose(ALGORITHMS[0])
+        cycle = lambda: run_pool_cycle(collector, pool_features, registry.current(), appliers, scheduler=scheduler,
+                                       journal=journal, model_version=registry.versions()['active'])
+    else:
+        fleet = LBFleet(targets=LB_TARGETS or [LB_CONFIG_URL], dns_name=LB_DNS_NAME or None,
+                        backends=LB_BACKEND_LIST, reconcile_seconds=LB_RECONCILE_SECONDS)
+        if META_LB_MODE != 'weights' and CANARY_FRACTION > 0:
+            # Switches are tried on CANARY_FRACTION of the LB traffic before they go fleet-wide
+            applier = CanaryApplier(NGINX_CONF_DIR, fleet, {name: label for label, name in ALGORITHMS.items()},
+                                    min_dwell_seconds=MIN_DWELL_SECONDS, confidence_margin=CONFIDENCE_MARGIN,
+                                    reloader=reloader)
+        else:
+            applier = ConfigApplier(NGINX_CONF_DIR, fleet, min_dwell_seconds=MIN_DWELL_SECONDS,
+                                    confidence_margin=CONFIDENCE_MARGIN, reloader=reloader)
+
+        if META_LB_MODE == 'weights':
+            collector = MetricsCollector(PROMETHEUS_URL, BACKEND_QUERIES, group_label=BACKEND_LABEL)
+            scorer = WeightScorer(LB_BACKEND_LIST)
+            print(f"Running in weights mode for backends: {', '.join(LB_BACKEND_LIST)}")
+
+            # Start with an even split
+            applier.propose_weights(dict(zip(scorer.backends, scorer.weights.tolist())))
+            cycle = lambda: run_weight_cycle(collector, scorer, applier, scheduler)
+        else:
+            collector = MetricsCollector(PROMETHEUS_URL)
+            engine = FeatureEngine()
+
+            # Set initial algorithm
+            update_nginx_config(applier, ALGORITHMS[0])  # Start with round-robin
+            cycle = lambda: run_cycle(collector, engine, registry.current(), applier, scheduler=scheduler,
+                                      journal=journal, model_version=registry.versions()['active'])
+
+    # docker stop sends SIGTERM: finish the current cycle, then exit normally so buffered
+    # canary rows (see canary.py) and the journal are written out
+    stopping = threading.Event()
+    def on_sigterm(signum, frame):
+        stopping.set()
+        scheduler.trigger('shutdown')
+    signal.signal(signal.SIGTERM, on_sigterm)
+
     # Main loop
-    while True:
+    while not stopping.is_set():
         try:
-            # Get metrics
-            metrics = get_metrics()
-            
-            # Predict the best algorithm
-            algorithm_id = model.predict(metrics)[0]
-            
-            # Update Nginx config
-            update_nginx_config(algorithm_id)
-            
-            # Wait for 5 seconds
-            time.sleep(5)
+            cycle()
         except Exception as e:
             print(f"Error in main loop: {e}")
-            time.sleep(5)
+
+        # Wait for the scheduler's interval or an early trigger from the webhook
+        source = scheduler.wait()
+        if source is not None and not stopping.is_set():
+            print(f"Decision cycle triggered by {source}")
+
+    print("Received SIGTERM, shutting down")
+    if journal is not None:
+        journal.close()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
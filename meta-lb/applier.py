@@ -0,0 +1,173 @@
+import os
+import tempfile
+import time
+from string import Template
+
+from instrumentation import BACKEND_WEIGHT, CONFIG_WRITE_SECONDS, SKIPPED_APPLIES
+from reloader import NginxConfigError
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), 'templates')
+
+# Directive rendered into the upstream block for each algorithm
+ALGORITHM_DIRECTIVES = {
+    "round-robin": "# round-robin is the nginx default, no directive needed",
+    "least_conn": "least_conn;",
+    "ip_hash": "ip_hash;",
+    # least_conn honours server weights: fewest active connections per unit of weight
+    "weighted": "least_conn;",
+}
+
+NGINX_SERVERS = ["svc1:80", "svc2:80", "svc3:80"]
+
+MIN_DWELL_SECONDS = 30.0
+CONFIDENCE_MARGIN = 0.1
+
+
+def load_template(name):
+    with open(os.path.join(TEMPLATE_DIR, name)) as f:
+        return Template(f.read())
+
+
+# Write a file atomically: readers see either the old or the new content, never a partial write
+def atomic_write(path, content):
+    directory = os.path.dirname(path) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path) + '.')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def read_file(path):
+    try:
+        with open(path) as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+# Applies the predicted algorithm to nginx and the LB fleet only when it actually changes.
+# Switching away from the applied algorithm additionally requires that it has been
+# in place for min_dwell_seconds and that the candidate beats it by confidence_margin.
+# With fleet=None only the nginx config is written. A reloader (reloader.NginxReloader)
+# reloads nginx whenever the files change.
+class ConfigApplier:
+    def __init__(self, conf_dir, fleet, min_dwell_seconds=MIN_DWELL_SECONDS,
+                 confidence_margin=CONFIDENCE_MARGIN, clock=time.monotonic, reloader=None):
+        self.conf_dir = conf_dir
+        self.fleet = fleet
+        self.reloader = reloader
+        self.min_dwell_seconds = min_dwell_seconds
+        self.confidence_margin = confidence_margin
+        self.clock = clock
+
+        self.default_template = load_template('default.conf')
+        self.algo_template = load_template('algo.conf')
+
+        # Applied state; None until the first successful apply
+        self.applied_algorithm = None
+        self.applied_weights = None
+        self.switched_at = None
+
+    def render(self, algorithm, weights=None):
+        if weights is None:
+            servers = "\n".join(f"server {server};" for server in NGINX_SERVERS)
+        else:
+            servers = "\n".join(f"server {server} weight={weight};" for server, weight in weights.items())
+        return {
+            'default.conf': self.default_template.substitute(
+                algorithm=algorithm, algorithm_directive=ALGORITHM_DIRECTIVES[algorithm]),
+            'algo.conf': self.algo_template.substitute(algorithm=algorithm, servers=servers),
+        }
+
+    # Decide whether a prediction should replace the applied algorithm.
+    # `scores` maps algorithm name to its predict_proba confidence.
+    def should_switch(self, algorithm, scores=None):
+        if self.applied_algorithm is None:
+            return True
+        if algorithm == self.applied_algorithm:
+            return False
+        if self.clock() - self.switched_at < self.min_dwell_seconds:
+            return False
+        if scores is not None:
+            margin = scores.get(algorithm, 0.0) - scores.get(self.applied_algorithm, 0.0)
+            if margin < self.confidence_margin:
+                return False
+        return True
+
+    # Feed a prediction through the hysteresis filter; returns the algorithm now in effect.
+    # `features` is the model input behind the prediction, used by the canary subclass.
+    def propose(self, algorithm, scores=None, features=None):
+        if self.should_switch(algorithm, scores):
+            self.apply(algorithm)
+        else:
+            self.maintain()
+        return self.applied_algorithm
+
+    # Weights mode: weights arrive already smoothed and rate-limited by the WeightScorer
+    def propose_weights(self, weights):
+        if weights != self.applied_weights:
+            self.apply_weights(weights)
+        else:
+            self.maintain()
+        return self.applied_weights
+
+    # Nothing new to apply: keep the LB fleet converged on the desired state
+    def maintain(self):
+        if self.fleet is None:
+            SKIPPED_APPLIES.inc()
+        elif not self.fleet.in_sync():
+            # Retry the LB targets a push failed on in an earlier cycle
+            self.fleet.repush()
+        elif self.fleet.reconcile_due():
+            self.fleet.reconcile()
+        else:
+            SKIPPED_APPLIES.inc()
+
+    def write_config(self, algorithm, weights=None):
+        # Only touch files whose rendered content differs from what is on disk
+        previous = {}
+        with CONFIG_WRITE_SECONDS.time():
+            for name, content in self.render(algorithm, weights).items():
+                path = os.path.join(self.conf_dir, name)
+                old = read_file(path)
+                if old != content:
+                    atomic_write(path, content)
+                    previous[path] = old
+        if not previous or self.reloader is None:
+            return
+        try:
+            self.reloader.reload()
+        except NginxConfigError:
+            # Put the config nginx is still running back, so a later reload cannot pick up the bad one
+            for path, old in previous.items():
+                if old is None:
+                    os.unlink(path)
+                else:
+                    atomic_write(path, old)
+            raise
+
+    def apply(self, algorithm):
+        self.write_config(algorithm)
+
+        if algorithm != self.applied_algorithm:
+            self.applied_algorithm = algorithm
+            self.switched_at = self.clock()
+
+        if self.fleet is not None and self.fleet.desired_algorithm != algorithm:
+            self.fleet.publish(algorithm)
+
+    def apply_weights(self, weights):
+        self.write_config('weighted', weights)
+        self.applied_algorithm = 'weighted'
+        self.applied_weights = weights
+        for backend, weight in weights.items():
+            BACKEND_WEIGHT.labels(backend=backend).set(weight)
+        if self.fleet is not None:
+            self.fleet.publish('weighted', weights)
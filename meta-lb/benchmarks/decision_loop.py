@@ -0,0 +1,310 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+META_LB_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, META_LB_DIR)
+import app
+from applier import ConfigApplier
+from collector import MetricsCollector
+from fleet import LBFleet
+from features import LATENCY_BUCKET_NAMES, LATENCY_BUCKETS, RAW_QUERIES, SAMPLE_INTERVAL_SECONDS, FeatureEngine
+from scheduler import AdaptiveScheduler
+
+# Offline replay of the real fetch -> predict -> apply cycle. A metric trace is served by
+# a stand-in Prometheus, configs are pushed to a stand-in LB, and the cycle runs back to
+# back as fast as it can while the trace clock advances one sample per cycle.
+#
+#   python benchmarks/decision_loop.py --output bench.json
+#   python benchmarks/decision_loop.py --trace dataset-runs/spike__ip_hash.json --baseline bench.json
+#   python benchmarks/decision_loop.py --scheduler both --trace-interval 1
+#
+# With the adaptive scheduler the trace clock advances by the scheduler's interval
+# instead of one sample, so the trace should be finer than its minimum interval.
+
+SYNTHETIC_STEPS = 2000
+# A switch that is undone within this much trace time counts as a flap
+FLAP_WINDOW_SECONDS = 60.0
+# --baseline fails the run if a stage's p99 grows by more than this factor
+REGRESSION_FACTOR = 1.25
+
+QUERY_SIGNALS = {query: name for name, query, _ in RAW_QUERIES}
+
+
+# Requests per latency bucket (le-cumulative, one row per step) when `requests` requests
+# per step take an exponentially distributed time with mean `latency`
+def latency_bucket_counts(latency, requests):
+    latency, requests = np.atleast_1d(latency), np.atleast_1d(requests)
+    fractions = 1.0 - np.exp(-np.asarray(LATENCY_BUCKETS)[None, :] / latency[:, None])
+    fractions = np.hstack([fractions, np.ones((len(latency), 1))])
+    return requests[:, None] * fractions
+
+
+# Synthetic trace: diurnal-style load with noise and a few spikes, seeded for comparability.
+# `steps` counts SAMPLE_INTERVAL_SECONDS samples; `interval` sets the trace resolution.
+def synthetic_trace(steps=SYNTHETIC_STEPS, seed=0, interval=SAMPLE_INTERVAL_SECONDS):
+    rng = np.random.default_rng(seed)
+    k = int(round(SAMPLE_INTERVAL_SECONDS / interval))
+    steps *= k
+    t = np.arange(steps)
+    load = 0.5 + 0.35 * np.sin(2 * np.pi * t / (720 * k)) + rng.normal(0, 0.05, steps)
+    for start in rng.integers(0, steps - 30 * k, size=steps // (250 * k)):
+        load[start:start + rng.integers(5 * k, 30 * k)] += rng.uniform(0.3, 0.8)
+    load = np.clip(load, 0.0, 1.5)
+    latency = 0.02 + 0.4 * load ** 3 + np.abs(rng.normal(0, 0.01, steps))
+    throughput = (80 * load + rng.normal(0, 2, steps)).clip(0)
+    # Bucket counters accumulate every step's requests, as the exporter's do
+    buckets = np.cumsum(latency_bucket_counts(latency, throughput * interval), axis=0)
+    return {
+        'timestamps': (t * interval).tolist(),
+        'series': {
+            'cpu': (100 * np.clip(0.1 + 0.6 * load + rng.normal(0, 0.03, steps), 0, 1)).tolist(),
+            'mem': (100 * np.clip(0.4 + 0.2 * load + rng.normal(0, 0.01, steps), 0, 1)).tolist(),
+            'latency': latency.tolist(),
+            'throughput': throughput.tolist(),
+            'connections': (60 * load + rng.normal(0, 2, steps)).clip(0).tolist(),
+            **{name: buckets[:, i].tolist() for i, name in enumerate(LATENCY_BUCKET_NAMES)},
+        },
+    }
+
+
+# Recorded traces use the checkpoint format written by generate_dataset.py
+def load_trace(path):
+    with open(path) as f:
+        trace = json.load(f)
+    return {'timestamps': trace['timestamps'], 'series': trace['series']}
+
+
+class TraceState:
+    def __init__(self, trace):
+        self.trace = trace
+        self.index = 0
+        self.pushes = []
+        self.lb_config = {}
+
+
+def make_prometheus_handler(state):
+    class PrometheusHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            query = parse_qs(urlparse(self.path).query).get('query', [''])[0]
+            name = QUERY_SIGNALS.get(query)
+            result = []
+            if name in state.trace['series']:
+                value = state.trace['series'][name][state.index]
+                if value is not None and not np.isnan(value):
+                    result = [{'metric': {}, 'value': [state.trace['timestamps'][state.index], str(value)]}]
+            body = json.dumps({'status': 'success', 'data': {'resultType': 'vector', 'result': result}}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return PrometheusHandler
+
+
+def make_lb_handler(state):
+    class LBHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            state.pushes.append((state.index, payload['algorithm']))
+            state.lb_config = payload
+            body = b'Configuration updated'
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            body = json.dumps(state.lb_config).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return LBHandler
+
+
+# A cycle connects once per raw query at the same time, more than the default backlog of 5
+class StandInServer(ThreadingHTTPServer):
+    request_queue_size = 64
+
+
+def serve(handler):
+    server = StandInServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def percentiles(values):
+    values = np.asarray(values) * 1000
+    return {'p50_ms': float(np.percentile(values, 50)), 'p99_ms': float(np.percentile(values, 99))}
+
+
+def count_flaps(switches):
+    # switches: list of (trace time, from algorithm, to algorithm)
+    flaps = 0
+    for (at, old, new), (next_at, next_old, next_new) in zip(switches, switches[1:]):
+        if next_old == new and next_new == old and next_at - at <= FLAP_WINDOW_SECONDS:
+            flaps += 1
+    return flaps
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=META_LB_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(trace, model_dir, min_dwell_seconds, confidence_margin, scheduler=None):
+    state = TraceState(trace)
+    prometheus = serve(make_prometheus_handler(state))
+    lb = serve(make_lb_handler(state))
+    timestamps = trace['timestamps']
+
+    model = app.load_model(model_dir)
+    collector = MetricsCollector(f'http://127.0.0.1:{prometheus.server_port}')
+    engine = FeatureEngine()
+    with tempfile.TemporaryDirectory() as conf_dir:
+        # The applier's dwell time and the fleet's reconcile interval run on trace time, not wall time
+        now = [timestamps[0]]
+        clock = lambda: now[0]
+        fleet = LBFleet([f'http://127.0.0.1:{lb.server_port}/config'], clock=clock)
+        applier = ConfigApplier(conf_dir, fleet, min_dwell_seconds=min_dwell_seconds,
+                                confidence_margin=confidence_margin, clock=clock)
+
+        stage_timings = {'fetch': [], 'predict': [], 'apply': [], 'cycle': []}
+        switches = []
+        previous = None
+        cycles = 0
+        started = time.perf_counter()
+        while now[0] <= timestamps[-1]:
+            state.index = int(np.searchsorted(timestamps, now[0], side='right')) - 1
+            applied, timings = app.run_cycle(collector, engine, model, applier, now[0], scheduler)
+            cycles += 1
+            for stage, seconds in timings.items():
+                stage_timings[stage].append(seconds)
+            stage_timings['cycle'].append(sum(timings.values()))
+            if previous is not None and applied != previous:
+                switches.append((now[0], previous, applied))
+            previous = applied
+            now[0] += SAMPLE_INTERVAL_SECONDS if scheduler is None else scheduler.interval
+        elapsed = time.perf_counter() - started
+
+    collector.close()
+    fleet.close()
+    prometheus.shutdown()
+    lb.shutdown()
+
+    trace_hours = (timestamps[-1] - timestamps[0] + SAMPLE_INTERVAL_SECONDS) / 3600
+    flaps = count_flaps(switches)
+    return {
+        'revision': git_revision(),
+        'scheduler': 'fixed' if scheduler is None else 'adaptive',
+        'cycles': cycles,
+        'prometheus_queries_per_trace_hour': cycles * len(RAW_QUERIES) / trace_hours,
+        'decisions_per_second': cycles / elapsed,
+        'stages': {stage: percentiles(values) for stage, values in stage_timings.items()},
+        'config_pushes': len(state.pushes),
+        'switches': len(switches),
+        'switches_per_trace_hour': len(switches) / trace_hours,
+        'flaps': flaps,
+        'flap_rate': flaps / len(switches) if switches else 0.0,
+        'switch_log': switches,
+    }
+
+
+# How much earlier the adaptive run made each switch the fixed run made; a switch is
+# matched to the nearest adaptive switch to the same algorithm within FLAP_WINDOW_SECONDS
+def compare_schedulers(fixed, adaptive):
+    leads = []
+    for at, _, new in fixed['switch_log']:
+        candidates = [other_at for other_at, _, other_new in adaptive['switch_log']
+                      if other_new == new and abs(other_at - at) <= FLAP_WINDOW_SECONDS]
+        if candidates:
+            leads.append(at - min(candidates, key=lambda other_at: abs(other_at - at)))
+    print("\nAdaptive vs fixed scheduling:")
+    print(f"  Prometheus queries/trace hour: {fixed['prometheus_queries_per_trace_hour']:.0f} -> "
+          f"{adaptive['prometheus_queries_per_trace_hour']:.0f}")
+    print(f"  switches: {fixed['switches']} -> {adaptive['switches']} ({len(leads)} matched)")
+    if leads:
+        print(f"  switch lead over fixed: mean {np.mean(leads):.1f} s, median {np.median(leads):.1f} s")
+    return {'matched_switches': len(leads), 'mean_lead_seconds': float(np.mean(leads)) if leads else None}
+
+
+# Print stage-by-stage changes against an earlier result; returns False on a p99 regression
+def compare(results, baseline, regression_factor=REGRESSION_FACTOR):
+    ok = True
+    print(f"\nCompared with {baseline.get('revision') or 'baseline'}:")
+    print(f"  decisions/sec: {baseline['decisions_per_second']:.1f} -> {results['decisions_per_second']:.1f}")
+    for stage, current in results['stages'].items():
+        previous = baseline['stages'].get(stage)
+        if previous is None:
+            continue
+        ratio = current['p99_ms'] / previous['p99_ms'] if previous['p99_ms'] else 1.0
+        flag = ' REGRESSION' if ratio > regression_factor else ''
+        ok = ok and not flag
+        print(f"  {stage:8s} p99: {previous['p99_ms']:.3f} ms -> {current['p99_ms']:.3f} ms ({ratio:.2f}x){flag}")
+    print(f"  config pushes: {baseline['config_pushes']} -> {results['config_pushes']}")
+    print(f"  flap rate: {baseline['flap_rate']:.3f} -> {results['flap_rate']:.3f}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a metric trace through the meta-lb decision loop")
+    parser.add_argument('--trace', help="recorded trace (dataset-runs/*.json); a synthetic trace is used by default")
+    parser.add_argument('--steps', type=int, default=SYNTHETIC_STEPS,
+                        help="length of the synthetic trace, in SAMPLE_INTERVAL_SECONDS samples")
+    parser.add_argument('--trace-interval', type=float, default=SAMPLE_INTERVAL_SECONDS,
+                        help="resolution of the synthetic trace in seconds")
+    parser.add_argument('--scheduler', choices=['fixed', 'adaptive', 'both'], default='fixed',
+                        help="decision cadence; 'both' runs each and compares them")
+    parser.add_argument('--model-dir', default=app.MODEL_DIR)
+    parser.add_argument('--min-dwell-seconds', type=float, default=app.MIN_DWELL_SECONDS)
+    parser.add_argument('--confidence-margin', type=float, default=app.CONFIDENCE_MARGIN)
+    parser.add_argument('--output', help="write the results as JSON")
+    parser.add_argument('--baseline', help="results JSON from an earlier commit to compare against")
+    parser.add_argument('--regression-factor', type=float, default=REGRESSION_FACTOR,
+                        help="p99 growth over the baseline that fails the run")
+    args = parser.parse_args()
+
+    trace = load_trace(args.trace) if args.trace else synthetic_trace(args.steps, interval=args.trace_interval)
+    if args.scheduler == 'both':
+        fixed = run(trace, args.model_dir, args.min_dwell_seconds, args.confidence_margin)
+        results = run(trace, args.model_dir, args.min_dwell_seconds, args.confidence_margin, AdaptiveScheduler())
+        results['versus_fixed'] = compare_schedulers(fixed, results)
+    else:
+        scheduler = AdaptiveScheduler() if args.scheduler == 'adaptive' else None
+        results = run(trace, args.model_dir, args.min_dwell_seconds, args.confidence_margin, scheduler)
+    print(json.dumps({key: value for key, value in results.items() if key != 'switch_log'}, indent=2))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            if not compare(results, json.load(f), args.regression_factor):
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+META_LB_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, META_LB_DIR)
+from forest import CompiledForest
+
+MODEL_DIR = os.path.join(META_LB_DIR, 'models')
+PICKLE_PATH = os.path.join(MODEL_DIR, 'lb_model.pkl')
+FOREST_PATH = os.path.join(MODEL_DIR, 'lb_forest')
+
+STARTUP_RUNS = 5
+PREDICT_RUNS = 2000
+AGREEMENT_ROWS = 100000
+
+RSS_SUFFIX = "import resource; print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)\n"
+
+# Each snippet is run in a fresh interpreter: import, load, predict once, report peak RSS
+def startup_snippets(pickle_path, forest_path):
+    return {
+        'joblib': (
+            "import joblib, numpy as np\n"
+            f"m = joblib.load({pickle_path!r})\n"
+            "m.predict_proba(np.zeros((1, m.n_features_in_)))\n"
+        ),
+        'compiled': (
+            f"import sys; sys.path.insert(0, {META_LB_DIR!r})\n"
+            "import numpy as np\n"
+            "from forest import CompiledForest\n"
+            f"m = CompiledForest.load({forest_path!r})\n"
+            "m.predict_proba(np.zeros((1, m.n_features_in_)))\n"
+        ),
+    }
+
+
+def measure_startup(snippet):
+    timings, rss = [], []
+    for _ in range(STARTUP_RUNS):
+        started = time.perf_counter()
+        output = subprocess.run([sys.executable, '-W', 'ignore', '-c', snippet + RSS_SUFFIX],
+                                check=True, capture_output=True, text=True).stdout
+        timings.append(time.perf_counter() - started)
+        rss.append(int(output.split()[-1]))
+    return {'startup_ms': 1000 * float(np.median(timings)), 'peak_rss_mb': max(rss) / 1024}
+
+
+def measure_predict(model, row):
+    model.predict_proba(row)
+    timings = np.empty(PREDICT_RUNS)
+    for i in range(PREDICT_RUNS):
+        started = time.perf_counter()
+        model.predict_proba(row)
+        timings[i] = time.perf_counter() - started
+    return {'predict_p50_us': 1e6 * float(np.percentile(timings, 50)),
+            'predict_p99_us': 1e6 * float(np.percentile(timings, 99))}
+
+
+def main(pickle_path=PICKLE_PATH, forest_path=FOREST_PATH):
+    # Startup is measured before this process imports scikit-learn: children inherit
+    # the parent's peak RSS across fork, which would hide the difference
+    results = {}
+    for name, snippet in startup_snippets(pickle_path, forest_path).items():
+        results[name] = measure_startup(snippet)
+
+    import warnings
+    import joblib
+    warnings.filterwarnings('ignore')
+
+    sk_model = joblib.load(pickle_path)
+    compiled = CompiledForest.load(forest_path)
+
+    # Outputs must match scikit-learn bit for bit, not just approximately
+    rng = np.random.default_rng(0)
+    X = rng.random((AGREEMENT_ROWS, compiled.n_features_in_))
+    identical = bool(np.array_equal(sk_model.predict_proba(X), compiled.predict_proba(X)))
+    results['bit_identical'] = identical
+
+    row = X[:1]
+    for name, model in (('joblib', sk_model), ('compiled', compiled)):
+        results[name].update(measure_predict(model, row))
+
+    print(json.dumps(results, indent=2))
+    if not identical:
+        sys.exit(1)
+
+
+# Usage: python benchmarks/inference.py [lb_model.pkl lb_forest/]
+if __name__ == '__main__':
+    main(*sys.argv[1:3])
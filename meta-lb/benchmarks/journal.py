@@ -0,0 +1,95 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+META_LB_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, META_LB_DIR)
+import app
+from decision_loop import percentiles
+from journal import DecisionJournal, JournalReader, latency_after, rescore, switches, time_in_algorithm
+
+# Cost of the decision journal: what record() costs the decision loop, how fast the writer
+# thread drains it, and how long the query side takes to scan, summarise and re-score
+# millions of journalled decisions.
+#
+#   python benchmarks/journal.py
+#   python benchmarks/journal.py --records 5000000 --output journal.json
+
+RECORDS = 2_000_000
+# Decisions timed one by one on the loop side
+TIMED_RECORDS = 10000
+
+
+# Synthetic decision history: one decision per second, a few switches per hour
+def synthetic_decisions(n, algorithms, seed=0):
+    rng = np.random.default_rng(seed)
+    features = rng.random((n, len(app.FEATURE_NAMES)))
+    applied = np.repeat(rng.integers(0, len(algorithms), n // 600 + 1), 600)[:n]
+    predicted = np.where(rng.random(n) < 0.9, applied, rng.integers(0, len(algorithms), n))
+    scores = rng.dirichlet(np.ones(len(algorithms)), n)
+    latency = 0.02 + 0.05 * applied + rng.exponential(0.01, n)
+    return features, predicted, applied, scores, latency
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write, scan and re-score a large decision journal")
+    parser.add_argument('--records', type=int, default=RECORDS)
+    parser.add_argument('--model-dir', default=app.MODEL_DIR)
+    parser.add_argument('--output', help="write the results as JSON")
+    args = parser.parse_args()
+
+    algorithms = [app.ALGORITHMS[label] for label in sorted(app.ALGORITHMS)]
+    features, predicted, applied, scores, latency = synthetic_decisions(args.records, algorithms)
+    score_dicts = [dict(zip(algorithms, row)) for row in scores.tolist()]
+    results = {'records': args.records}
+
+    with tempfile.TemporaryDirectory() as path:
+        # Large queue so the write-throughput phase measures the writer, not drops
+        journal = DecisionJournal(path, algorithms, queue_size=args.records + 1).start()
+        timings = []
+        started = time.perf_counter()
+        for i in range(args.records):
+            if i < TIMED_RECORDS:
+                before = time.perf_counter()
+            journal.record(features[i], score_dicts[i], algorithms[predicted[i]], algorithms[applied[i]],
+                           latency[i], timestamp=float(i))
+            if i < TIMED_RECORDS:
+                timings.append(time.perf_counter() - before)
+        journal.close()
+        elapsed = time.perf_counter() - started
+        results['record'] = percentiles(timings)
+        results['write_records_per_second'] = args.records / elapsed
+        results['bytes_per_record'] = journal.dtype.itemsize
+        print(f"record(): p50 {results['record']['p50_ms'] * 1000:.1f} us, p99 {results['record']['p99_ms'] * 1000:.1f} us "
+              f"on the loop; {args.records / elapsed:,.0f} records/s written, {journal.dtype.itemsize} bytes each")
+
+        started = time.perf_counter()
+        reader = JournalReader(path)
+        records = reader.load(['timestamp', 'applied', 'latency'])
+        seconds = time_in_algorithm(records['timestamp'], records['applied'], len(algorithms))
+        n_switches = int(switches(records['applied']).sum())
+        following = latency_after(records['timestamp'], records['latency'])
+        results['summary_seconds'] = time.perf_counter() - started
+        print(f"summary of {len(records['timestamp']):,} records: {results['summary_seconds']:.2f} s "
+              f"({n_switches} switches, {np.nanmean(following) * 1000:.1f} ms mean latency after, "
+              f"{seconds.sum() / 3600:.0f} h)")
+
+        model = app.load_model(args.model_dir)
+        started = time.perf_counter()
+        new = rescore(model, reader.load(['features'])['features'], algorithms)
+        results['rescore_seconds'] = time.perf_counter() - started
+        print(f"re-score of {len(new):,} records: {results['rescore_seconds']:.2f} s "
+              f"({len(new) / results['rescore_seconds']:,.0f} records/s)")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
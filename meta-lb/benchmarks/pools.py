@@ -0,0 +1,159 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+META_LB_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, META_LB_DIR)
+import app
+from collector import MetricsCollector
+from decision_loop import latency_bucket_counts, percentiles, serve
+from features import LATENCY_BUCKET_NAMES, SAMPLE_INTERVAL_SECONDS, FeatureEngine, raw_queries
+from pools import POOL_LABEL, PoolConfigApplier, PoolFeatures
+
+# Per-cycle cost of pools mode against running one meta-lb per pool, as the number of
+# pools grows. A stand-in Prometheus answers both the grouped `by (upstream)` queries
+# and per-pool `upstream="..."` queries with a different load level per pool.
+#
+#   python benchmarks/pools.py
+#   python benchmarks/pools.py --pools 1,8,32,128 --cycles 100 --output pools.json
+
+POOL_COUNTS = (1, 4, 16, 64)
+CYCLES = 50
+
+
+def pool_name(index):
+    return f"pool{index}"
+
+
+def pool_selector(pool):
+    return f'{POOL_LABEL}="{pool}"'
+
+
+# Raw signal values of one pool; pools differ in load so their predictions differ too
+def pool_sample(index, step):
+    loads = 0.2 + 0.6 * ((index * 7 + np.arange(step + 1)) % 10) / 10
+    load = loads[-1]
+    # Bucket counters hold every request up to this step
+    buckets = latency_bucket_counts(0.02 + 0.4 * loads ** 3, 80 * loads * SAMPLE_INTERVAL_SECONDS).sum(axis=0)
+    return {'cpu': 40.0, 'mem': 50.0, 'latency': 0.02 + 0.4 * load ** 3,
+            'throughput': 80 * load, 'connections': 60 * load,
+            **dict(zip(LATENCY_BUCKET_NAMES, buckets.tolist()))}
+
+
+# `step` is a one-item list the benchmark advances every cycle
+def make_prometheus_handler(n_pools, step):
+    # query -> (signal, pool index); None means every pool, grouped by POOL_LABEL
+    queries = {query: (name, None) for name, query, _ in raw_queries(group_by=POOL_LABEL)}
+    for i in range(n_pools):
+        for name, query, _ in raw_queries(pool_selector(pool_name(i))):
+            queries.setdefault(query, (name, i))
+
+    class PrometheusHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            query = parse_qs(urlparse(self.path).query).get('query', [''])[0]
+            name, index = queries.get(query, (None, None))
+            if name is None:
+                result = []
+            elif name in ('cpu', 'mem'):
+                # Host-level signals are one unlabelled series in either mode
+                result = [{'metric': {}, 'value': [0, str(pool_sample(0, step[0])[name])]}]
+            elif index is not None:
+                result = [{'metric': {}, 'value': [0, str(pool_sample(index, step[0])[name])]}]
+            else:
+                result = [{'metric': {POOL_LABEL: pool_name(i)}, 'value': [0, str(pool_sample(i, step[0])[name])]}
+                          for i in range(n_pools)]
+            body = json.dumps({'status': 'success', 'data': {'resultType': 'vector', 'result': result}}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return PrometheusHandler
+
+
+# Pools mode: one grouped collector, one predict call per cycle
+def run_batched(prometheus_url, model, pools, conf_dir, cycles, step):
+    collector = MetricsCollector(prometheus_url, raw_queries(group_by=POOL_LABEL), group_label=POOL_LABEL)
+    pool_features = PoolFeatures(pools)
+    appliers = {pool: PoolConfigApplier(conf_dir, pool, servers) for pool, servers in pools.items()}
+    timings = []
+    for cycle in range(cycles):
+        step[0] = cycle
+        _, stages = app.run_pool_cycle(collector, pool_features, model, appliers,
+                                       timestamp=cycle * SAMPLE_INTERVAL_SECONDS)
+        timings.append(stages)
+    collector.close()
+    return timings
+
+
+# One meta-lb per pool: a collector and a predict call for every pool, back to back
+def run_per_pool(prometheus_url, model, pools, conf_dir, cycles, step):
+    instances = [(MetricsCollector(prometheus_url, raw_queries(pool_selector(pool))), FeatureEngine(),
+                  PoolConfigApplier(conf_dir, pool, servers)) for pool, servers in pools.items()]
+    timings = []
+    for cycle in range(cycles):
+        step[0] = cycle
+        total = {'fetch': 0.0, 'predict': 0.0, 'apply': 0.0}
+        for collector, engine, applier in instances:
+            _, stages = app.run_cycle(collector, engine, model, applier, timestamp=cycle * SAMPLE_INTERVAL_SECONDS)
+            for stage, seconds in stages.items():
+                total[stage] += seconds
+        timings.append(total)
+    for collector, _, _ in instances:
+        collector.close()
+    return timings
+
+
+def summarise(timings, queries_per_cycle):
+    return {
+        'prometheus_queries_per_cycle': queries_per_cycle,
+        'stages': {stage: percentiles([t[stage] for t in timings]) for stage in ('fetch', 'predict', 'apply')},
+        'cycle': percentiles([sum(t.values()) for t in timings]),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-cycle cost of pools mode as the number of pools grows")
+    parser.add_argument('--pools', default=','.join(str(n) for n in POOL_COUNTS), help="pool counts to measure")
+    parser.add_argument('--cycles', type=int, default=CYCLES)
+    parser.add_argument('--model-dir', default=app.MODEL_DIR)
+    parser.add_argument('--output', help="write the results as JSON")
+    args = parser.parse_args()
+
+    model = app.load_model(args.model_dir)
+    n_queries = len(raw_queries())
+    results = {}
+    for n_pools in (int(n) for n in args.pools.split(',')):
+        pools = {pool_name(i): [f"{pool_name(i)}-{j}:80" for j in range(3)] for i in range(n_pools)}
+        step = [0]
+        prometheus = serve(make_prometheus_handler(n_pools, step))
+        url = f'http://127.0.0.1:{prometheus.server_port}'
+        with tempfile.TemporaryDirectory() as conf_dir:
+            batched = summarise(run_batched(url, model, pools, conf_dir, args.cycles, step), n_queries)
+        with tempfile.TemporaryDirectory() as conf_dir:
+            per_pool = summarise(run_per_pool(url, model, pools, conf_dir, args.cycles, step), n_queries * n_pools)
+        prometheus.shutdown()
+        results[n_pools] = {'batched': batched, 'per_pool': per_pool}
+
+        print(f"{n_pools:4d} pools  batched: {batched['cycle']['p50_ms']:8.2f} ms/cycle "
+              f"(predict {batched['stages']['predict']['p50_ms']:.2f} ms, {n_queries} queries)  "
+              f"per-pool: {per_pool['cycle']['p50_ms']:8.2f} ms/cycle "
+              f"(predict {per_pool['stages']['predict']['p50_ms']:.2f} ms, {n_queries * n_pools} queries)")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
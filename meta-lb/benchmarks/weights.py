@@ -0,0 +1,152 @@
+import argparse
+import collections
+import json
+import os
+import sys
+
+import numpy as np
+
+META_LB_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, META_LB_DIR)
+from features import SAMPLE_INTERVAL_SECONDS
+from weights import WeightScorer, service_name
+
+# Offline comparison of weights mode against the fixed algorithms under skewed backend
+# capacity. Requests arrive as a Poisson process and queue FIFO at the backend they are
+# routed to; one backend is slower than the others. Weights mode runs the real
+# WeightScorer every SAMPLE_INTERVAL_SECONDS on the signals the LB and cadvisor would
+# report for the requests completed in that interval.
+#
+#   python benchmarks/weights.py
+#   python benchmarks/weights.py --capacities 1,1,0.5,0.2 --load 0.8 --output weights.json
+
+CAPACITIES = (1.0, 1.0, 0.35)
+# Requests per second a backend of capacity 1 can serve
+BASE_RATE = 100.0
+LOAD = 0.75
+DURATION_SECONDS = 900.0
+WARMUP_SECONDS = 120.0
+N_CLIENTS = 1000
+
+POLICIES = ['roundrobin', 'leastconn', 'iphash', 'weighted']
+
+
+# Weighted least connections, the same selection lb/index.js uses for 'weighted': fewest
+# in-flight requests per unit of weight, ties broken by smooth weighted round-robin
+def weighted_least_conn(weights, current, inflight):
+    load = np.asarray(inflight, dtype=float) / weights
+    least = load == load.min()
+    current[least] += weights[least]
+    chosen = int(np.argmax(np.where(least, current, -np.inf)))
+    current[chosen] -= weights[least].sum()
+    return chosen
+
+
+def simulate(policy, capacities, load, duration, seed):
+    rng = np.random.default_rng(seed)
+    backends = [f"svc{i + 1}:80" for i in range(len(capacities))]
+    services = [service_name(backend) for backend in backends]
+    rates = BASE_RATE * np.asarray(capacities)
+    arrival_rate = load * rates.sum()
+
+    arrivals = np.cumsum(rng.exponential(1.0 / arrival_rate, int(arrival_rate * duration * 1.2)))
+    arrivals = arrivals[arrivals < duration]
+    work = rng.exponential(1.0, len(arrivals))
+    clients = rng.integers(0, N_CLIENTS, len(arrivals))
+
+    n_backends = len(backends)
+    free_at = np.zeros(n_backends)
+    # (finish time, latency, service time) of requests still in flight, per backend
+    inflight = [collections.deque() for _ in range(n_backends)]
+    busy = np.zeros(n_backends)
+    latency_sum = np.zeros(n_backends)
+    completed = np.zeros(n_backends)
+    latencies = np.empty(len(arrivals))
+
+    scorer = WeightScorer(backends) if policy == 'weighted' else None
+    weights = np.ones(n_backends) if scorer is None else scorer.weights.astype(float)
+    current = np.zeros(n_backends)
+    next_sample = SAMPLE_INTERVAL_SECONDS
+    rr_index = 0
+    weight_history = []
+
+    for i, t in enumerate(arrivals):
+        # Retire completed requests; only these are visible to the signals
+        for b in range(n_backends):
+            queue = inflight[b]
+            while queue and queue[0][0] <= t:
+                _, latency, service = queue.popleft()
+                busy[b] += service
+                latency_sum[b] += latency
+                completed[b] += 1
+
+        if t >= next_sample:
+            if scorer is not None:
+                values = {
+                    'backend_cpu': dict(zip(services, np.minimum(busy / SAMPLE_INTERVAL_SECONDS, 1.0))),
+                    'backend_inflight': {service: len(inflight[b]) for b, service in enumerate(services)},
+                    'backend_latency': {service: latency_sum[b] / completed[b]
+                                        for b, service in enumerate(services) if completed[b]},
+                }
+                weights = np.asarray(list(scorer.update(values).values()), dtype=float)
+                weight_history.append(weights.tolist())
+            busy[:], latency_sum[:], completed[:] = 0.0, 0.0, 0.0
+            next_sample += SAMPLE_INTERVAL_SECONDS
+
+        if policy == 'roundrobin':
+            b = rr_index
+            rr_index = (rr_index + 1) % n_backends
+        elif policy == 'leastconn':
+            b = int(np.argmin([len(queue) for queue in inflight]))
+        elif policy == 'iphash':
+            b = int(clients[i]) % n_backends
+        else:
+            b = weighted_least_conn(weights, current, [len(queue) for queue in inflight])
+
+        service = work[i] / rates[b]
+        finish = max(t, free_at[b]) + service
+        free_at[b] = finish
+        latencies[i] = finish - t
+        inflight[b].append((finish, finish - t, service))
+
+    measured = latencies[arrivals >= WARMUP_SECONDS] * 1000
+    result = {
+        'requests': int(len(measured)),
+        'p50_ms': float(np.percentile(measured, 50)),
+        'p95_ms': float(np.percentile(measured, 95)),
+        'p99_ms': float(np.percentile(measured, 99)),
+    }
+    if weight_history:
+        result['final_weights'] = dict(zip(backends, weight_history[-1]))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare weights mode with the fixed algorithms under skewed load")
+    parser.add_argument('--capacities', default=','.join(str(c) for c in CAPACITIES),
+                        help="relative capacity of each backend")
+    parser.add_argument('--load', type=float, default=LOAD, help="offered load as a fraction of total capacity")
+    parser.add_argument('--duration', type=float, default=DURATION_SECONDS, help="simulated seconds")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="write the results as JSON")
+    args = parser.parse_args()
+
+    capacities = [float(c) for c in args.capacities.split(',')]
+    results = {policy: simulate(policy, capacities, args.load, args.duration, args.seed) for policy in POLICIES}
+
+    for policy, result in results.items():
+        print(f"{policy:10s} p50 {result['p50_ms']:9.1f} ms  p95 {result['p95_ms']:9.1f} ms  "
+              f"p99 {result['p99_ms']:9.1f} ms")
+    best_fixed = min((policy for policy in POLICIES if policy != 'weighted'), key=lambda p: results[p]['p95_ms'])
+    ratio = results['weighted']['p95_ms'] / results[best_fixed]['p95_ms']
+    print(f"weighted p95 is {ratio:.2f}x the best fixed algorithm ({best_fixed})")
+    print(f"final weights: {results['weighted']['final_weights']}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'capacities': capacities, 'load': args.load, 'results': results,
+                       'best_fixed': best_fixed, 'weighted_vs_best_fixed_p95': ratio}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+import atexit
+import math
+import os
+import time
+
+from applier import ConfigApplier
+from datastore import DatasetStore
+from features import FEATURE_NAMES
+from instrumentation import CANARY_ACTIVE, CANARY_RESULTS
+
+# Canary mode: when the hysteresis lets a predicted algorithm replace the applied one, the
+# LB fleet first routes CANARY_FRACTION of requests with the candidate while the rest keeps
+# the incumbent. After CANARY_SECONDS the slices' latencies are compared with Welch's t-test
+# and the candidate is promoted to all traffic only if it is significantly faster; if it is
+# significantly slower, fails more requests, or the result is still inconclusive after
+# CANARY_MAX_SECONDS, it is rejected and the dwell time restarts. Conclusive comparisons
+# are appended to the dataset as labelled rows with scenario 'live'.
+CANARY_FRACTION = float(os.environ.get('CANARY_FRACTION', '0'))
+CANARY_SECONDS = float(os.environ.get('CANARY_SECONDS', '30'))
+CANARY_MAX_SECONDS = float(os.environ.get('CANARY_MAX_SECONDS', '120'))
+# Requests each slice needs before it is compared at all
+CANARY_MIN_REQUESTS = 100
+# One-sided significance level of the latency comparison
+CANARY_ALPHA = 0.05
+# A candidate whose error rate exceeds the incumbent's by this much is rejected outright
+CANARY_MAX_ERROR_INCREASE = 0.01
+LIVE_DATASET_PATH = os.environ.get('LIVE_DATASET_PATH', os.path.join(os.path.dirname(__file__), 'dataset'))
+# Live rows are buffered and written as one chunk once this many are waiting or the oldest
+# has waited this long, so canaries do not leave a tiny chunk each
+LIVE_FLUSH_ROWS = 100
+LIVE_FLUSH_SECONDS = 6 * 3600
+
+
+# Continued fraction for the regularised incomplete beta function (Numerical Recipes' betacf)
+def _betacf(a, b, x):
+    tiny = 1e-300
+    qab, qap, qam = a + b, a + 1.0, a - 1.0
+    c, d = 1.0, 1.0 - qab * x / qap
+    d = 1.0 / (d if abs(d) > tiny else tiny)
+    h = d
+    for m in range(1, 301):
+        m2 = 2 * m
+        aa = m * (b - m) * x / ((qam + m2) * (a + m2))
+        d = 1.0 + aa * d
+        c = 1.0 + aa / c
+        d = 1.0 / (d if abs(d) > tiny else tiny)
+        c = c if abs(c) > tiny else tiny
+        h *= d * c
+        aa = -(a + m) * (qab + m) * x / ((a + m2) * (qap + m2))
+        d = 1.0 + aa * d
+        c = 1.0 + aa / c
+        d = 1.0 / (d if abs(d) > tiny else tiny)
+        c = c if abs(c) > tiny else tiny
+        delta = d * c
+        h *= delta
+        if abs(delta - 1.0) < 1e-12:
+            break
+    return h
+
+
+def betainc(a, b, x):
+    if x <= 0.0:
+        return 0.0
+    if x >= 1.0:
+        return 1.0
+    front = math.exp(math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b) + a * math.log(x) + b * math.log1p(-x))
+    if x < (a + 1.0) / (a + b + 2.0):
+        return front * _betacf(a, b, x) / a
+    return 1.0 - front * _betacf(b, a, 1.0 - x) / b
+
+
+# CDF of Student's t distribution with `df` degrees of freedom
+def t_cdf(t, df):
+    tail = 0.5 * betainc(df / 2.0, 0.5, df / (df + t * t))
+    return 1.0 - tail if t > 0 else tail
+
+
+# Mean and unbiased variance from a slice's {count, sum, sumSquares}
+def slice_moments(stats):
+    n = stats['count']
+    mean = stats['sum'] / n
+    variance = max(stats['sumSquares'] - n * mean * mean, 0.0) / (n - 1)
+    return n, mean, variance
+
+
+# Welch's t-test of the candidate's mean latency against the incumbent's; returns
+# (t, degrees of freedom, p-value that the candidate is faster, p-value that it is slower)
+def welch_test(incumbent, candidate):
+    n1, mean1, var1 = slice_moments(incumbent)
+    n2, mean2, var2 = slice_moments(candidate)
+    se1, se2 = var1 / n1, var2 / n2
+    if se1 + se2 == 0.0:
+        return 0.0, math.inf, 0.5, 0.5
+    t = (mean2 - mean1) / math.sqrt(se1 + se2)
+    df = (se1 + se2) ** 2 / (se1 ** 2 / (n1 - 1) + se2 ** 2 / (n2 - 1))
+    faster = t_cdf(t, df)
+    return t, df, faster, 1.0 - faster
+
+
+# 'better', 'worse', or None while the comparison is inconclusive
+def verdict(incumbent, candidate, alpha=CANARY_ALPHA, max_error_increase=CANARY_MAX_ERROR_INCREASE):
+    error_increase = candidate['errors'] / candidate['count'] - incumbent['errors'] / incumbent['count']
+    if error_increase > max_error_increase:
+        return 'worse'
+    _, _, p_faster, p_slower = welch_test(incumbent, candidate)
+    if p_faster < alpha:
+        return 'better'
+    if p_slower < alpha:
+        return 'worse'
+    return None
+
+
+# ConfigApplier whose switches go through a canary on the LB fleet. nginx is only
+# rewritten on promotion: it cannot split traffic, so it keeps the incumbent meanwhile.
+class CanaryApplier(ConfigApplier):
+    def __init__(self, conf_dir, fleet, labels, fraction=CANARY_FRACTION, min_seconds=CANARY_SECONDS,
+                 max_seconds=CANARY_MAX_SECONDS, min_requests=CANARY_MIN_REQUESTS, alpha=CANARY_ALPHA,
+                 max_error_increase=CANARY_MAX_ERROR_INCREASE, dataset_path=LIVE_DATASET_PATH, **kwargs):
+        super().__init__(conf_dir, fleet, **kwargs)
+        # Algorithm name -> class label, as in the training data
+        self.labels = labels
+        self.fraction = fraction
+        self.min_seconds = min_seconds
+        self.max_seconds = max_seconds
+        self.min_requests = min_requests
+        self.alpha = alpha
+        self.max_error_increase = max_error_increase
+        self.dataset_path = dataset_path
+        # Live dataset, opened on the first row and kept open; rows wait in its buffer
+        self.store = None
+        self.pending_since = None
+        # The running canary: incumbent, candidate, started_at, features, version
+        self.canary = None
+        CANARY_ACTIVE.set(0)
+        # app.py turns SIGTERM into a normal exit, so this also runs on docker stop
+        atexit.register(self.flush_rows)
+
+    def propose(self, algorithm, scores=None, features=None):
+        if self.pending_since is not None and self.clock() - self.pending_since >= LIVE_FLUSH_SECONDS:
+            self.flush_rows()
+        if self.canary is not None:
+            self.evaluate()
+            return self.applied_algorithm
+        if self.applied_algorithm is not None and self.should_switch(algorithm, scores):
+            self.start(algorithm, features)
+            return self.applied_algorithm
+        return super().propose(algorithm, scores, features)
+
+    def start(self, candidate, features):
+        self.fleet.publish(self.applied_algorithm, canary=(candidate, self.fraction))
+        self.canary = {
+            'incumbent': self.applied_algorithm,
+            'candidate': candidate,
+            'started_at': self.clock(),
+            'features': features,
+            'version': self.fleet.desired['version'],
+        }
+        CANARY_ACTIVE.set(1)
+        print(f"Canary: routing {self.fraction:.0%} of traffic with {candidate}, "
+              f"the rest with {self.applied_algorithm}")
+
+    # Decide the running canary once it has run long enough; until then keep the fleet converged
+    def evaluate(self):
+        elapsed = self.clock() - self.canary['started_at']
+        result = None
+        if elapsed >= self.min_seconds:
+            stats = self.fleet.canary_stats()
+            incumbent, candidate = stats.get('incumbent'), stats.get('canary')
+            if (incumbent and candidate and incumbent['count'] >= self.min_requests
+                    and candidate['count'] >= self.min_requests):
+                result = verdict(incumbent, candidate, self.alpha, self.max_error_increase)
+            if result is not None or elapsed >= self.max_seconds:
+                self.finish(result, incumbent, candidate)
+                return
+        self.maintain()
+
+    def finish(self, result, incumbent, candidate):
+        canary, self.canary = self.canary, None
+        CANARY_ACTIVE.set(0)
+        CANARY_RESULTS.labels(result=result or 'inconclusive').inc()
+        summary = ""
+        if incumbent and candidate and incumbent['count'] and candidate['count']:
+            summary = (f" (mean latency {canary['incumbent']} {1000 * incumbent['sum'] / incumbent['count']:.1f} ms"
+                       f" over {incumbent['count']} requests, {canary['candidate']} "
+                       f"{1000 * candidate['sum'] / candidate['count']:.1f} ms over {candidate['count']})")
+
+        if result == 'better':
+            print(f"Canary: promoting {canary['candidate']}{summary}")
+            self.apply(canary['candidate'])
+        else:
+            print(f"Canary: rejecting {canary['candidate']}, {result or 'inconclusive'}{summary}")
+            self.fleet.publish(canary['incumbent'])
+            # Restart the dwell time so the same prediction is not canaried again right away
+            self.switched_at = self.clock()
+
+        if result is not None and canary['features'] is not None:
+            winner = canary['candidate'] if result == 'better' else canary['incumbent']
+            self.log_row(canary, winner)
+
+    # Append the live comparison as a training row: the features the prediction was made
+    # from, labelled with the algorithm that won
+    def log_row(self, canary, winner):
+        try:
+            if self.store is None:
+                self.store = DatasetStore(self.dataset_path)
+            self.store.append({
+                **{name: [float(value)] for name, value in zip(FEATURE_NAMES, canary['features'])},
+                'label': [self.labels[winner]],
+                'scenario': ['live'],
+                'algorithm': [winner],
+                'run_id': [f"canary@{canary['version']}"],
+                'timestamp': [time.time()],
+            })
+        except (OSError, ValueError) as e:
+            print(f"Failed to log canary result to {self.dataset_path}: {e}")
+            return
+        if self.pending_since is None:
+            self.pending_since = self.clock()
+        if self.store.pending_rows >= LIVE_FLUSH_ROWS:
+            self.flush_rows()
+
+    def flush_rows(self):
+        if self.store is None or not self.store.pending_rows:
+            return
+        rows = self.store.pending_rows
+        try:
+            self.store.flush()
+        except OSError as e:
+            # The rows stay buffered and are retried on the next flush
+            print(f"Failed to write {rows} canary results to {self.dataset_path}: {e}")
+            return
+        self.pending_since = None
+        print(f"Wrote {rows} canary results to {self.dataset_path}")
@@ -0,0 +1,83 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from features import RAW_QUERIES
+from instrumentation import FALLBACKS, FETCH_QUERY_SECONDS, FETCH_SECONDS
+
+QUERY_TIMEOUT_SECONDS = 1.0
+CYCLE_DEADLINE_SECONDS = 2.0
+
+
+# Fetches every raw signal query concurrently over one pooled keep-alive session.
+# The whole fetch is bounded by the cycle deadline; any query that errors or
+# misses the deadline falls back to the last value that was fetched successfully.
+# With `group_label`, each query returns one series per value of that label and
+# the collector yields {label value: value} per signal instead of a single value.
+class MetricsCollector:
+    def __init__(self, prometheus_url, queries=RAW_QUERIES,
+                 query_timeout=QUERY_TIMEOUT_SECONDS, cycle_deadline=CYCLE_DEADLINE_SECONDS, group_label=None):
+        self.query_url = prometheus_url.rstrip('/') + '/api/v1/query'
+        self.queries = list(queries)
+        self.group_label = group_label
+        self.query_timeout = query_timeout
+        self.cycle_deadline = cycle_deadline
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=len(self.queries))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=len(self.queries), thread_name_prefix='collector')
+
+        # Last known good raw value per signal, seeded with the defaults; grouped
+        # signals start empty and the caller fills in defaults for missing groups
+        self.last_good = {name: default if group_label is None else {} for name, _, default in self.queries}
+
+    def _query(self, name, query):
+        with FETCH_QUERY_SECONDS.labels(feature=name).time():
+            response = self.session.get(self.query_url, params={
+                'query': query,
+                # Let Prometheus abandon the evaluation too, not just the client
+                'timeout': f'{self.query_timeout}s',
+            }, timeout=self.query_timeout)
+            response.raise_for_status()
+            result = response.json()['data']['result']
+        if not result:
+            return None
+        if self.group_label is not None:
+            return {series['metric'].get(self.group_label, ''): float(series['value'][1]) for series in result}
+        return float(result[0]['value'][1])
+
+    # Returns the raw value of every signal, keyed by name
+    def collect(self):
+        started = time.monotonic()
+        futures = {self.executor.submit(self._query, name, query): name for name, query, _ in self.queries}
+        done, not_done = wait(futures, timeout=self.cycle_deadline)
+
+        values = {}
+        for future, name in futures.items():
+            if future in not_done:
+                future.cancel()
+                FALLBACKS.labels(feature=name, reason='deadline').inc()
+                print(f"Metric '{name}' missed the {self.cycle_deadline}s deadline, using last known value")
+            elif future.exception() is not None:
+                FALLBACKS.labels(feature=name, reason='error').inc()
+                print(f"Error getting metric '{name}': {future.exception()}")
+            elif future.result() is None:
+                FALLBACKS.labels(feature=name, reason='empty').inc()
+            elif self.group_label is not None:
+                # A group missing from this result keeps its last known value
+                self.last_good[name] = {**self.last_good[name], **future.result()}
+            else:
+                self.last_good[name] = future.result()
+            values[name] = self.last_good[name]
+
+        self.last_fetch_seconds = time.monotonic() - started
+        FETCH_SECONDS.observe(self.last_fetch_seconds)
+        return values
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.session.close()
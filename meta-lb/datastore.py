@@ -0,0 +1,152 @@
+import csv
+import errno
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+
+from features import FEATURE_NAMES
+
+# Append-only columnar dataset: a directory holding schema.json plus one sub-directory
+# per chunk, with a typed .npy file per column. Chunks are written to a temp directory
+# and renamed into place, so readers only ever see complete chunks, and every column
+# file can be memory-mapped without copying.
+DATASET_COLUMNS = {
+    **{name: '<f8' for name in FEATURE_NAMES},
+    'label': '<i8',
+    'scenario': 'S32',
+    'algorithm': 'S16',
+    'run_id': 'S64',
+    'timestamp': '<f8',
+}
+
+CHUNK_ROWS = 65536
+
+
+class DatasetStore:
+    def __init__(self, path, columns=DATASET_COLUMNS):
+        self.path = path
+        schema_path = os.path.join(path, 'schema.json')
+        if os.path.exists(schema_path):
+            with open(schema_path) as f:
+                self.columns = json.load(f)['columns']
+        else:
+            os.makedirs(path, exist_ok=True)
+            self.columns = dict(columns)
+            with open(schema_path, 'w') as f:
+                json.dump({'columns': self.columns}, f, indent=2)
+        self.dtypes = {name: np.dtype(dtype) for name, dtype in self.columns.items()}
+        self.pending = {name: [] for name in self.columns}
+        self.pending_rows = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+
+    def __len__(self):
+        return sum(self.chunk_rows(chunk) for chunk in self.chunks())
+
+    # Buffer rows given as {column: values}; full chunks are written as they fill up
+    def append(self, rows):
+        missing = set(self.columns) - set(rows)
+        if missing:
+            raise ValueError(f"Missing columns: {', '.join(sorted(missing))}")
+        lengths = {len(values) for values in rows.values()}
+        if len(lengths) != 1:
+            raise ValueError("All columns must have the same number of rows")
+
+        for name in self.columns:
+            self.pending[name].append(np.asarray(rows[name], dtype=self.dtypes[name]))
+        self.pending_rows += lengths.pop()
+        if self.pending_rows >= CHUNK_ROWS:
+            self.flush()
+
+    def flush(self):
+        if not self.pending_rows:
+            return
+        index = len(self.chunks())
+        tmp_dir = tempfile.mkdtemp(dir=self.path, prefix='.chunk-')
+        try:
+            for name, parts in self.pending.items():
+                np.save(os.path.join(tmp_dir, name + '.npy'), np.concatenate(parts))
+            # Another writer (e.g. meta-lb's live rows next to generate_dataset.py) may
+            # have taken this index meanwhile; take the next free one
+            while True:
+                try:
+                    os.rename(tmp_dir, os.path.join(self.path, f'chunk-{index:06d}'))
+                    break
+                except OSError as e:
+                    if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                        raise
+                    index += 1
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        self.pending = {name: [] for name in self.columns}
+        self.pending_rows = 0
+
+    def chunks(self):
+        return sorted(name for name in os.listdir(self.path) if name.startswith('chunk-'))
+
+    def chunk_rows(self, chunk):
+        first = next(iter(self.columns))
+        return len(np.load(os.path.join(self.path, chunk, first + '.npy'), mmap_mode='r'))
+
+    # Memory-mapped, zero-copy view of one chunk's columns
+    def read_chunk(self, chunk, columns=None):
+        return {name: np.load(os.path.join(self.path, chunk, name + '.npy'), mmap_mode='r')
+                for name in (columns or self.columns)}
+
+    # Load columns into memory, copying only the selected rows.
+    # `where` maps a column to a value or list of accepted values; `sample` keeps
+    # that random fraction of the matching rows.
+    def load(self, columns=None, where=None, sample=None, seed=0):
+        columns = list(columns or self.columns)
+        where = {name: np.asarray(accepted if isinstance(accepted, (list, tuple)) else [accepted],
+                                  dtype=self.dtypes[name])
+                 for name, accepted in (where or {}).items()}
+        rng = np.random.default_rng(seed)
+
+        parts = {name: [] for name in columns}
+        for chunk in self.chunks():
+            data = self.read_chunk(chunk, set(columns) | set(where))
+            mask = np.ones(self.chunk_rows(chunk), dtype=bool)
+            for name, accepted in where.items():
+                mask &= np.isin(data[name], accepted)
+            if sample is not None:
+                mask &= rng.random(len(mask)) < sample
+            for name in columns:
+                parts[name].append(data[name][mask])
+
+        return {name: np.concatenate(values) if values else np.empty(0, dtype=self.dtypes[name])
+                for name, values in parts.items()}
+
+
+# One-shot conversion of the legacy dataset.csv; rows get placeholder metadata
+def convert_csv(csv_path, store_path):
+    with open(csv_path, newline='') as f:
+        rows = list(csv.DictReader(f))
+    with DatasetStore(store_path) as store:
+        if rows:
+            store.append({
+                **{name: [float(row[name]) for row in rows] for name in FEATURE_NAMES},
+                'label': [int(row['label']) for row in rows],
+                'scenario': ['unknown'] * len(rows),
+                'algorithm': ['unknown'] * len(rows),
+                'run_id': [os.path.basename(csv_path)] * len(rows),
+                'timestamp': [np.nan] * len(rows),
+            })
+    print(f"Converted {len(rows)} rows from {csv_path} to {store_path}")
+
+
+# Usage: python meta-lb/datastore.py convert dataset.csv dataset
+if __name__ == '__main__':
+    if len(sys.argv) != 4 or sys.argv[1] != 'convert':
+        print("Usage: python datastore.py convert <dataset.csv> <store dir>")
+        sys.exit(1)
+    convert_csv(sys.argv[2], sys.argv[3])
@@ -0,0 +1,308 @@
+import json
+import math
+import re
+import time
+
+import numpy as np
+
+# Shared feature schema for training (generate_dataset.py / train_model.py) and
+# serving (app.py). Bump SCHEMA_VERSION whenever a query, aggregate or scale changes
+# so that a model is never served features it was not trained on.
+SCHEMA_VERSION = 2
+
+# Raw signals sampled from Prometheus as cheap instant queries: (name, PromQL, default)
+RAW_QUERIES = [
+    ('cpu', '100 - (avg(irate(node_cpu_seconds_total{mode="idle"}[1m])) * 100)', 50.0),
+    ('mem', '(sum(node_memory_MemTotal_bytes) - sum(node_memory_MemAvailable_bytes)) / sum(node_memory_MemTotal_bytes) * 100', 50.0),
+    ('latency', 'sum(rate(nginx_http_request_duration_seconds_sum[1m])) / sum(rate(nginx_http_request_duration_seconds_count[1m]))', 0.1),
+    ('throughput', 'sum(rate(nginx_http_requests_total[1m]))', 10.0),
+    ('connections', 'sum(nginx_http_connections_active)', 0.0),
+]
+
+# Fixed histogram buckets (upper bounds, seconds) used for windowed p95 latency. They match
+# the buckets of nginx_http_request_duration_seconds exported by nginx-exporter.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0)
+
+# One raw signal per bucket holding its cumulative request count; the per-slot deltas of
+# these counters feed the window histogram the p95 feature reads
+LATENCY_BUCKET_QUERIES = [
+    (f'latency_le_{le}', f'sum(nginx_http_request_duration_seconds_bucket{{le="{le}"}})', 0.0)
+    for le in [repr(bound) for bound in LATENCY_BUCKETS] + ['+Inf']
+]
+LATENCY_BUCKET_NAMES = [name for name, _, _ in LATENCY_BUCKET_QUERIES]
+RAW_QUERIES += LATENCY_BUCKET_QUERIES
+
+NGINX_METRIC_PATTERN = re.compile(r'\b(nginx_\w+)(?:\{([^}]*)\})?')
+NODE_METRIC_PATTERN = re.compile(r'\b(node_\w+)(?:\{([^}]*)\})?')
+SUM_PATTERN = re.compile(r'\bsum\(')
+
+
+# Adds `selector` to the label matchers of every series the pattern matches
+def add_matchers(pattern, query, selector):
+    def add_selector(match):
+        matchers = ', '.join(part for part in (match.group(2), selector) if part)
+        return f'{match.group(1)}{{{matchers}}}'
+    return pattern.sub(add_selector, query)
+
+
+# Raw queries with extra label matchers (e.g. 'job="nginx-2"') added to every nginx_* series,
+# and `node_selector` (e.g. 'instance="host-2:9100"') to every node_* series, so that cpu and
+# mem come from one host's node-exporter.
+# With `group_by`, every sum over nginx_* series is kept apart per value of that label
+# (e.g. 'upstream'), so one query returns one series per pool; host-level signals such
+# as cpu and mem stay a single series that applies to every pool.
+def raw_queries(selector='', group_by=None, node_selector=''):
+    if not selector and not group_by and not node_selector:
+        return list(RAW_QUERIES)
+
+    queries = []
+    for name, query, default in RAW_QUERIES:
+        if NGINX_METRIC_PATTERN.search(query):
+            if selector:
+                query = add_matchers(NGINX_METRIC_PATTERN, query, selector)
+            if group_by:
+                query = SUM_PATTERN.sub(f'sum by ({group_by}) (', query)
+        elif node_selector:
+            query = add_matchers(NODE_METRIC_PATTERN, query, node_selector)
+        queries.append((name, query, default))
+    return queries
+
+
+# Model features, in column order: (feature, raw signal, aggregate, normalisation scale)
+FEATURES = [
+    ('cpu', 'cpu', 'mean', 100.0),
+    ('mem', 'mem', 'mean', 100.0),
+    ('latency', 'latency', 'ewma', 1.0),
+    ('p95', 'latency', 'p95', 1.0),
+    ('throughput', 'throughput', 'mean', 100.0),
+    ('connections', 'connections', 'mean', 100.0),
+]
+FEATURE_NAMES = [name for name, _, _, _ in FEATURES]
+
+# Raw signals are sampled every SAMPLE_INTERVAL_SECONDS and aggregated over WINDOW_SAMPLES
+SAMPLE_INTERVAL_SECONDS = 5.0
+WINDOW_SAMPLES = 6
+WINDOW_SECONDS = SAMPLE_INTERVAL_SECONDS * WINDOW_SAMPLES
+EWMA_HALF_LIFE_SECONDS = 15.0
+
+
+def schema():
+    return {
+        'version': SCHEMA_VERSION,
+        'raw_queries': [{'name': name, 'query': query, 'default': default} for name, query, default in RAW_QUERIES],
+        'features': [{'name': name, 'signal': signal, 'aggregate': aggregate, 'scale': scale}
+                     for name, signal, aggregate, scale in FEATURES],
+        'sample_interval_seconds': SAMPLE_INTERVAL_SECONDS,
+        'window_samples': WINDOW_SAMPLES,
+        'ewma_half_life_seconds': EWMA_HALF_LIFE_SECONDS,
+        'latency_buckets': list(LATENCY_BUCKETS),
+    }
+
+
+def save_schema(path):
+    with open(path, 'w') as f:
+        json.dump(schema(), f, indent=2)
+
+
+def load_schema(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+# Raise if a model's saved schema does not describe the features this code produces
+def check_schema(saved):
+    current = schema()
+    if saved != current:
+        differing = sorted(key for key in current if saved.get(key) != current[key])
+        raise ValueError(f"Feature schema mismatch: model has version {saved.get('version')}, "
+                         f"serving has version {SCHEMA_VERSION} (differs in {', '.join(differing)})")
+
+
+# Fixed-capacity ring buffer over a NumPy array with an O(1) running sum
+class RingBuffer:
+    def __init__(self, capacity):
+        self.values = np.zeros(capacity, dtype=np.float64)
+        self.capacity = capacity
+        self.count = 0
+        self.head = 0
+        self.total = 0.0
+        self.pushes = 0
+
+    # Append a value; returns the value it evicted, or None while the buffer is filling
+    def push(self, value):
+        evicted = None
+        if self.count == self.capacity:
+            evicted = self.values[self.head]
+            self.total -= evicted
+        else:
+            self.count += 1
+        self.values[self.head] = value
+        self.total += value
+        self.head = (self.head + 1) % self.capacity
+
+        # Resync the running sum once per lap so float error cannot accumulate
+        self.pushes += 1
+        if self.pushes % self.capacity == 0:
+            self.total = float(self.values[:self.count].sum())
+        return evicted
+
+    # Overwrite the newest value in place; returns the value it replaced
+    def replace_last(self, value):
+        last = (self.head - 1) % self.capacity
+        replaced = self.values[last]
+        self.total += value - replaced
+        self.values[last] = value
+        return replaced
+
+    def mean(self):
+        return float(self.total / self.count) if self.count else math.nan
+
+
+# Sliding-window histogram over fixed buckets: the ring holds each slot's request count per
+# bucket, and `counts` their sum over the window
+class WindowHistogram:
+    def __init__(self, bounds, capacity):
+        self.bounds = np.asarray(bounds, dtype=np.float64)
+        self.slots = np.zeros((capacity, len(self.bounds) + 1), dtype=np.float64)
+        self.counts = np.zeros(len(self.bounds) + 1, dtype=np.float64)
+        self.capacity = capacity
+        self.head = 0
+        self.pushes = 0
+
+    # Start a new slot with `counts` (zeros for an empty slot), evicting the oldest
+    def push(self, counts):
+        self.counts += counts - self.slots[self.head]
+        self.slots[self.head] = counts
+        self.head = (self.head + 1) % self.capacity
+        # Resync once per lap so float error cannot accumulate
+        self.pushes += 1
+        if self.pushes % self.capacity == 0:
+            self.counts = self.slots.sum(axis=0)
+
+    # Add `counts` to the newest slot
+    def add_last(self, counts):
+        self.slots[(self.head - 1) % self.capacity] += counts
+        self.counts += counts
+
+    # Quantile with linear interpolation inside the bucket, like PromQL's histogram_quantile
+    def quantile(self, q):
+        total = self.counts.sum()
+        if total <= 0:
+            return math.nan
+        rank = q * total
+        cumulative = np.cumsum(self.counts)
+        bucket = int(np.searchsorted(cumulative, rank, side='left'))
+        if bucket >= len(self.bounds):
+            return float(self.bounds[-1])
+        lower = self.bounds[bucket - 1] if bucket > 0 else 0.0
+        below = cumulative[bucket - 1] if bucket > 0 else 0
+        in_bucket = self.counts[bucket]
+        return float(lower + (self.bounds[bucket] - lower) * (rank - below) / in_bucket)
+
+
+# Time-aware exponentially weighted moving average
+class Ewma:
+    def __init__(self, half_life):
+        self.tau = half_life / math.log(2)
+        self.value = math.nan
+        self.timestamp = None
+
+    def push(self, value, timestamp):
+        if self.timestamp is None:
+            self.value = value
+        else:
+            alpha = 1.0 - math.exp(-max(timestamp - self.timestamp, 0.0) / self.tau)
+            self.value += alpha * (value - self.value)
+        self.timestamp = timestamp
+
+
+# Ingests raw samples as they arrive and keeps every rolling aggregate up to date in O(1).
+# The windows hold one slot per SAMPLE_INTERVAL_SECONDS whatever the ingest cadence, so
+# they always span WINDOW_SECONDS like the training data: a sample arriving before the
+# next slot is due refreshes the newest slot, and a sample arriving after a longer gap
+# fills every missed slot with its value.
+class FeatureEngine:
+    def __init__(self, window_samples=WINDOW_SAMPLES, half_life=EWMA_HALF_LIFE_SECONDS,
+                 sample_interval=SAMPLE_INTERVAL_SECONDS):
+        self.window_samples = window_samples
+        self.sample_interval = sample_interval
+        self.slot_started = None
+        self.windows = {name: RingBuffer(window_samples) for name, _, _ in RAW_QUERIES
+                        if name not in LATENCY_BUCKET_NAMES}
+        self.ewmas = {name: Ewma(half_life) for name in self.windows}
+        # Request counts per latency bucket over the window, from the bucket counters' deltas
+        self.histogram = WindowHistogram(LATENCY_BUCKETS, window_samples)
+        self.bucket_totals = None
+        self.defaults = {name: default for name, _, default in RAW_QUERIES}
+        # Most recent raw value of each signal, e.g. for the decision journal
+        self.latest = {}
+
+    # `sample` maps raw signal name to its value; missing signals are skipped
+    def ingest(self, sample, timestamp=None):
+        timestamp = time.time() if timestamp is None else timestamp
+        if self.slot_started is None:
+            self.slot_started, new_slots = timestamp, 1
+        else:
+            elapsed_slots = int((timestamp - self.slot_started) // self.sample_interval)
+            self.slot_started += elapsed_slots * self.sample_interval
+            new_slots = min(elapsed_slots, self.window_samples)
+
+        for name, value in sample.items():
+            if name not in self.windows or value is None or math.isnan(value):
+                continue
+            self.latest[name] = value
+            window = self.windows[name]
+            if new_slots == 0 and window.count:
+                window.replace_last(value)
+            else:
+                for _ in range(max(new_slots, 1)):
+                    window.push(value)
+            # The EWMA is time-aware and takes samples at any cadence
+            self.ewmas[name].push(value, timestamp)
+
+        # Requests counted since the previous sample land in the newest slot; missed slots
+        # stay empty, as their requests cannot be told apart from the newest slot's
+        counts = self.bucket_counts(sample)
+        if new_slots == 0:
+            self.histogram.add_last(counts)
+        else:
+            for _ in range(new_slots - 1):
+                self.histogram.push(np.zeros_like(counts))
+            self.histogram.push(counts)
+
+    # Per-bucket request counts since the previous sample of the cumulative bucket counters.
+    # Nothing is counted for the first sample, or while any bucket is missing.
+    def bucket_counts(self, sample):
+        counts = np.zeros(len(LATENCY_BUCKET_NAMES), dtype=np.float64)
+        values = [sample.get(name) for name in LATENCY_BUCKET_NAMES]
+        if any(value is None or math.isnan(value) for value in values):
+            return counts
+        # le-cumulative counts to per-bucket counts
+        totals = np.diff(np.array(values, dtype=np.float64), prepend=0.0).clip(min=0.0)
+        previous, self.bucket_totals = self.bucket_totals, totals
+        if previous is not None:
+            counts = totals - previous
+            # A counter went down, so the exporter restarted: count everything since then
+            if np.any(counts < 0):
+                counts = totals
+        return counts
+
+    def aggregate(self, signal, aggregate):
+        if aggregate == 'mean':
+            value = self.windows[signal].mean()
+        elif aggregate == 'ewma':
+            value = self.ewmas[signal].value
+        elif aggregate == 'p95':
+            value = self.histogram.quantile(0.95)
+        else:
+            raise ValueError(f"Unknown aggregate: {aggregate}")
+        return self.defaults[signal] if math.isnan(value) else value
+
+    # Un-normalised feature values keyed by feature name
+    def features(self):
+        return {name: self.aggregate(signal, aggregate) for name, signal, aggregate, _ in FEATURES}
+
+    # 1xF normalised feature vector in FEATURE_NAMES order, ready for the model
+    def vector(self):
+        values = self.features()
+        return np.array([[min(values[name] / scale, 1.0) for name, _, _, scale in FEATURES]])
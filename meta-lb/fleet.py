@@ -0,0 +1,242 @@
+import os
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from instrumentation import (FAILED_PUSHES, FLEET_APPLIED_VERSION, FLEET_DRIFT_REPUSHES, FLEET_PUSH_SECONDS,
+                             FLEET_SWITCH_SKEW_SECONDS, LB_PUSH_SECONDS)
+
+LB_CONFIG_PORT = 7000
+LB_BACKENDS = ["svc1:80", "svc2:80", "svc3:80"]
+
+# meta-lb's algorithm names -> the names lb/index.js switches on
+LB_ALGORITHM_NAMES = {
+    "round-robin": "roundrobin",
+    "least_conn": "leastconn",
+    "ip_hash": "iphash",
+    "weighted": "weighted",
+}
+
+PUSH_TIMEOUT_SECONDS = 1.0
+PUSH_RETRIES = 2
+RETRY_BACKOFF_SECONDS = 0.05
+RECONCILE_SECONDS = 30.0
+# Pushes run in parallel up to this many targets at once
+MAX_WORKERS = int(os.environ.get('LB_PUSH_WORKERS', '32'))
+
+
+# Config URLs of every LB replica behind a DNS name; docker's DNS returns one
+# record per replica of a scaled service. None when the name does not resolve.
+def resolve_targets(dns_name, port=LB_CONFIG_PORT):
+    try:
+        infos = socket.getaddrinfo(dns_name, port, type=socket.SOCK_STREAM)
+    except socket.gaierror as e:
+        print(f"Failed to resolve LB targets from '{dns_name}': {e}")
+        return None
+    hosts = sorted({info[4][0] for info in infos})
+    return [f"http://[{host}]:{port}/config" if ':' in host else f"http://{host}:{port}/config" for host in hosts]
+
+
+# The LB serves its running canary comparison next to its config
+def canary_url(config_url):
+    return config_url[:-len('/config')] + '/canary' if config_url.endswith('/config') else config_url + '/canary'
+
+
+class TargetState:
+    def __init__(self):
+        # Config version the target last acknowledged or reported, None if unknown
+        self.applied_version = None
+        self.push_seconds = None
+        self.error = None
+
+
+# Registry of LB instances that all receive the same config. A publish pushes the
+# new desired state to every target concurrently over pooled keep-alive connections,
+# so switch skew across the fleet stays within one round-trip. Each push carries a
+# version; reconcile() asks every target for the version it runs and re-pushes only
+# to the ones that drifted (restarted, missed a push, or newly discovered).
+class LBFleet:
+    def __init__(self, targets=None, dns_name=None, port=LB_CONFIG_PORT, backends=LB_BACKENDS,
+                 timeout=PUSH_TIMEOUT_SECONDS, retries=PUSH_RETRIES, reconcile_seconds=RECONCILE_SECONDS,
+                 clock=time.monotonic):
+        self.static_targets = list(targets or [])
+        self.dns_name = dns_name
+        self.port = port
+        self.backends = list(backends)
+        self.timeout = timeout
+        self.retries = retries
+        self.reconcile_seconds = reconcile_seconds
+        self.clock = clock
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=MAX_WORKERS, pool_maxsize=MAX_WORKERS)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='fleet')
+
+        self.targets = {}
+        self.desired_algorithm = None
+        self.desired_weights = None
+        self.desired_canary = None
+        self.desired = None
+        self.reconciled_at = None
+        self.refresh_targets()
+
+    # Re-read the target list; on a DNS failure the last known targets are kept
+    def refresh_targets(self):
+        urls = self.static_targets
+        if self.dns_name:
+            urls = resolve_targets(self.dns_name, self.port)
+            if urls is None:
+                return
+        for url in set(urls) - set(self.targets):
+            print(f"Added LB target {url}")
+            self.targets[url] = TargetState()
+        for url in set(self.targets) - set(urls):
+            print(f"Removed LB target {url}")
+            del self.targets[url]
+            try:
+                FLEET_APPLIED_VERSION.remove(url)
+            except KeyError:
+                pass
+
+    # Make `algorithm` (with per-backend `weights` for "weighted") the desired state
+    # and push it to the whole fleet. `canary` is (candidate algorithm, fraction of traffic)
+    # to route with the candidate while the rest keeps using `algorithm`.
+    def publish(self, algorithm, weights=None, canary=None):
+        # Wall-clock milliseconds keep versions increasing across meta-lb restarts,
+        # and stay exact as JavaScript numbers on the LB side
+        version = time.time_ns() // 1_000_000
+        if self.desired is not None:
+            version = max(version, self.desired["version"] + 1)
+        self.desired_algorithm = algorithm
+        self.desired_weights = weights
+        self.desired_canary = canary
+        self.desired = {
+            "algorithm": LB_ALGORITHM_NAMES[algorithm],
+            "backends": self.backends,
+            "version": version,
+        }
+        if weights is not None:
+            self.desired["weights"] = weights
+        if canary is not None:
+            self.desired["canary"] = {"algorithm": LB_ALGORITHM_NAMES[canary[0]], "fraction": canary[1]}
+        return self.push(list(self.targets))
+
+    def out_of_sync(self):
+        if self.desired is None:
+            return []
+        return [url for url, state in self.targets.items() if state.applied_version != self.desired["version"]]
+
+    def in_sync(self):
+        return not self.out_of_sync()
+
+    # Retry the targets that have not acknowledged the desired version, without asking them first
+    def repush(self):
+        return self.push(self.out_of_sync())
+
+    def reconcile_due(self):
+        return self.reconciled_at is None or self.clock() - self.reconciled_at >= self.reconcile_seconds
+
+    # Compare what every target reports against the desired state and fix the ones that drifted
+    def reconcile(self):
+        self.reconciled_at = self.clock()
+        self.refresh_targets()
+        if self.desired is None:
+            return True
+
+        futures = {self.executor.submit(self._fetch_version, url): url for url in self.targets}
+        for future in as_completed(futures):
+            self.targets[futures[future]].applied_version = future.result()
+
+        drifted = self.out_of_sync()
+        if not drifted:
+            return True
+        FLEET_DRIFT_REPUSHES.inc(len(drifted))
+        print(f"{len(drifted)} LB target(s) drifted from version {self.desired['version']}, re-pushing")
+        return self.push(drifted)
+
+    # Push the desired state to `urls` concurrently; True when every one acknowledged it
+    def push(self, urls):
+        if not urls:
+            return True
+        payload = self.desired
+        acked_at = []
+        with LB_PUSH_SECONDS.time():
+            futures = [self.executor.submit(self._push_one, url, payload) for url in urls]
+            for future in as_completed(futures):
+                finished = future.result()
+                if finished is not None:
+                    acked_at.append(finished)
+
+        if len(acked_at) > 1:
+            FLEET_SWITCH_SKEW_SECONDS.observe(max(acked_at) - min(acked_at))
+        print(f"Updated load balancing algorithm to: {self.desired_algorithm} "
+              f"on {len(acked_at)}/{len(urls)} LB target(s)")
+        return len(acked_at) == len(urls)
+
+    # Returns the perf_counter time the target acknowledged the push, or None if it never did
+    def _push_one(self, url, payload):
+        state = self.targets.get(url) or TargetState()
+        for attempt in range(self.retries + 1):
+            started = time.perf_counter()
+            try:
+                response = self.session.post(url, json=payload, timeout=self.timeout)
+                response.raise_for_status()
+            except requests.exceptions.RequestException as e:
+                state.error = str(e)
+                FAILED_PUSHES.labels(target=url).inc()
+                if attempt < self.retries:
+                    time.sleep(RETRY_BACKOFF_SECONDS * 2 ** attempt)
+                continue
+
+            finished = time.perf_counter()
+            state.applied_version = payload["version"]
+            state.push_seconds = finished - started
+            state.error = None
+            FLEET_PUSH_SECONDS.labels(target=url).observe(state.push_seconds)
+            FLEET_APPLIED_VERSION.labels(target=url).set(payload["version"])
+            return finished
+
+        print(f"Failed to update load balancer {url} after {self.retries + 1} attempt(s): {state.error}")
+        return None
+
+    def _fetch_version(self, url):
+        try:
+            response = self.session.get(url, timeout=self.timeout)
+            response.raise_for_status()
+            return response.json().get("version")
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print(f"Failed to read config from load balancer {url}: {e}")
+            return None
+
+    # Per-slice latency sums of the running canary, added up over every target that runs the
+    # desired version: {slice: {count, sum, sumSquares, errors}}
+    def canary_stats(self):
+        futures = [self.executor.submit(self._fetch_canary, url) for url in self.targets]
+        totals = {}
+        for future in as_completed(futures):
+            report = future.result()
+            if not report or report.get("version") != self.desired["version"] or not report.get("slices"):
+                continue
+            for slice_name, stats in report["slices"].items():
+                total = totals.setdefault(slice_name, dict.fromkeys(stats, 0))
+                for key, value in stats.items():
+                    total[key] += value
+        return totals
+
+    def _fetch_canary(self, url):
+        try:
+            response = self.session.get(canary_url(url), timeout=self.timeout)
+            response.raise_for_status()
+            return response.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print(f"Failed to read canary stats from load balancer {url}: {e}")
+            return None
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.session.close()
@@ -0,0 +1,130 @@
+import json
+import os
+
+import numpy as np
+
+# Compiled RandomForest artifact: one .npy file per node array plus meta.json.
+# Trees are concatenated into flat node arrays; children are global node indices
+# and leaves point to themselves so every tree can be walked for max_depth steps.
+ARRAYS = ('feature', 'threshold', 'children_left', 'children_right', 'value', 'roots', 'classes')
+# Rows walked at a time, so the per-level (rows x trees) index arrays stay small
+APPLY_BLOCK_ROWS = 8192
+
+
+# Flatten a fitted RandomForestClassifier into NumPy node arrays and save them under `path`
+def export_forest(model, path):
+    import sklearn
+
+    # Before scikit-learn 1.4 tree_.value held weighted class counts that predict_proba
+    # normalised on the fly; since 1.4 it holds the proportions and is returned as is
+    normalize = tuple(int(part) for part in sklearn.__version__.split('.')[:2]) < (1, 4)
+
+    features, thresholds, lefts, rights, values, roots = [], [], [], [], [], []
+    offset = 0
+    max_depth = 0
+    for estimator in model.estimators_:
+        tree = estimator.tree_
+        n_nodes = tree.node_count
+        node_ids = np.arange(n_nodes)
+        is_leaf = tree.children_left == -1
+
+        roots.append(offset)
+        features.append(np.where(is_leaf, 0, tree.feature))
+        thresholds.append(tree.threshold)
+        lefts.append(np.where(is_leaf, node_ids, tree.children_left) + offset)
+        rights.append(np.where(is_leaf, node_ids, tree.children_right) + offset)
+
+        # Same arithmetic as DecisionTreeClassifier.predict_proba, applied per node
+        value = tree.value[:, 0, :model.n_classes_].astype(np.float64)
+        if normalize:
+            normalizer = value.sum(axis=1)[:, np.newaxis]
+            normalizer[normalizer == 0.0] = 1.0
+            value = value / normalizer
+        values.append(value)
+
+        offset += n_nodes
+        max_depth = max(max_depth, tree.max_depth)
+
+    arrays = {
+        'feature': np.concatenate(features).astype(np.int32),
+        'threshold': np.concatenate(thresholds).astype(np.float64),
+        'children_left': np.concatenate(lefts).astype(np.int32),
+        'children_right': np.concatenate(rights).astype(np.int32),
+        'value': np.ascontiguousarray(np.concatenate(values)),
+        'roots': np.array(roots, dtype=np.int32),
+        'classes': np.asarray(model.classes_),
+    }
+    meta = {
+        'n_features': int(model.n_features_in_),
+        'n_trees': len(model.estimators_),
+        'n_classes': int(model.n_classes_),
+        'n_nodes': offset,
+        'max_depth': int(max_depth),
+        'feature_names': [str(name) for name in getattr(model, 'feature_names_in_', [])],
+    }
+
+    os.makedirs(path, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(path, name + '.npy'), array)
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+
+# Vectorised predictor for an exported forest. Produces the same predict_proba
+# output as scikit-learn, bit for bit, without importing scikit-learn.
+class CompiledForest:
+    def __init__(self, arrays, meta):
+        self.meta = meta
+        self.feature = arrays['feature']
+        self.threshold = arrays['threshold']
+        self.children_left = arrays['children_left']
+        self.children_right = arrays['children_right']
+        self.value = arrays['value']
+        self.roots = arrays['roots']
+        # Right then left child of every node, so one gather indexed by 2 * node + go_left walks a level
+        self.children = np.stack([self.children_right, self.children_left], axis=1).ravel()
+        self.classes_ = arrays['classes']
+        self.n_features_in_ = meta['n_features']
+        self.n_classes_ = meta['n_classes']
+
+    # mmap_mode='r' maps the node arrays instead of reading them; only use it on
+    # artifacts that are never rewritten in place, like registry versions
+    @classmethod
+    def load(cls, path, mmap_mode=None):
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        arrays = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode) for name in ARRAYS}
+        return cls(arrays, meta)
+
+    # Leaf node reached in every tree, shape (n_samples, n_trees)
+    def apply(self, X):
+        # scikit-learn casts inputs to float32 before comparing against float64 thresholds
+        X = np.asarray(X, dtype=np.float32)
+        if X.ndim != 2 or X.shape[1] != self.n_features_in_:
+            raise ValueError(f"Expected input of shape (n, {self.n_features_in_}), got {X.shape}")
+
+        leaves = np.empty((X.shape[0], len(self.roots)), dtype=self.children.dtype)
+        for start in range(0, X.shape[0], APPLY_BLOCK_ROWS):
+            block = X[start:start + APPLY_BLOCK_ROWS]
+            # Each row's offset into the flattened block, so a single gather reads the split features
+            flat = block.ravel()
+            offsets = (np.arange(block.shape[0]) * block.shape[1])[:, np.newaxis]
+            nodes = np.broadcast_to(self.roots, (block.shape[0], len(self.roots)))
+            for _ in range(self.meta['max_depth']):
+                go_left = flat[offsets + self.feature[nodes]] <= self.threshold[nodes]
+                nodes = self.children[2 * nodes + go_left]
+            leaves[start:start + block.shape[0]] = nodes
+        return leaves
+
+    def predict_proba(self, X):
+        leaves = self.apply(X)
+        # Accumulate tree by tree, in estimator order, exactly like the forest does
+        proba = np.zeros((leaves.shape[0], self.n_classes_), dtype=np.float64)
+        for t in range(leaves.shape[1]):
+            proba += self.value[leaves[:, t]]
+        proba /= leaves.shape[1]
+        return proba
+
+    def predict(self, X):
+        return self.classes_.take(np.argmax(self.predict_proba(X), axis=1), axis=0)
@@ -1,11 +1,13 @@
 import numpy as np
 from sklearn.ensemble import RandomForestClassifier
 import joblib
+from forest import export_forest
+from features import FEATURE_NAMES, save_schema
 
 # Generate a simple model for demonstration purposes
 def generate_model():
-    # Create a simple dataset
-    X = np.random.rand(100, 4)  # 4 features: CPU, Memory, Latency, Throughput
+    # Create a simple dataset of normalised features, in the order of features.FEATURE_NAMES
+    X = np.random.rand(100, len(FEATURE_NAMES))  # cpu, mem, latency, p95, throughput, connections
     
     # Create labels (0: round-robin, 1: least_conn, 2: ip_hash)
     y = np.zeros(100, dtype=int)
@@ -27,5 +29,12 @@ def generate_model():
     joblib.dump(model, 'lb_model.pkl')
     print("Model generated and saved as lb_model.pkl")
 
+    # Export the sklearn-free compiled forest used by app.py
+    export_forest(model, 'lb_forest')
+    print("Compiled forest exported to lb_forest/")
+
+    save_schema('feature_schema.json')
+    print("Feature schema saved as feature_schema.json")
+
 if __name__ == "__main__":
     generate_model()
\ No newline at end of file
@@ -0,0 +1,117 @@
+import collections
+import os
+import signal
+import sys
+import threading
+import time
+
+from prometheus_client import Counter, Gauge, Histogram
+
+# Hot-path metrics exported on meta-lb's :8000/metrics, one histogram per cycle stage
+STAGE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+FETCH_QUERY_SECONDS = Histogram('meta_lb_fetch_query_seconds', 'Latency of one Prometheus feature query',
+                                ['feature'], buckets=STAGE_BUCKETS)
+FETCH_SECONDS = Histogram('meta_lb_fetch_seconds', 'Latency of the whole concurrent fetch stage',
+                          buckets=STAGE_BUCKETS)
+PREDICT_SECONDS = Histogram('meta_lb_predict_seconds', 'Latency of model inference', buckets=STAGE_BUCKETS)
+CONFIG_WRITE_SECONDS = Histogram('meta_lb_config_write_seconds', 'Latency of rendering and writing the nginx config',
+                                 buckets=STAGE_BUCKETS)
+LB_PUSH_SECONDS = Histogram('meta_lb_lb_push_seconds', 'Latency of pushing the config to every load balancer',
+                            buckets=STAGE_BUCKETS)
+
+FALLBACKS = Counter('meta_lb_metric_fallbacks_total', 'Feature queries that fell back to the last known value',
+                    ['feature', 'reason'])
+SKIPPED_APPLIES = Counter('meta_lb_skipped_applies_total', 'Cycles whose prediction needed no config change')
+NGINX_RELOADS = Counter('meta_lb_nginx_reloads_total', 'nginx reload attempts after a config change, by result',
+                        ['result'])
+FAILED_PUSHES = Counter('meta_lb_failed_pushes_total', 'Config push attempts to a load balancer that failed',
+                        ['target'])
+
+FLEET_PUSH_SECONDS = Histogram('meta_lb_fleet_push_seconds', 'Latency of one successful config push per LB target',
+                               ['target'], buckets=STAGE_BUCKETS)
+FLEET_SWITCH_SKEW_SECONDS = Histogram('meta_lb_fleet_switch_skew_seconds',
+                                      'Spread between the first and last LB target acknowledging a push',
+                                      buckets=STAGE_BUCKETS)
+FLEET_APPLIED_VERSION = Gauge('meta_lb_fleet_applied_version', 'Config version each LB target last acknowledged',
+                              ['target'])
+FLEET_DRIFT_REPUSHES = Counter('meta_lb_fleet_drift_repushes_total',
+                               'LB targets re-pushed because reconciliation found them out of date')
+
+DECISION_INTERVAL_SECONDS = Gauge('meta_lb_decision_interval_seconds', 'Current wait between decision cycles')
+DECISION_CYCLES = Counter('meta_lb_decision_cycles_total', 'Decision cycles run, by what started them', ['cause'])
+
+ACTIVE_MODEL_VERSION = Gauge('meta_lb_active_model_version', 'Version of the model being served, 0 if unversioned')
+MODEL_SWAPS = Counter('meta_lb_model_swaps_total', 'Times a model was swapped in, including rollbacks')
+MODEL_REJECTIONS = Counter('meta_lb_model_rejections_total', 'Model versions that failed validation')
+
+CANARY_ACTIVE = Gauge('meta_lb_canary_active', '1 while a candidate algorithm is being canaried')
+CANARY_RESULTS = Counter('meta_lb_canary_results_total', 'Finished canaries by outcome', ['result'])
+
+JOURNAL_RECORDS = Counter('meta_lb_journal_records_total', 'Decisions written to the decision journal')
+JOURNAL_DROPPED = Counter('meta_lb_journal_dropped_total', 'Decisions dropped because the journal writer fell behind')
+
+FEATURE_VALUE = Gauge('meta_lb_feature_value', 'Last normalised feature vector fed to the model', ['feature'])
+POOL_ALGORITHM = Gauge('meta_lb_pool_algorithm', 'Algorithm applied to each upstream pool in pools mode',
+                       ['pool', 'algorithm'])
+BACKEND_WEIGHT = Gauge('meta_lb_backend_weight', 'Weight pushed for each backend in weights mode', ['backend'])
+PREDICTION_CONFIDENCE = Gauge('meta_lb_prediction_confidence', 'Last predict_proba confidence per algorithm',
+                              ['algorithm'])
+
+# Sampling profiler: send SIGUSR1 to sample every thread for PROFILE_SECONDS and write
+# the stacks in collapsed ("folded") format, ready for flamegraph.pl or speedscope
+PROFILE_DIR = os.environ.get('PROFILE_DIR', '/tmp')
+PROFILE_SECONDS = float(os.environ.get('PROFILE_SECONDS', '30'))
+PROFILE_INTERVAL_SECONDS = 0.005
+
+
+class SamplingProfiler:
+    def __init__(self, output_dir=PROFILE_DIR, duration=PROFILE_SECONDS, interval=PROFILE_INTERVAL_SECONDS):
+        self.output_dir = output_dir
+        self.duration = duration
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.running = False
+
+    def install(self, signum=signal.SIGUSR1):
+        signal.signal(signum, lambda *_: self.trigger())
+        print(f"Sampling profiler armed: send signal {signum} to write a profile to {self.output_dir}")
+
+    # Start a profile in the background unless one is already running
+    def trigger(self):
+        with self.lock:
+            if self.running:
+                return
+            self.running = True
+        threading.Thread(target=self._run, name='profiler', daemon=True).start()
+
+    def _run(self):
+        try:
+            stacks = self.sample()
+            path = os.path.join(self.output_dir, f"meta-lb-{int(time.time())}.folded")
+            with open(path, 'w') as f:
+                for stack, count in stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+            print(f"Wrote profile with {sum(stacks.values())} samples to {path}")
+        finally:
+            with self.lock:
+                self.running = False
+
+    def sample(self):
+        own = threading.get_ident()
+        stacks = collections.Counter()
+        deadline = time.monotonic() + self.duration
+        while time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                frames = []
+                while frame is not None:
+                    code = frame.f_code
+                    frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                frames.append(names.get(ident, str(ident)))
+                stacks[';'.join(reversed(frames))] += 1
+            time.sleep(self.interval)
+        return stacks
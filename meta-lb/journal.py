@@ -0,0 +1,374 @@
+import argparse
+import json
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+
+import numpy as np
+
+from features import FEATURE_NAMES
+from forest import CompiledForest
+from instrumentation import JOURNAL_DROPPED, JOURNAL_RECORDS
+from registry import load_version
+
+# Append-only decision journal: one fixed-width binary record per decision with the feature
+# vector, every algorithm's probability, the predicted and applied algorithm, the model
+# version and the latency measured in that cycle. Segments are journal-<index>.bin files
+# of a HEADER_BYTES header followed by records. The writer preallocates a segment,
+# memory-maps it and starts the next one when it is full, dropping the oldest beyond
+# max_segments. The decision loop only puts a tuple on a queue; a writer thread packs
+# batches into the map, so a slow disk never holds up a cycle.
+#
+# The latency that followed a decision is not known when it is made, so it is not written
+# back: it is read at query time from the records after it.
+JOURNAL_PATH = os.environ.get('JOURNAL_PATH', '')
+JOURNAL_SEGMENT_BYTES = int(os.environ.get('JOURNAL_SEGMENT_BYTES', str(64 * 1024 * 1024)))
+JOURNAL_MAX_SEGMENTS = int(os.environ.get('JOURNAL_MAX_SEGMENTS', '16'))
+# Decisions waiting for the writer; further ones are dropped and counted
+JOURNAL_QUEUE_SIZE = 10000
+WRITE_BATCH_RECORDS = 4096
+
+JOURNAL_MAGIC = b'MLBJRNL1'
+# Magic, record count (updated after every batch), header JSON length, header JSON
+HEADER_BYTES = 4096
+HEADER_PREFIX = struct.Struct('<8sQI')
+# Index stored when a decision's algorithm is not one of the journal's algorithms
+NO_ALGORITHM = 255
+MAX_ALGORITHMS = 8
+
+# Time in an algorithm stops counting across a gap this long (meta-lb was down)
+MAX_GAP_SECONDS = 120.0
+# Window after a decision over which its resulting latency is averaged
+LATENCY_HORIZON_SECONDS = 30.0
+RESCORE_BATCH_ROWS = 1 << 20
+
+
+def record_dtype(n_algorithms, n_features=len(FEATURE_NAMES)):
+    return np.dtype([
+        ('timestamp', '<f8'),
+        ('pool', 'S32'),
+        ('features', '<f8', (n_features,)),
+        ('scores', '<f4', (n_algorithms,)),
+        ('predicted', 'u1'),
+        ('applied', 'u1'),
+        ('model_version', '<u8'),
+        ('latency', '<f8'),
+    ])
+
+
+def segment_name(index):
+    return f'journal-{index:06d}.bin'
+
+
+def list_segments(path):
+    if not os.path.isdir(path):
+        return []
+    return sorted(name for name in os.listdir(path) if name.startswith('journal-') and name.endswith('.bin'))
+
+
+def read_header(f):
+    magic, count, length = HEADER_PREFIX.unpack(f.read(HEADER_PREFIX.size))
+    if magic != JOURNAL_MAGIC:
+        raise ValueError(f"Not a decision journal segment: {f.name}")
+    return count, json.loads(f.read(length))
+
+
+class DecisionJournal:
+    # `algorithms` lists algorithm names by class label, so a label is its record index
+    def __init__(self, path, algorithms, segment_bytes=JOURNAL_SEGMENT_BYTES, max_segments=JOURNAL_MAX_SEGMENTS,
+                 queue_size=JOURNAL_QUEUE_SIZE):
+        if len(algorithms) > MAX_ALGORITHMS:
+            raise ValueError(f"At most {MAX_ALGORITHMS} algorithms fit a journal record")
+        self.path = path
+        self.algorithms = list(algorithms)
+        self.indexes = {name: index for index, name in enumerate(self.algorithms)}
+        self.dtype = record_dtype(len(self.algorithms))
+        self.capacity = max((segment_bytes - HEADER_BYTES) // self.dtype.itemsize, 1)
+        self.max_segments = max_segments
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.thread = None
+        self.segment = None
+        os.makedirs(path, exist_ok=True)
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='decision-journal', daemon=True)
+        self.thread.start()
+        return self
+
+    # Write what is queued and close the current segment
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        self.close_segment()
+
+    # Called from the decision loop; never blocks
+    def record(self, features, scores, predicted, applied, latency=np.nan, pool='', model_version=None,
+               timestamp=None):
+        try:
+            self.queue.put_nowait((time.time() if timestamp is None else timestamp, pool, features, scores,
+                                   predicted, applied, model_version, latency))
+        except queue.Full:
+            JOURNAL_DROPPED.inc()
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < WRITE_BATCH_RECORDS:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in batch
+            batch = [item for item in batch if item is not None]
+            try:
+                if batch:
+                    self.write(self.pack(batch))
+            except (OSError, ValueError) as e:
+                print(f"Failed to write {len(batch)} decisions to the journal: {e}")
+            if stop:
+                return
+
+    def pack(self, batch):
+        rows = np.zeros(len(batch), dtype=self.dtype)
+        timestamps, pools, features, scores, predicted, applied, versions, latencies = zip(*batch)
+        rows['timestamp'] = timestamps
+        rows['pool'] = pools
+        rows['features'] = np.asarray(features, dtype=np.float64).reshape(len(batch), -1)
+        rows['scores'] = [[(s or {}).get(name, np.nan) for name in self.algorithms] for s in scores]
+        rows['predicted'] = [self.indexes.get(name, NO_ALGORITHM) for name in predicted]
+        rows['applied'] = [self.indexes.get(name, NO_ALGORITHM) for name in applied]
+        rows['model_version'] = [int(version or 0) for version in versions]
+        rows['latency'] = latencies
+        return rows
+
+    def write(self, rows):
+        while len(rows):
+            if self.segment is None:
+                self.open_segment()
+            count = self.segment['count']
+            n = min(len(rows), self.capacity - count)
+            self.segment['records'][count:count + n] = rows[:n]
+            count += n
+            # Readers take the count from the header, so it only covers complete records
+            HEADER_PREFIX.pack_into(self.segment['mmap'], 0, JOURNAL_MAGIC, count, self.segment['header_length'])
+            self.segment['count'] = count
+            JOURNAL_RECORDS.inc(n)
+            rows = rows[n:]
+            if count == self.capacity:
+                self.close_segment()
+
+    def open_segment(self):
+        segments = list_segments(self.path)
+        index = int(segments[-1][len('journal-'):-len('.bin')]) + 1 if segments else 0
+        header = json.dumps({
+            'algorithms': self.algorithms,
+            'features': FEATURE_NAMES,
+            'dtype': self.dtype.descr,
+            'created_at': time.time(),
+        }).encode()
+        if HEADER_PREFIX.size + len(header) > HEADER_BYTES:
+            raise ValueError("Journal header does not fit in HEADER_BYTES")
+
+        fd = os.open(os.path.join(self.path, segment_name(index)), os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o644)
+        try:
+            os.ftruncate(fd, HEADER_BYTES + self.capacity * self.dtype.itemsize)
+            mm = mmap.mmap(fd, 0)
+        except BaseException:
+            os.close(fd)
+            raise
+        HEADER_PREFIX.pack_into(mm, 0, JOURNAL_MAGIC, 0, len(header))
+        mm[HEADER_PREFIX.size:HEADER_PREFIX.size + len(header)] = header
+        self.segment = {
+            'fd': fd,
+            'mmap': mm,
+            'records': np.ndarray(self.capacity, dtype=self.dtype, buffer=mm, offset=HEADER_BYTES),
+            'count': 0,
+            'header_length': len(header),
+        }
+
+        # Keep at most max_segments, the new one included
+        for old in list_segments(self.path)[:-self.max_segments]:
+            os.remove(os.path.join(self.path, old))
+
+    # Flush and trim the segment to the records it holds
+    def close_segment(self):
+        if self.segment is None:
+            return
+        segment, self.segment = self.segment, None
+        del segment['records']
+        segment['mmap'].flush()
+        segment['mmap'].close()
+        os.ftruncate(segment['fd'], HEADER_BYTES + segment['count'] * self.dtype.itemsize)
+        os.close(segment['fd'])
+
+
+# Read side: every segment memory-mapped, including the one being written
+class JournalReader:
+    def __init__(self, path):
+        self.path = path
+        self.segments = list_segments(path)
+        if not self.segments:
+            raise ValueError(f"No journal segments in {path}")
+        with open(os.path.join(path, self.segments[-1]), 'rb') as f:
+            _, header = read_header(f)
+        self.algorithms = header['algorithms']
+        self.features = header['features']
+
+    def read_segment(self, segment):
+        path = os.path.join(self.path, segment)
+        with open(path, 'rb') as f:
+            count, header = read_header(f)
+        # JSON turned the descr's tuples into lists; sub-array fields have a third item, the shape
+        dtype = np.dtype([(field[0], field[1], tuple(field[2])) if len(field) == 3 else tuple(field)
+                          for field in header['dtype']])
+        if header['algorithms'] != self.algorithms:
+            raise ValueError(f"{segment} was written for algorithms {header['algorithms']}")
+        if not count:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode='r', offset=HEADER_BYTES, shape=(count,))
+
+    # Load fields into memory, copying only the selected rows; `pool` selects one pool
+    def load(self, fields=None, pool=None):
+        parts = {}
+        for segment in self.segments:
+            records = self.read_segment(segment)
+            mask = None if pool is None else records['pool'] == pool.encode()
+            for name in (fields or records.dtype.names):
+                parts.setdefault(name, []).append(records[name] if mask is None else records[name][mask])
+        return {name: np.concatenate(values) for name, values in parts.items()}
+
+
+# Seconds spent in each algorithm index, crediting each interval to the decision that began it
+def time_in_algorithm(timestamps, applied, n_algorithms, max_gap=MAX_GAP_SECONDS):
+    gaps = np.diff(timestamps)
+    gaps[(gaps < 0) | (gaps > max_gap)] = 0.0
+    counted = applied[:-1] < n_algorithms
+    return np.bincount(applied[:-1][counted], weights=gaps[counted], minlength=n_algorithms)
+
+
+# Mean latency over the records in (t, t + horizon] after each decision, NaN when there are none
+def latency_after(timestamps, latency, horizon=LATENCY_HORIZON_SECONDS):
+    valid = ~np.isnan(latency)
+    sums = np.concatenate(([0.0], np.cumsum(np.where(valid, latency, 0.0))))
+    counts = np.concatenate(([0], np.cumsum(valid)))
+    start = np.arange(1, len(timestamps) + 1)
+    end = np.searchsorted(timestamps, timestamps + horizon, side='right')
+    n = counts[end] - counts[start]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(n > 0, (sums[end] - sums[start]) / n, np.nan)
+
+
+# Decisions whose applied algorithm differs from the one before
+def switches(applied):
+    return np.concatenate(([False], applied[1:] != applied[:-1]))
+
+
+def mean_ms(values):
+    values = values[~np.isnan(values)]
+    return f"{1000 * values.mean():.1f} ms" if len(values) else "n/a"
+
+
+def pools_of(reader, pool):
+    if pool is not None:
+        return [pool]
+    return [name.decode() for name in np.unique(reader.load(['pool'])['pool'])]
+
+
+def summarise(reader, pool=None, horizon=LATENCY_HORIZON_SECONDS):
+    n_algorithms = len(reader.algorithms)
+    for name in pools_of(reader, pool):
+        records = reader.load(['timestamp', 'applied', 'latency'], pool=name)
+        timestamps, applied = records['timestamp'], records['applied']
+        if len(timestamps) < 2:
+            print(f"Pool '{name or '(all)'}': {len(timestamps)} decision(s), nothing to summarise")
+            continue
+        seconds = time_in_algorithm(timestamps, applied, n_algorithms)
+        following = latency_after(timestamps, records['latency'], horizon)
+        switched = switches(applied)
+        hours = max(seconds.sum() / 3600, 1e-9)
+
+        print(f"Pool '{name or '(all)'}': {len(timestamps)} decisions over {seconds.sum() / 3600:.2f} h")
+        print(f"  {'algorithm':<14}{'time':>8}{'decisions':>12}  latency over the next {horizon:.0f} s")
+        for index, algorithm in enumerate(reader.algorithms):
+            chosen = applied == index
+            print(f"  {algorithm:<14}{seconds[index] / max(seconds.sum(), 1e-9):>8.1%}{int(chosen.sum()):>12}  "
+                  f"{mean_ms(following[chosen])}")
+        print(f"  switches: {int(switched.sum())} ({switched.sum() / hours:.1f}/h), latency after a switch "
+              f"{mean_ms(following[switched])}, otherwise {mean_ms(following[~switched])}")
+
+
+# Score every journalled feature vector with `model` in large vectorised batches; returns
+# the journal index of each new prediction
+def rescore(model, features, algorithms, batch_rows=RESCORE_BATCH_ROWS):
+    classes = np.asarray(model.classes_).astype(np.int64)
+    labels = np.where(classes < len(algorithms), classes, NO_ALGORITHM).astype(np.uint8)
+    predicted = np.empty(len(features), dtype=np.uint8)
+    for start in range(0, len(features), batch_rows):
+        proba = model.predict_proba(np.ascontiguousarray(features[start:start + batch_rows]))
+        predicted[start:start + batch_rows] = labels[np.argmax(proba, axis=1)]
+    return predicted
+
+
+# Counterfactual check of a model on production history: how often it agrees with what was
+# predicted and applied, what it would have chosen instead, and the latency that followed
+# the decisions it agrees and disagrees with
+def compare(reader, model, pool=None, horizon=LATENCY_HORIZON_SECONDS):
+    n_algorithms = len(reader.algorithms)
+    for name in pools_of(reader, pool):
+        records = reader.load(['timestamp', 'features', 'predicted', 'applied', 'latency'], pool=name)
+        if not len(records['timestamp']):
+            continue
+        started = time.perf_counter()
+        new = rescore(model, records['features'], reader.algorithms)
+        elapsed = time.perf_counter() - started
+        applied = records['applied']
+        following = latency_after(records['timestamp'], records['latency'], horizon)
+        agrees = new == applied
+
+        print(f"Pool '{name or '(all)'}': re-scored {len(new)} decisions in {elapsed:.2f} s")
+        print(f"  agreement with the logged prediction {np.mean(new == records['predicted']):.1%}, "
+              f"with the applied algorithm {np.mean(agrees):.1%}")
+        confusion = np.bincount(np.minimum(applied, n_algorithms) * (n_algorithms + 1) + np.minimum(new, n_algorithms),
+                                minlength=(n_algorithms + 1) ** 2).reshape(n_algorithms + 1, n_algorithms + 1)
+        print(f"  {'applied/new':<14}" + ''.join(f"{algorithm:>14}" for algorithm in reader.algorithms))
+        for index, algorithm in enumerate(reader.algorithms):
+            print(f"  {algorithm:<14}" + ''.join(f"{count:>14}" for count in confusion[index, :n_algorithms]))
+        print(f"  latency over the next {horizon:.0f} s where the model agrees {mean_ms(following[agrees])}, "
+              f"where it would switch {mean_ms(following[~agrees])}")
+
+
+def load_model_for_replay(model, models_dir):
+    if os.path.exists(os.path.join(model, 'meta.json')):
+        return CompiledForest.load(model, mmap_mode='r')
+    return load_version(models_dir, model)[0]
+
+
+# Usage: python meta-lb/journal.py summary <journal dir>
+#        python meta-lb/journal.py rescore <journal dir> <model version or compiled forest dir>
+def main():
+    parser = argparse.ArgumentParser(description="Query and replay the meta-lb decision journal")
+    parser.add_argument('command', choices=['summary', 'rescore'])
+    parser.add_argument('journal', help="journal directory")
+    parser.add_argument('model', nargs='?', help="rescore: model version, or a compiled forest directory")
+    parser.add_argument('--pool', help="only this pool ('' for algorithm mode)")
+    parser.add_argument('--horizon', type=float, default=LATENCY_HORIZON_SECONDS,
+                        help="seconds after a decision its resulting latency is averaged over")
+    parser.add_argument('--models-dir', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models'))
+    args = parser.parse_args()
+
+    reader = JournalReader(args.journal)
+    if args.command == 'summary':
+        summarise(reader, args.pool, args.horizon)
+    else:
+        if not args.model:
+            parser.error("rescore needs a model")
+        compare(reader, load_model_for_replay(args.model, args.models_dir), args.pool, args.horizon)
+
+
+if __name__ == '__main__':
+    main()
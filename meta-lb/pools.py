@@ -0,0 +1,74 @@
+import re
+import time
+
+import numpy as np
+
+from applier import ALGORITHM_DIRECTIVES, ConfigApplier, load_template
+from features import FeatureEngine
+
+# Multi-pool mode: one meta-lb decides the algorithm of many nginx upstream pools.
+# Every raw signal is fetched for all pools at once with a `by (upstream)` query,
+# each pool keeps its own rolling feature windows, the pools' vectors are stacked
+# into one N x F matrix for a single predict_proba call, and each pool's result
+# goes through its own hysteresis into its own upstream-<pool>.conf.
+POOL_LABEL = 'upstream'
+# Pool names become a file name and an nginx upstream name
+POOL_NAME_PATTERN = re.compile(r'[A-Za-z0-9_-]+')
+
+
+# "api=svc1:80,svc2:80;static=svc3:80" -> {'api': ['svc1:80', 'svc2:80'], 'static': ['svc3:80']}
+def parse_pools(spec):
+    pools = {}
+    for entry in spec.split(';'):
+        if not entry.strip():
+            continue
+        name, _, servers = entry.partition('=')
+        servers = [server.strip() for server in servers.split(',') if server.strip()]
+        name = name.strip()
+        if not name or not servers:
+            raise ValueError(f"Invalid pool '{entry.strip()}', expected name=host:port,host:port")
+        if not POOL_NAME_PATTERN.fullmatch(name):
+            raise ValueError(f"Invalid pool name '{name}', only letters, digits, '_' and '-' are allowed")
+        pools[name] = servers
+    if not pools:
+        raise ValueError("No pools configured, set LB_POOLS")
+    return pools
+
+
+# Per-pool rolling features fed from the grouped collector's {signal: {upstream: value}}
+class PoolFeatures:
+    def __init__(self, pools, **engine_kwargs):
+        self.pools = list(pools)
+        self.engines = {pool: FeatureEngine(**engine_kwargs) for pool in self.pools}
+
+    # A series without the pool label (key '') is host-level, e.g. cpu, and applies to every pool
+    def ingest(self, values, timestamp=None):
+        timestamp = time.time() if timestamp is None else timestamp
+        for pool, engine in self.engines.items():
+            engine.ingest({name: series.get(pool, series.get('')) for name, series in values.items()}, timestamp)
+
+    # N x F normalised feature matrix, one row per pool in self.pools order
+    def matrix(self):
+        return np.vstack([engine.vector() for engine in self.engines.values()])
+
+
+# Renders one pool's whole upstream block into upstream-<pool>.conf; the nginx server
+# blocks that proxy_pass to the pools are the operator's. Pools are nginx-only: the
+# LB fleet serves a single backend list, so no fleet is attached.
+class PoolConfigApplier(ConfigApplier):
+    def __init__(self, conf_dir, pool, servers, **kwargs):
+        super().__init__(conf_dir, None, **kwargs)
+        self.pool = pool
+        self.servers = list(servers)
+        self.pool_template = load_template('pool.conf')
+
+    def render(self, algorithm, weights=None):
+        if weights is None:
+            servers = "\n".join(f"    server {server};" for server in self.servers)
+        else:
+            servers = "\n".join(f"    server {server} weight={weight};" for server, weight in weights.items())
+        return {
+            f'upstream-{self.pool}.conf': self.pool_template.substitute(
+                pool=self.pool, algorithm=algorithm, algorithm_directive=ALGORITHM_DIRECTIVES[algorithm],
+                servers=servers),
+        }
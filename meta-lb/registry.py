@@ -0,0 +1,198 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from features import check_schema, load_schema, save_schema
+from forest import CompiledForest, export_forest
+from instrumentation import ACTIVE_MODEL_VERSION, MODEL_REJECTIONS, MODEL_SWAPS
+
+# Versioned model artifacts. train_model.py publishes every model as
+# models/versions/<version>/ holding the compiled forest arrays, the feature schema,
+# a small holdout set and manifest.json. A version directory is renamed into place
+# complete and never modified afterwards, so serving can memory-map its arrays.
+VERSIONS_DIR = 'versions'
+HOLDOUT_ROWS = 500
+KEEP_VERSIONS = 5
+MODEL_POLL_SECONDS = float(os.environ.get('MODEL_POLL_SECONDS', '10'))
+# A new model may score at most this much below the active one on the new holdout
+HOLDOUT_TOLERANCE = float(os.environ.get('HOLDOUT_TOLERANCE', '0.02'))
+
+
+# Trainer side: write `model` as a new version with a holdout sample drawn from (X, y)
+def publish_version(model, X_holdout, y_holdout, models_dir, extra=None):
+    versions_dir = os.path.join(models_dir, VERSIONS_DIR)
+    os.makedirs(versions_dir, exist_ok=True)
+    # Millisecond timestamps sort in publish order, and keep increasing across hosts' restarts
+    version = str(time.time_ns() // 1_000_000)
+
+    X_holdout, y_holdout = np.asarray(X_holdout, dtype=np.float64), np.asarray(y_holdout)
+    if len(y_holdout) > HOLDOUT_ROWS:
+        rows = np.sort(np.random.default_rng(0).choice(len(y_holdout), HOLDOUT_ROWS, replace=False))
+        X_holdout, y_holdout = X_holdout[rows], y_holdout[rows]
+
+    tmp_dir = tempfile.mkdtemp(dir=versions_dir, prefix='.publish-')
+    try:
+        export_forest(model, os.path.join(tmp_dir, 'lb_forest'))
+        save_schema(os.path.join(tmp_dir, 'feature_schema.json'))
+        np.savez(os.path.join(tmp_dir, 'holdout.npz'), X=X_holdout, y=y_holdout)
+
+        # Record the accuracy of the artifact itself, as serving will compute it
+        forest = CompiledForest.load(os.path.join(tmp_dir, 'lb_forest'))
+        manifest = {
+            'version': version,
+            'created_at': time.time(),
+            'holdout_rows': int(len(y_holdout)),
+            'holdout_accuracy': float(np.mean(forest.predict(X_holdout) == y_holdout)) if len(y_holdout) else None,
+            **(extra or {}),
+        }
+        with open(os.path.join(tmp_dir, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.chmod(tmp_dir, 0o755)
+        os.rename(tmp_dir, os.path.join(versions_dir, version))
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    # Old versions stay around for rollback, up to KEEP_VERSIONS
+    for old in list_versions(models_dir)[:-KEEP_VERSIONS]:
+        shutil.rmtree(os.path.join(versions_dir, old), ignore_errors=True)
+    return version
+
+
+def list_versions(models_dir):
+    versions_dir = os.path.join(models_dir, VERSIONS_DIR)
+    if not os.path.isdir(versions_dir):
+        return []
+    return sorted((name for name in os.listdir(versions_dir) if name.isdigit()), key=int)
+
+
+def load_version(models_dir, version):
+    path = os.path.join(models_dir, VERSIONS_DIR, version)
+    with open(os.path.join(path, 'manifest.json')) as f:
+        manifest = json.load(f)
+    check_schema(load_schema(os.path.join(path, 'feature_schema.json')))
+    model = CompiledForest.load(os.path.join(path, 'lb_forest'), mmap_mode='r')
+    with np.load(os.path.join(path, 'holdout.npz')) as holdout:
+        X_holdout, y_holdout = holdout['X'], holdout['y']
+    return model, manifest, X_holdout, y_holdout
+
+
+def holdout_accuracy(model, X_holdout, y_holdout):
+    return float(np.mean(model.predict(X_holdout) == y_holdout)) if len(y_holdout) else None
+
+
+# Serving side: a background thread watches models/versions, loads each new version
+# memory-mapped and validates it; current() swaps a validated candidate in at the start
+# of a cycle, so one cycle always uses one model. The model it replaced is kept for rollback.
+class ModelRegistry:
+    def __init__(self, models_dir, initial_model=None, poll_seconds=MODEL_POLL_SECONDS,
+                 tolerance=HOLDOUT_TOLERANCE):
+        self.models_dir = models_dir
+        self.poll_seconds = poll_seconds
+        self.tolerance = tolerance
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+
+        # (version, model) pairs; version None is the legacy unversioned artifact
+        self.active = (None, initial_model)
+        self.previous = None
+        self.candidate = None
+        self.rollback_requested = False
+        # Versions already considered, valid or not; each is validated at most once
+        self.seen = set()
+
+    # Load the newest valid version synchronously; returns False when there is none
+    def load_latest(self):
+        for version in reversed(list_versions(self.models_dir)):
+            candidate = self._validate(version, compare_active=False)
+            if candidate is not None:
+                self.activate(version, candidate)
+                return True
+        return False
+
+    def start(self):
+        threading.Thread(target=self._watch, name='model-registry', daemon=True).start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def _watch(self):
+        while not self.stop_event.wait(self.poll_seconds):
+            try:
+                self.poll()
+            except Exception as e:
+                print(f"Error watching {self.models_dir}: {e}")
+
+    # Stage the newest valid unseen version newer than the active one for the next cycle
+    def poll(self):
+        versions = [version for version in list_versions(self.models_dir) if version not in self.seen]
+        active_version = self.active[0]
+        for version in reversed(versions):
+            if active_version is not None and int(version) <= int(active_version):
+                break
+            model = self._validate(version, compare_active=True)
+            if model is not None:
+                with self.lock:
+                    self.candidate = (version, model)
+                print(f"Model version {version} validated, swapping in at the next cycle")
+                break
+        self.seen.update(versions)
+
+    def _validate(self, version, compare_active):
+        self.seen.add(version)
+        try:
+            model, manifest, X_holdout, y_holdout = load_version(self.models_dir, version)
+            if len(y_holdout) and not np.all(np.isfinite(model.predict_proba(X_holdout))):
+                raise ValueError("predict_proba returned non-finite values")
+
+            accuracy = holdout_accuracy(model, X_holdout, y_holdout)
+            expected = manifest.get('holdout_accuracy')
+            if accuracy is not None and expected is not None and abs(accuracy - expected) > 1e-9:
+                raise ValueError(f"holdout accuracy {accuracy:.4f} differs from the published {expected:.4f}")
+
+            active_model = self.active[1]
+            if compare_active and accuracy is not None and active_model is not None:
+                active_accuracy = holdout_accuracy(active_model, X_holdout, y_holdout)
+                if accuracy < active_accuracy - self.tolerance:
+                    raise ValueError(f"holdout accuracy {accuracy:.4f} is below the active model's "
+                                     f"{active_accuracy:.4f}")
+        except (OSError, ValueError, KeyError) as e:
+            MODEL_REJECTIONS.inc()
+            print(f"Rejected model version {version}: {e}")
+            return None
+        return model
+
+    def activate(self, version, model):
+        self.previous, self.active = self.active, (version, model)
+        ACTIVE_MODEL_VERSION.set(int(version) if version is not None else 0)
+        MODEL_SWAPS.inc()
+        print(f"Serving model version {version or 'unversioned'}")
+
+    def request_rollback(self):
+        with self.lock:
+            self.rollback_requested = True
+
+    # The model for this cycle, after applying any pending swap or rollback. A rollback
+    # swaps the active and previous models, so a second rollback undoes the first.
+    def current(self):
+        with self.lock:
+            candidate, self.candidate = self.candidate, None
+            rollback, self.rollback_requested = self.rollback_requested, False
+        if rollback:
+            if self.previous is None or self.previous[1] is None:
+                print("No previous model to roll back to")
+            else:
+                version = self.active[0]
+                self.activate(*self.previous)
+                print(f"Rolled back from model version {version or 'unversioned'}")
+        elif candidate is not None:
+            self.activate(*candidate)
+        return self.active[1]
+
+    def versions(self):
+        return {'active': self.active[0], 'previous': self.previous[0] if self.previous else None}
@@ -0,0 +1,97 @@
+import http.client
+import json
+import os
+import socket
+import struct
+from urllib.parse import quote
+
+from instrumentation import NGINX_RELOADS
+
+# Reloads nginx after meta-lb rewrites its config. nginx runs in its own container, so the
+# Docker Engine API on the mounted docker.sock runs `nginx -t` inside every container of
+# the compose service and, only if the config is valid, sends it SIGHUP (a graceful
+# reload: old workers finish their requests on the old config).
+DOCKER_SOCKET = os.environ.get('DOCKER_SOCKET', '/var/run/docker.sock')
+# Compose service whose containers are reloaded; empty disables reloading
+NGINX_SERVICE = os.environ.get('NGINX_SERVICE', 'nginx')
+DOCKER_TIMEOUT_SECONDS = 10.0
+
+
+class NginxConfigError(RuntimeError):
+    pass
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=DOCKER_TIMEOUT_SECONDS):
+        super().__init__('localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+# stdout/stderr of a non-TTY exec arrive as frames with an 8-byte header: stream, 0, 0, 0, length
+def demultiplex(data):
+    output, offset = [], 0
+    while offset + 8 <= len(data):
+        _, length = struct.unpack('>B3xI', data[offset:offset + 8])
+        output.append(data[offset + 8:offset + 8 + length])
+        offset += 8 + length
+    return b''.join(output).decode(errors='replace')
+
+
+class NginxReloader:
+    def __init__(self, service=NGINX_SERVICE, socket_path=DOCKER_SOCKET):
+        self.service = service
+        self.socket_path = socket_path
+
+    def request(self, method, path, body=None):
+        connection = UnixHTTPConnection(self.socket_path)
+        try:
+            connection.request(method, path, body=None if body is None else json.dumps(body),
+                               headers={'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            data = response.read()
+        finally:
+            connection.close()
+        if response.status >= 400:
+            raise OSError(f"Docker API {method} {path}: {response.status} {data.decode(errors='replace').strip()}")
+        return data
+
+    def containers(self):
+        filters = quote(json.dumps({'label': [f'com.docker.compose.service={self.service}'],
+                                    'status': ['running']}))
+        containers = json.loads(self.request('GET', f'/containers/json?filters={filters}'))
+        return [container['Id'] for container in containers]
+
+    # Run `nginx -t` in the container; returns (exit code, output)
+    def test_config(self, container):
+        exec_id = json.loads(self.request('POST', f'/containers/{container}/exec', {
+            'Cmd': ['nginx', '-t'], 'AttachStdout': True, 'AttachStderr': True}))['Id']
+        output = demultiplex(self.request('POST', f'/exec/{exec_id}/start', {'Detach': False, 'Tty': False}))
+        return json.loads(self.request('GET', f'/exec/{exec_id}/json'))['ExitCode'], output
+
+    # Validate and reload every nginx container. Raises NginxConfigError when nginx rejects
+    # the config; an unreachable Docker API is only reported, as nothing can be reloaded then.
+    def reload(self):
+        try:
+            containers = self.containers()
+            if not containers:
+                print(f"No running containers of service '{self.service}' to reload")
+                NGINX_RELOADS.labels(result='no_containers').inc()
+                return
+            for container in containers:
+                exit_code, output = self.test_config(container)
+                if exit_code != 0:
+                    NGINX_RELOADS.labels(result='invalid').inc()
+                    raise NginxConfigError(f"nginx -t failed in {container[:12]}: {output.strip()}")
+            for container in containers:
+                self.request('POST', f'/containers/{container}/kill?signal=HUP')
+        except (OSError, ValueError, KeyError, http.client.HTTPException) as e:
+            print(f"Could not reload nginx: {e}")
+            NGINX_RELOADS.labels(result='error').inc()
+            return
+        NGINX_RELOADS.labels(result='reloaded').inc()
+        print(f"Reloaded nginx in {len(containers)} container(s) of service '{self.service}'")
@@ -0,0 +1,63 @@
+import os
+import threading
+
+import numpy as np
+
+from features import SAMPLE_INTERVAL_SECONDS
+from instrumentation import DECISION_CYCLES, DECISION_INTERVAL_SECONDS
+
+MIN_INTERVAL_SECONDS = float(os.environ.get('MIN_INTERVAL_SECONDS', '1'))
+MAX_INTERVAL_SECONDS = float(os.environ.get('MAX_INTERVAL_SECONDS', '30'))
+# Stable cycles stretch the interval by this factor, up to MAX_INTERVAL_SECONDS
+BACKOFF_FACTOR = 1.5
+# A normalised feature moving by at least this much since the last cycle counts as fast change
+CHANGE_THRESHOLD = 0.05
+# A prediction whose top confidence is below this counts as uncertain
+LOW_CONFIDENCE = 0.6
+
+
+# Decides when the next decision cycle runs. Fast-changing features or an uncertain
+# prediction drop the interval straight to min_interval; every stable cycle backs it
+# off by BACKOFF_FACTOR towards max_interval. trigger() wakes the loop immediately,
+# e.g. from the alert webhook.
+class AdaptiveScheduler:
+    def __init__(self, min_interval=MIN_INTERVAL_SECONDS, max_interval=MAX_INTERVAL_SECONDS,
+                 initial_interval=SAMPLE_INTERVAL_SECONDS, backoff_factor=BACKOFF_FACTOR,
+                 change_threshold=CHANGE_THRESHOLD, low_confidence=LOW_CONFIDENCE):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff_factor = backoff_factor
+        self.change_threshold = change_threshold
+        self.low_confidence = low_confidence
+        self.interval = min(max(initial_interval, min_interval), max_interval)
+        self.last_vector = None
+        self.event = threading.Event()
+        self.trigger_source = None
+        DECISION_INTERVAL_SECONDS.set(self.interval)
+
+    # Feed one cycle's normalised feature vector and top confidence; returns the next interval
+    def observe(self, vector, confidence=1.0):
+        vector = np.asarray(vector, dtype=np.float64).ravel()
+        change = 0.0 if self.last_vector is None else float(np.abs(vector - self.last_vector).max())
+        self.last_vector = vector
+
+        if change >= self.change_threshold or confidence < self.low_confidence:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * self.backoff_factor, self.max_interval)
+        DECISION_INTERVAL_SECONDS.set(self.interval)
+        return self.interval
+
+    # Run a cycle now and keep polling fast until the features settle again
+    def trigger(self, source='webhook'):
+        self.trigger_source = source
+        self.interval = self.min_interval
+        self.event.set()
+
+    # Sleep until the interval elapses or trigger() is called; returns the trigger source, or None
+    def wait(self):
+        triggered = self.event.wait(self.interval)
+        self.event.clear()
+        source, self.trigger_source = (self.trigger_source or 'webhook') if triggered else None, None
+        DECISION_CYCLES.labels(cause='trigger' if triggered else 'timer').inc()
+        return source
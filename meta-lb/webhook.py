@@ -0,0 +1,69 @@
+import hmac
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WEBHOOK_PORT = 8001
+# Shared secret every POST must send as `Authorization: Bearer <token>` (Alertmanager's
+# http_config.authorization). Without one the endpoint only listens on localhost.
+WEBHOOK_TOKEN = os.environ.get('WEBHOOK_TOKEN', '')
+
+
+# Local control endpoint. `routes` maps a POST path to a handler that takes the decoded
+# JSON body (or None) and returns a short status message; handlers run on the server's
+# thread, so they should only signal the main loop, not do the work themselves.
+def make_handler(routes, token=WEBHOOK_TOKEN):
+    expected = f'Bearer {token}'.encode()
+
+    class WebhookHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if token and not hmac.compare_digest(self.headers.get('Authorization', '').encode(), expected):
+                self.respond(401, 'Unauthorized')
+                return
+            handler = routes.get(self.path.split('?')[0])
+            if handler is None:
+                self.respond(404, 'Not found')
+                return
+            length = int(self.headers.get('Content-Length') or 0)
+            try:
+                payload = json.loads(self.rfile.read(length)) if length else None
+            except ValueError:
+                self.respond(400, 'Body is not valid JSON')
+                return
+            self.respond(202, handler(payload))
+
+        def respond(self, status, message):
+            body = (message + '\n').encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return WebhookHandler
+
+
+def serve_webhook(routes, port=WEBHOOK_PORT, token=WEBHOOK_TOKEN, host=None):
+    if host is None:
+        host = '0.0.0.0' if token else '127.0.0.1'
+    if not token:
+        print("WEBHOOK_TOKEN is not set, the webhook only accepts requests from localhost")
+    server = ThreadingHTTPServer((host, port), make_handler(routes, token))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='webhook', daemon=True).start()
+    print(f"Webhook listening on port {server.server_port}: {', '.join(sorted(routes))}")
+    return server
+
+
+# Name of what fired, from an Alertmanager notification or a plain {"source": ...} body
+def trigger_source(payload):
+    if not isinstance(payload, dict):
+        return 'webhook'
+    if 'alerts' in payload:
+        names = sorted({alert.get('labels', {}).get('alertname', '?') for alert in payload['alerts']})
+        return f"alertmanager ({payload.get('status', 'unknown')}: {', '.join(names)})"
+    return str(payload.get('source', 'webhook'))
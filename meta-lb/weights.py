@@ -0,0 +1,96 @@
+import numpy as np
+
+# Weights mode: instead of choosing one algorithm for every backend, meta-lb scores
+# each backend's saturation from per-backend signals and pushes a weight per backend
+# for the LB's weighted least connections, which sends each request to the backend with
+# the fewest in-flight requests per unit of weight. A hot backend sheds load gradually.
+#
+# Every per-backend query is relabelled to a common `service` label (the compose
+# service name, i.e. the host part of the backend address) so that cadvisor's
+# container series and the LB's per-backend series line up.
+BACKEND_LABEL = 'service'
+
+CADVISOR_SERVICE = 'container_label_com_docker_compose_service'
+
+
+def _from_cadvisor(expr):
+    return f'label_replace(sum by ({CADVISOR_SERVICE}) ({expr}), "{BACKEND_LABEL}", "$1", "{CADVISOR_SERVICE}", "(.+)")'
+
+
+def _from_lb(expr):
+    return f'label_replace({expr}, "{BACKEND_LABEL}", "$1", "backend", "([^:]+).*")'
+
+
+# Per-backend signals: (name, PromQL grouped by service, default, normalisation scale, coefficient).
+# A normalised value of 1 means "saturated"; the coefficients weigh the signals into one score.
+BACKEND_SIGNALS = [
+    ('backend_cpu', _from_cadvisor(f'rate(container_cpu_usage_seconds_total{{{CADVISOR_SERVICE}!=""}}[1m])'),
+     0.0, 1.0, 0.35),
+    ('backend_mem', _from_cadvisor(f'container_memory_working_set_bytes{{{CADVISOR_SERVICE}!=""}}')
+     + ' / on() group_left() sum(machine_memory_bytes)', 0.0, 0.5, 0.1),
+    ('backend_inflight', _from_lb('sum by (backend) (lb_backend_inflight_requests)'), 0.0, 50.0, 0.25),
+    ('backend_latency', _from_lb('sum by (backend) (rate(lb_backend_request_duration_seconds_sum[1m]))'
+                                 ' / sum by (backend) (rate(lb_backend_request_duration_seconds_count[1m]))'),
+     0.0, 0.5, 0.3),
+]
+BACKEND_QUERIES = [(name, query, default) for name, query, default, _, _ in BACKEND_SIGNALS]
+
+# Normalised signals are capped so one runaway signal cannot dominate the score
+SATURATION_CAP = 2.0
+
+# Each cycle a backend's weight is scaled by exp(-ADAPT_RATE * (its saturation - fleet mean)),
+# so weight keeps flowing from hotter to cooler backends until their saturation evens out.
+# Weights are integers summing to about WEIGHT_TOTAL; a backend's weight changes by at most
+# MAX_WEIGHT_STEP per cycle, and changes smaller than WEIGHT_DEADBAND are not pushed at all.
+# MIN_WEIGHT keeps every backend receiving a trickle of traffic so its recovery shows up.
+WEIGHT_TOTAL = 100
+ADAPT_RATE = 1.0
+MAX_WEIGHT_STEP = 10
+WEIGHT_DEADBAND = 2
+MIN_WEIGHT = 5
+
+
+def service_name(backend):
+    return backend.split(':')[0]
+
+
+class WeightScorer:
+    def __init__(self, backends, signals=BACKEND_SIGNALS, adapt_rate=ADAPT_RATE,
+                 max_step=MAX_WEIGHT_STEP, deadband=WEIGHT_DEADBAND, min_weight=MIN_WEIGHT, total=WEIGHT_TOTAL):
+        self.backends = list(backends)
+        self.services = [service_name(backend) for backend in self.backends]
+        self.signals = [(name, default) for name, _, default, _, _ in signals]
+        self.scales = np.array([scale for _, _, _, scale, _ in signals])
+        self.coefficients = np.array([coefficient for _, _, _, _, coefficient in signals])
+        self.adapt_rate = adapt_rate
+        self.max_step = max_step
+        self.deadband = deadband
+        self.min_weight = min_weight
+        self.total = total
+
+        # Start from an even split
+        self.target = np.full(len(self.backends), total / len(self.backends))
+        self.weights = np.rint(self.target).astype(int)
+        self.last_saturation = np.zeros(len(self.backends))
+
+    # Backends x signals matrix of normalised values from the collector's {signal: {service: value}}
+    def signal_matrix(self, values):
+        matrix = np.empty((len(self.services), len(self.signals)))
+        for column, (name, default) in enumerate(self.signals):
+            series = values.get(name) or {}
+            matrix[:, column] = [series.get(service, default) for service in self.services]
+        return np.clip(matrix / self.scales, 0.0, SATURATION_CAP)
+
+    def saturation(self, values):
+        return self.signal_matrix(values) @ self.coefficients
+
+    # Move the weights one rate-limited step towards evening out saturation; returns {backend: weight}
+    def update(self, values):
+        saturation = self.last_saturation = self.saturation(values)
+        self.target *= np.exp(-self.adapt_rate * (saturation - saturation.mean()))
+        self.target = np.maximum(self.total * self.target / self.target.sum(), self.min_weight)
+        step = np.clip(self.target - self.weights, -self.max_step, self.max_step)
+        proposed = np.maximum(np.rint(self.weights + step), self.min_weight).astype(int)
+        if np.abs(proposed - self.weights).max() >= self.deadband:
+            self.weights = proposed
+        return dict(zip(self.backends, self.weights.tolist()))
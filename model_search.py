@@ -0,0 +1,197 @@
+import hashlib
+import json
+import math
+import os
+import resource
+import shutil
+import time
+
+import numpy as np
+from joblib import Parallel, delayed
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.model_selection import ParameterGrid
+
+# Successive halving search for train_model.py.
+#
+# Candidates are first scored on a small prefix of the training rows and only the
+# best 1/FACTOR survive into the next round, which uses FACTOR times more rows.
+# The training matrix is written once to a .npy file and memory-mapped, so joblib
+# workers share the pages instead of each receiving a pickled copy. Every fold score
+# is cached on disk under a key made of the hash of the rows it saw and the params,
+# so a rerun only trains what it has not seen before. The store returns rows grouped by
+# scenario and run, so they are first shuffled by a hash of their stable row key: every
+# prefix is then a sample of all scenarios, and folds assigned by position in that order
+# are random too. The order is saved in the cache: on the next run rows seen before keep
+# their place and unseen rows follow them in hash order, so a rerun after rows were appended
+# sees the same early-round prefixes and hits the cache for them. When fewer than half the
+# rows were seen before (e.g. different filters) the order starts afresh from the hashes.
+CACHE_DIR = ".train-cache"
+ORDER_PATH = os.path.join(CACHE_DIR, "order.npy")
+FACTOR = 3
+MIN_RESOURCES = 500
+N_SPLITS = 5
+N_JOBS = int(os.environ.get("TRAIN_N_JOBS", max(1, (os.cpu_count() or 2) // 2)))
+
+
+# Deterministic 64-bit mix, used to derive stable row keys and the splits made from them
+def splitmix64(values):
+    z = (values.astype(np.uint64) + np.uint64(0x9E3779B97F4A7C15))
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+
+def string_hashes(values):
+    uniques, inverse = np.unique(np.asarray(values), return_inverse=True)
+    hashes = np.array([int.from_bytes(hashlib.sha1(str(value).encode()).digest()[:8], "little") for value in uniques],
+                      dtype=np.uint64)
+    return hashes[inverse]
+
+
+# Stable 64-bit identity of every row from its scenario, run and timestamp, so a row gets
+# the same key whatever filters selected it or rows were appended. Rows sharing all three
+# (converted CSV rows have no timestamp) are told apart by their order of appearance.
+def row_keys(scenarios, run_ids, timestamps):
+    keys = splitmix64(string_hashes(scenarios) ^ splitmix64(string_hashes(run_ids)))
+    keys = splitmix64(keys ^ np.ascontiguousarray(timestamps, dtype=np.float64).view(np.uint64))
+    order = np.argsort(keys, kind="stable")
+    first = np.concatenate(([True], keys[order][1:] != keys[order][:-1]))
+    positions = np.arange(len(keys))
+    occurrence = np.empty(len(keys), dtype=np.uint64)
+    occurrence[order] = positions - np.maximum.accumulate(np.where(first, positions, 0))
+    return splitmix64(keys ^ occurrence)
+
+
+# Boolean mask of holdout rows; a row keeps its assignment when rows are appended or filtered
+def stable_test_mask(keys, test_fraction=0.2):
+    return splitmix64(keys) % np.uint64(1000) < np.uint64(int(test_fraction * 1000))
+
+
+def data_hash(X, y):
+    digest = hashlib.sha1()
+    digest.update(np.ascontiguousarray(X).tobytes())
+    digest.update(np.ascontiguousarray(y).tobytes())
+    return digest.hexdigest()
+
+
+def cache_key(rows_hash, params, fold):
+    payload = json.dumps({"rows": rows_hash, "params": params, "fold": fold, "n_splits": N_SPLITS}, sort_keys=True)
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+
+# Write X and y once and reopen them read-only memory-mapped, for sharing with workers
+def share_arrays(X, y):
+    name = "data-" + data_hash(X, y)
+    directory = os.path.join(CACHE_DIR, name)
+    os.makedirs(directory, exist_ok=True)
+    # Only the current matrix is kept; fold scores are what the cache is for
+    for stale in os.listdir(CACHE_DIR):
+        if stale.startswith("data-") and stale != name:
+            shutil.rmtree(os.path.join(CACHE_DIR, stale), ignore_errors=True)
+    paths = {"X": os.path.join(directory, "X.npy"), "y": os.path.join(directory, "y.npy")}
+    for name, array in (("X", X), ("y", y)):
+        if not os.path.exists(paths[name]):
+            tmp_path = paths[name] + ".tmp.npy"
+            np.save(tmp_path, np.ascontiguousarray(array))
+            os.replace(tmp_path, paths[name])
+    return np.load(paths["X"], mmap_mode="r"), np.load(paths["y"], mmap_mode="r")
+
+
+# Row order for the search: rows in the saved order first, then unseen rows by hash
+def row_order(keys):
+    # Hash again so the order is independent of stable_test_mask, which hashes the keys once
+    by_hash = np.argsort(splitmix64(splitmix64(keys)), kind="stable")
+    seen = np.zeros(len(keys), dtype=bool)
+    if os.path.exists(ORDER_PATH):
+        previous = np.load(ORDER_PATH)
+        previous = previous[np.isin(previous, keys)]
+        if len(previous) * 2 >= len(keys):
+            sorter = np.argsort(keys, kind="stable")
+            kept = sorter[np.searchsorted(keys, previous, sorter=sorter)]
+            seen[kept] = True
+            by_hash = np.concatenate((kept, by_hash[~seen[by_hash]]))
+    tmp_path = ORDER_PATH + ".tmp.npy"
+    np.save(tmp_path, keys[by_hash])
+    os.replace(tmp_path, ORDER_PATH)
+    return by_hash
+
+
+def fit_fold(X, y, n_rows, fold, params):
+    fold_ids = np.arange(n_rows) % N_SPLITS
+    train, val = fold_ids != fold, fold_ids == fold
+    started = time.perf_counter()
+    model = RandomForestClassifier(random_state=42, class_weight="balanced", n_jobs=1, **params)
+    model.fit(X[:n_rows][train], y[:n_rows][train])
+    score = float(model.score(X[:n_rows][val], y[:n_rows][val]))
+    # Workers are long-lived, so each reports its own peak RSS rather than the parent reading it
+    return {"score": score, "fit_seconds": time.perf_counter() - started,
+            "worker_peak_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+
+
+# `keys` are the rows' stable keys (see row_keys); row positions are used when omitted
+def successive_halving(X, y, param_grid, keys=None):
+    started = time.perf_counter()
+    fold_dir = os.path.join(CACHE_DIR, "folds")
+    os.makedirs(fold_dir, exist_ok=True)
+    keys = np.arange(len(y), dtype=np.uint64) if keys is None else np.asarray(keys, dtype=np.uint64)
+    order = row_order(keys)
+    X, y = share_arrays(np.asarray(X, dtype=np.float64)[order], np.asarray(y)[order])
+
+    candidates = [dict(sorted(params.items())) for params in ParameterGrid(param_grid)]
+    n_rounds = max(1, math.ceil(math.log(len(candidates), FACTOR)) + 1)
+    n_rows = len(y)
+
+    trained, cached = 0, 0
+    worker_peak_mb = 0.0
+    history = []
+    with Parallel(n_jobs=N_JOBS) as parallel:
+        for round_index in range(n_rounds):
+            # Round sizes are absolute, not fractions of the data, so they stay cacheable
+            resources = n_rows if round_index == n_rounds - 1 else min(MIN_RESOURCES * FACTOR ** round_index, n_rows)
+            rows_hash = data_hash(X[:resources], y[:resources])
+
+            # Reuse cached fold scores, train only the missing ones
+            tasks, results = [], {}
+            for index, params in enumerate(candidates):
+                for fold in range(N_SPLITS):
+                    path = os.path.join(fold_dir, cache_key(rows_hash, params, fold) + ".json")
+                    if os.path.exists(path):
+                        with open(path) as f:
+                            results[index, fold] = json.load(f)
+                    else:
+                        tasks.append((index, fold, path))
+            outputs = parallel(delayed(fit_fold)(X, y, resources, fold, candidates[index]) for index, fold, _ in tasks)
+            for (index, fold, path), output in zip(tasks, outputs):
+                with open(path, "w") as f:
+                    json.dump(output, f)
+                results[index, fold] = output
+            trained += len(tasks)
+            worker_peak_mb = max([worker_peak_mb] + [output["worker_peak_mb"] for output in outputs])
+            cached += len(results) - len(tasks)
+
+            scores = [np.mean([results[index, fold]["score"] for fold in range(N_SPLITS)]) for index in range(len(candidates))]
+            ranking = np.argsort(scores)[::-1]
+            history.append({"round": round_index, "rows": resources, "candidates": len(candidates),
+                            "best_score": float(scores[ranking[0]])})
+            print(f"Round {round_index}: {len(candidates)} candidate(s) on {resources} rows, "
+                  f"best CV accuracy {scores[ranking[0]]:.4f} with {candidates[ranking[0]]}")
+
+            best_params, best_score = candidates[ranking[0]], float(scores[ranking[0]])
+            if resources == n_rows:
+                break
+            candidates = [candidates[i] for i in ranking[:max(1, math.ceil(len(candidates) / FACTOR))]]
+
+    best_model = RandomForestClassifier(random_state=42, class_weight="balanced", n_jobs=N_JOBS, **best_params)
+    best_model.fit(X, y)
+
+    report = {
+        "best_params": best_params,
+        "best_score": best_score,
+        "time_to_best_model_seconds": time.perf_counter() - started,
+        "folds_trained": trained,
+        "folds_cached": cached,
+        "peak_memory_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "peak_worker_memory_mb": worker_peak_mb,
+        "rounds": history,
+    }
+    return best_model, report
@@ -0,0 +1,329 @@
+import os
+import sys
+import threading
+import time
+import urllib.request
+
+import numpy as np
+from prometheus_client import start_http_server
+from prometheus_client.core import REGISTRY, CounterMetricFamily, GaugeMetricFamily, HistogramMetricFamily
+from prometheus_client.utils import floatToGoString
+
+# Sidecar that tails nginx's `metrics` access log (see nginx/nginx.conf) and exports the
+# series meta-lb's feature queries read: nginx_http_request_duration_seconds,
+# nginx_http_requests_total and nginx_http_connections_active, all labelled by upstream.
+# Lines are read in large blocks from the last offset, never re-read, and folded into
+# fixed-bucket histograms per upstream, so memory does not grow with traffic.
+#
+# Log line: $msec $status $request_time $proxy_host $upstream_response_time
+# ($upstream_response_time is last because it holds "a, b" when nginx retried upstreams)
+
+ACCESS_LOG_PATH = os.environ.get('ACCESS_LOG_PATH', '/var/log/nginx/metrics/access.log')
+# nginx stub_status page for connection counts; empty disables it
+STUB_STATUS_URL = os.environ.get('STUB_STATUS_URL', 'http://nginx:8080/nginx_status')
+EXPORTER_PORT = int(os.environ.get('EXPORTER_PORT', '9113'))
+# Replay an existing log from its start instead of starting at its end
+FROM_START = os.environ.get('FROM_START', '0') == '1'
+# Truncate the log in place once it has been consumed past this size, 0 never truncates.
+# In compose nothing else rotates it; lines nginx appends between the final read and the
+# truncate are lost, which costs a few samples, not correctness.
+TRUNCATE_LOG_BYTES = int(os.environ.get('TRUNCATE_LOG_BYTES', str(256 * 1024 * 1024)))
+
+# Upper bounds in seconds, the same buckets meta-lb uses for its windowed p95
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0)
+# Most bytes handed to the aggregator per read, and the longest line kept
+READ_BYTES = 8 * 1024 * 1024
+MAX_LINE_BYTES = 64 * 1024
+POLL_SECONDS = 0.1
+# Active connections per upstream are estimated over this window (Little's law)
+ACTIVE_WINDOW_SECONDS = 5.0
+# Further upstreams are counted under 'other', bounding the label set
+MAX_UPSTREAMS = 256
+STUB_STATUS_TIMEOUT_SECONDS = 1.0
+
+
+# Follows a log file across rotation (rename and reopen, or copytruncate) from the last offset
+class LogTailer:
+    def __init__(self, path, from_start=FROM_START, truncate_bytes=TRUNCATE_LOG_BYTES):
+        self.path = path
+        self.truncate_bytes = truncate_bytes
+        self.fd = None
+        self.inode = None
+        self.position = 0
+        self.partial = b''
+        self.rotations = 0
+        self.dropped_lines = 0
+        self.open(from_start)
+
+    def open(self, from_start):
+        try:
+            fd = os.open(self.path, os.O_RDWR if self.truncate_bytes else os.O_RDONLY)
+        except FileNotFoundError:
+            return False
+        stat = os.fstat(fd)
+        self.fd = fd
+        self.inode = (stat.st_dev, stat.st_ino)
+        self.position = 0 if from_start else stat.st_size
+        self.partial = b''
+        print(f"Tailing {self.path} from offset {self.position}")
+        return True
+
+    # Complete lines appended since the last call, as one block, and whether more is waiting
+    def read(self):
+        if self.fd is None and not self.open(from_start=True):
+            return b'', False
+        data = os.pread(self.fd, READ_BYTES, self.position)
+        self.position += len(data)
+        more = len(data) == READ_BYTES
+
+        if not more:
+            try:
+                stat = os.stat(self.path)
+            except FileNotFoundError:
+                stat = None
+            if stat is not None and (stat.st_dev, stat.st_ino) != self.inode:
+                # Rotated by rename: the old file is fully read, continue with the new one
+                os.close(self.fd)
+                self.fd = None
+                self.rotations += 1
+                self.open(from_start=True)
+                more = True
+            elif stat is not None and stat.st_size < self.position:
+                # Truncated in place by someone else
+                self.position = 0
+                self.partial = b''
+                self.rotations += 1
+                more = True
+            elif (stat is not None and self.truncate_bytes and self.position >= self.truncate_bytes
+                  and stat.st_size == self.position):
+                os.ftruncate(self.fd, 0)
+                self.position = 0
+                self.rotations += 1
+
+        block = self.partial + data if self.partial else data
+        end = block.rfind(b'\n') + 1
+        self.partial = block[end:]
+        if len(self.partial) > MAX_LINE_BYTES:
+            self.partial = b''
+            self.dropped_lines += 1
+        return block[:end], more
+
+
+class UpstreamStats:
+    def __init__(self):
+        self.duration_counts = np.zeros(len(LATENCY_BUCKETS) + 1, dtype=np.int64)
+        self.duration_sum = 0.0
+        self.upstream_counts = np.zeros(len(LATENCY_BUCKETS) + 1, dtype=np.int64)
+        self.upstream_sum = 0.0
+        self.requests = {}
+        # Request-seconds completed in the current window, and the estimate from the last one
+        self.busy_seconds = 0.0
+        self.active = 0.0
+
+
+def parse_seconds(values):
+    try:
+        return np.array(values).astype(np.float64)
+    except ValueError:
+        # '-' (no upstream) or "a, b" (retried upstreams): count the time spent on every attempt
+        return np.array([sum(float(part) for part in value.split(b', ') if part != b'-') if value != b'-'
+                         else np.nan for value in values])
+
+
+# Folds blocks of log lines into per-upstream histograms and counters
+class LogAggregator:
+    def __init__(self, window_seconds=ACTIVE_WINDOW_SECONDS, max_upstreams=MAX_UPSTREAMS):
+        self.bounds = np.asarray(LATENCY_BUCKETS)
+        self.window_seconds = window_seconds
+        self.max_upstreams = max_upstreams
+        self.lock = threading.Lock()
+        self.upstreams = {}
+        self.lines = 0
+        self.malformed = 0
+        self.window_started = time.monotonic()
+
+    def stats(self, upstream):
+        stats = self.upstreams.get(upstream)
+        if stats is None:
+            if len(self.upstreams) >= self.max_upstreams:
+                upstream = 'other'
+                stats = self.upstreams.get(upstream)
+            if stats is None:
+                stats = self.upstreams[upstream] = UpstreamStats()
+        return stats
+
+    def ingest(self, block):
+        # Group the fields by upstream in one pass, then parse and bucket each group with NumPy
+        groups = {}
+        malformed = 0
+        lines = block.split(b'\n')
+        lines.pop()
+        for line in lines:
+            fields = line.split(b' ', 4)
+            if len(fields) < 5:
+                malformed += 1
+                continue
+            group = groups.get(fields[3])
+            if group is None:
+                group = groups[fields[3]] = ([], [], [])
+            group[0].append(fields[2])
+            group[1].append(fields[1][:1])
+            group[2].append(fields[4])
+
+        parsed = []
+        for upstream, (request_times, statuses, upstream_times) in groups.items():
+            try:
+                durations = np.array(request_times).astype(np.float64)
+            except ValueError:
+                malformed += len(request_times)
+                continue
+            upstream_seconds = parse_seconds(upstream_times)
+            upstream_seconds = upstream_seconds[~np.isnan(upstream_seconds)]
+            classes = dict(zip(*np.unique(np.array(statuses), return_counts=True)))
+            parsed.append((upstream.decode(errors='replace'), durations, upstream_seconds, classes))
+
+        with self.lock:
+            self.lines += len(lines)
+            self.malformed += malformed
+            for upstream, durations, upstream_seconds, classes in parsed:
+                stats = self.stats(upstream)
+                stats.duration_counts += np.bincount(np.searchsorted(self.bounds, durations, side='left'),
+                                                     minlength=len(self.bounds) + 1)
+                stats.duration_sum += float(durations.sum())
+                stats.busy_seconds += float(durations.sum())
+                stats.upstream_counts += np.bincount(np.searchsorted(self.bounds, upstream_seconds, side='left'),
+                                                     minlength=len(self.bounds) + 1)
+                stats.upstream_sum += float(upstream_seconds.sum())
+                for status_class, count in classes.items():
+                    label = status_class.decode(errors='replace') + 'xx'
+                    stats.requests[label] = stats.requests.get(label, 0) + int(count)
+
+    # Close the active-connections window: concurrency = request-seconds / window length
+    def roll_window(self, now):
+        elapsed = now - self.window_started
+        if elapsed < self.window_seconds:
+            return
+        with self.lock:
+            for stats in self.upstreams.values():
+                stats.active = stats.busy_seconds / elapsed
+                stats.busy_seconds = 0.0
+        self.window_started = now
+
+
+# nginx stub_status page -> {'active': .., 'accepted': .., 'handled': .., 'requests': .., 'reading': ..}
+def parse_stub_status(text):
+    lines = text.split('\n')
+    accepted, handled, requests = (int(value) for value in lines[2].split())
+    values = {'active': int(lines[0].split(':')[1]), 'accepted': accepted, 'handled': handled, 'requests': requests}
+    fields = lines[3].split()
+    for name, value in zip(fields[::2], fields[1::2]):
+        values[name.rstrip(':').lower()] = int(value)
+    return values
+
+
+def cumulative_buckets(counts):
+    cumulative = np.cumsum(counts)
+    return [(floatToGoString(bound), int(count)) for bound, count in zip(LATENCY_BUCKETS, cumulative)] + \
+        [('+Inf', int(cumulative[-1]))]
+
+
+class NginxCollector:
+    def __init__(self, aggregator, tailer, stub_status_url=STUB_STATUS_URL):
+        self.aggregator = aggregator
+        self.tailer = tailer
+        self.stub_status_url = stub_status_url
+
+    def collect(self):
+        duration = HistogramMetricFamily('nginx_http_request_duration_seconds',
+                                         'Request time as logged by nginx ($request_time)', labels=['upstream'])
+        upstream_time = HistogramMetricFamily('nginx_http_upstream_response_seconds',
+                                              'Upstream response time as logged by nginx ($upstream_response_time)',
+                                              labels=['upstream'])
+        requests = CounterMetricFamily('nginx_http_requests', 'Requests logged by nginx',
+                                       labels=['upstream', 'status'])
+        active = GaugeMetricFamily('nginx_http_connections_active',
+                                   'Requests in flight per upstream, averaged over the last window',
+                                   labels=['upstream'])
+        with self.aggregator.lock:
+            for upstream, stats in self.aggregator.upstreams.items():
+                duration.add_metric([upstream], cumulative_buckets(stats.duration_counts), stats.duration_sum)
+                upstream_time.add_metric([upstream], cumulative_buckets(stats.upstream_counts), stats.upstream_sum)
+                for status, count in stats.requests.items():
+                    requests.add_metric([upstream, status], count)
+                active.add_metric([upstream], stats.active)
+            lines, malformed = self.aggregator.lines, self.aggregator.malformed
+        yield from (duration, upstream_time, requests, active)
+
+        yield CounterMetricFamily('nginx_exporter_lines', 'Access log lines read', value=lines)
+        yield CounterMetricFamily('nginx_exporter_malformed_lines', 'Access log lines that did not parse',
+                                  value=malformed + self.tailer.dropped_lines)
+        yield CounterMetricFamily('nginx_exporter_log_rotations', 'Times the access log was rotated or truncated',
+                                  value=self.tailer.rotations)
+
+        if self.stub_status_url:
+            yield from self.collect_stub_status()
+
+    def collect_stub_status(self):
+        try:
+            with urllib.request.urlopen(self.stub_status_url, timeout=STUB_STATUS_TIMEOUT_SECONDS) as response:
+                status = parse_stub_status(response.read().decode())
+        except (OSError, ValueError, IndexError) as e:
+            print(f"Error reading {self.stub_status_url}: {e}")
+            yield GaugeMetricFamily('nginx_up', 'Whether stub_status could be read', value=0)
+            return
+        yield GaugeMetricFamily('nginx_up', 'Whether stub_status could be read', value=1)
+        yield GaugeMetricFamily('nginx_connections_active', 'Open client connections', value=status['active'])
+        for state in ('reading', 'writing', 'waiting'):
+            yield GaugeMetricFamily(f'nginx_connections_{state}', f'Client connections {state}', value=status[state])
+        yield CounterMetricFamily('nginx_connections_accepted', 'Accepted client connections', value=status['accepted'])
+        yield CounterMetricFamily('nginx_connections_handled', 'Handled client connections', value=status['handled'])
+
+
+def main():
+    aggregator = LogAggregator()
+    tailer = LogTailer(ACCESS_LOG_PATH)
+    REGISTRY.register(NginxCollector(aggregator, tailer))
+    start_http_server(EXPORTER_PORT)
+    print(f"nginx exporter listening on port {EXPORTER_PORT}")
+
+    while True:
+        try:
+            block, more = tailer.read()
+            if block:
+                aggregator.ingest(block)
+        except OSError as e:
+            print(f"Error reading {ACCESS_LOG_PATH}: {e}")
+            more = False
+        aggregator.roll_window(time.monotonic())
+        if not more:
+            time.sleep(POLL_SECONDS)
+
+
+# Throughput of the parse/aggregate path on synthetic lines
+def bench(n_lines=1_000_000):
+    rng = np.random.default_rng(0)
+    upstreams = [b'backend', b'api', b'static']
+    times = rng.exponential(0.05, n_lines)
+    lines = b''.join(b'%.3f %d %.3f %s %.3f\n' % (1700000000.0 + i / 1000, 200 if i % 50 else 502, t,
+                                                    upstreams[i % 3], t * 0.9)
+                     for i, t in enumerate(times))
+    blocks = []
+    start = 0
+    while start < len(lines):
+        end = lines.rfind(b'\n', start, start + READ_BYTES) + 1
+        blocks.append(lines[start:end])
+        start = end
+    aggregator = LogAggregator()
+    started = time.perf_counter()
+    for block in blocks:
+        aggregator.ingest(block)
+    elapsed = time.perf_counter() - started
+    print(f"{n_lines} lines in {elapsed:.2f} s: {n_lines / elapsed:,.0f} lines/s")
+
+
+# Usage: python exporter.py [bench [lines]]
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        bench(*(int(arg) for arg in sys.argv[2:3]))
+    else:
+        main()
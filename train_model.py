@@ -1,22 +1,46 @@
 import pandas as pd
-from sklearn.model_selection import train_test_split, GridSearchCV
+from sklearn.model_selection import GridSearchCV
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.metrics import classification_report, confusion_matrix
 import joblib
+import json
 import os
-
-DATASET_PATH = "dataset.csv"
+import sys
+from model_search import row_keys, stable_test_mask, successive_halving
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "meta-lb"))
+from forest import export_forest
+from registry import publish_version
+from features import FEATURE_NAMES, save_schema
+from datastore import DatasetStore
+
+# Columnar dataset store written by generate_dataset.py, see meta-lb/datastore.py
+DATASET_PATH = "dataset"
+# Optional filters: comma-separated scenarios to train on, and a random fraction of rows to keep
+TRAIN_SCENARIOS = os.environ.get("TRAIN_SCENARIOS")
+TRAIN_SAMPLE_FRACTION = os.environ.get("TRAIN_SAMPLE_FRACTION")
+# "grid" runs the exhaustive GridSearchCV, "halving" the cached successive halving search in model_search.py
+SEARCH_MODE = os.environ.get("SEARCH_MODE", "grid")
 MODEL_DIR = "meta-lb/models"
 MODEL_PATH = os.path.join(MODEL_DIR, "lb_model.pkl")
+FOREST_PATH = os.path.join(MODEL_DIR, "lb_forest")
+SCHEMA_PATH = os.path.join(MODEL_DIR, "feature_schema.json")
 
 def main():
     print(f"Loading dataset from {DATASET_PATH}...")
-    try:
-        data = pd.read_csv(DATASET_PATH)
-    except FileNotFoundError:
-        print(f"Error: Dataset file {DATASET_PATH} not found. Please run generate_dataset.py first.")
+    if not os.path.exists(os.path.join(DATASET_PATH, "schema.json")):
+        print(f"Error: Dataset {DATASET_PATH} not found. Please run generate_dataset.py first, "
+              f"or convert an old dataset.csv with: python meta-lb/datastore.py convert dataset.csv {DATASET_PATH}")
         return
 
+    where = {"scenario": TRAIN_SCENARIOS.split(",")} if TRAIN_SCENARIOS else None
+    sample = float(TRAIN_SAMPLE_FRACTION) if TRAIN_SAMPLE_FRACTION else None
+    columns = DatasetStore(DATASET_PATH).load(FEATURE_NAMES + ['label', 'scenario', 'run_id', 'timestamp'],
+                                              where=where, sample=sample)
+    # Identity of each row independent of which rows the filters kept, for the stable split
+    keys = row_keys(columns.pop('scenario'), columns.pop('run_id'), columns.pop('timestamp'))
+    data = pd.DataFrame(columns)
+
     if data.empty:
         print("Dataset is empty. No model will be trained.")
         return
@@ -26,33 +50,49 @@ def main():
     print(f"\nDataset shape: {data.shape}")
     print(f"\nLabel distribution:\n{data['label'].value_counts()}")
 
-    X = data[['cpu', 'mem', 'latency', 'p95', 'throughput', 'connections']]
+    # Columns come from the feature schema shared with meta-lb
+    X = data[FEATURE_NAMES]
     y = data['label']
 
-    print("\nSplitting data into training and testing sets (80/20 stratified)...")
-    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42, stratify=y)
-
-    print(f"Training set shape: X_train: {X_train.shape}, y_train: {y_train.shape}")
-    print(f"Test set shape: X_test: {X_test.shape}, y_test: {y_test.shape}")
-
     param_grid = {
         'n_estimators': [50, 100],
         'max_depth': [None, 10, 20],
         # Add other parameters here if needed, e.g., 'min_samples_split', 'min_samples_leaf'
     }
 
-    print("\nStarting GridSearchCV for RandomForestClassifier...")
-    # RandomForestClassifier with class_weight='balanced' can be helpful if classes are imbalanced
-    rf = RandomForestClassifier(random_state=42, class_weight='balanced') 
-    grid_search = GridSearchCV(estimator=rf, param_grid=param_grid, cv=5, scoring='accuracy', n_jobs=-1, verbose=1)
-    
-    grid_search.fit(X_train, y_train)
+    # Split by row identity so rows keep their side of the split as the dataset grows or is
+    # filtered. The published holdout is then unseen by earlier versions too, which a running
+    # meta-lb relies on when it compares a new version with the active one.
+    print("\nSplitting data into training and testing sets (80/20, stable under appends and filters)...")
+    test_mask = stable_test_mask(keys)
+    X_train, X_test = X[~test_mask], X[test_mask]
+    y_train, y_test = y[~test_mask], y[test_mask]
 
-    print("\nGridSearchCV complete.")
-    print(f"Best parameters found: {grid_search.best_params_}")
-    print(f"Best cross-validation accuracy: {grid_search.best_score_:.4f}")
+    print(f"Training set shape: X_train: {X_train.shape}, y_train: {y_train.shape}")
+    print(f"Test set shape: X_test: {X_test.shape}, y_test: {y_test.shape}")
 
-    best_model = grid_search.best_estimator_
+    if SEARCH_MODE == "halving":
+        print("\nStarting successive halving search for RandomForestClassifier...")
+        best_model, report = successive_halving(X_train.to_numpy(), y_train.to_numpy(), param_grid,
+                                                keys=keys[~test_mask])
+
+        print("\nSuccessive halving complete.")
+        print(f"Best parameters found: {report['best_params']}")
+        print(f"Best cross-validation accuracy: {report['best_score']:.4f}")
+        print(f"Search report:\n{json.dumps(report, indent=2)}")
+    else:
+        print("\nStarting GridSearchCV for RandomForestClassifier...")
+        # RandomForestClassifier with class_weight='balanced' can be helpful if classes are imbalanced
+        rf = RandomForestClassifier(random_state=42, class_weight='balanced')
+        grid_search = GridSearchCV(estimator=rf, param_grid=param_grid, cv=5, scoring='accuracy', n_jobs=-1, verbose=1)
+
+        grid_search.fit(X_train, y_train)
+
+        print("\nGridSearchCV complete.")
+        print(f"Best parameters found: {grid_search.best_params_}")
+        print(f"Best cross-validation accuracy: {grid_search.best_score_:.4f}")
+
+        best_model = grid_search.best_estimator_
 
     print("\nEvaluating model on the test set...")
     y_pred = best_model.predict(X_test)
@@ -72,5 +112,18 @@ def main():
     joblib.dump(best_model, MODEL_PATH)
     print("Model saved successfully.")
 
+    print(f"Exporting compiled forest for meta-lb to {FOREST_PATH}...")
+    export_forest(best_model, FOREST_PATH)
+    print("Compiled forest exported successfully.")
+
+    # Record the feature schema so meta-lb can refuse to serve mismatched features
+    save_schema(SCHEMA_PATH)
+    print(f"Feature schema saved to {SCHEMA_PATH}")
+
+    # Publish a versioned artifact that a running meta-lb validates and swaps in without a restart
+    version = publish_version(best_model, X_test.to_numpy(), y_test.to_numpy(), MODEL_DIR,
+                              extra={"search_mode": SEARCH_MODE, "train_rows": int(len(X_train))})
+    print(f"Published model version {version} to {os.path.join(MODEL_DIR, 'versions', version)}")
+
 if __name__ == "__main__":
     main()
\ No newline at end of file